@@ -0,0 +1,112 @@
+"""
+Decide when to add or retire consumer processes between the configured min
+and max process counts, based upon how saturated the processes are and if
+the backlog of messages is growing.
+
+"""
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Autoscaler(object):
+    """Scaling decisions for a single consumer. Processes are added when the
+    idle ratio of the processes drops below the scale up ratio, or when the
+    backlog grows for several poll intervals in a row while the processes
+    are busy. They are retired when the idle ratio stays above the scale
+    down ratio for several poll intervals in a row.
+
+    The gap between the two ratios and the cooldown periods after each change
+    keep the process count from flapping.
+
+    """
+    SCALE_DOWN = -1
+    SCALE_UP = 1
+
+    _SCALE_DOWN_COOLDOWN = 300
+    _SCALE_DOWN_IDLE_RATIO = 0.5
+    _SCALE_DOWN_INTERVALS = 3
+    _SCALE_UP_COOLDOWN = 60
+    _SCALE_UP_IDLE_RATIO = 0.1
+    _SCALE_UP_INTERVALS = 2
+
+    def __init__(self, minimum, maximum, config):
+        """Create the autoscaler for a consumer.
+
+        :param int minimum: The minimum number of processes
+        :param int maximum: The maximum number of processes
+        :param dict config: The consumer configuration
+
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.scale_down_cooldown = config.get('scale_down_cooldown',
+                                              self._SCALE_DOWN_COOLDOWN)
+        self.scale_down_idle_ratio = config.get('scale_down_idle_ratio',
+                                                self._SCALE_DOWN_IDLE_RATIO)
+        self.scale_down_intervals = config.get('scale_down_intervals',
+                                               self._SCALE_DOWN_INTERVALS)
+        self.scale_up_cooldown = config.get('scale_up_cooldown',
+                                            self._SCALE_UP_COOLDOWN)
+        self.scale_up_idle_ratio = config.get('scale_up_idle_ratio',
+                                              self._SCALE_UP_IDLE_RATIO)
+        self.scale_up_intervals = config.get('scale_up_intervals',
+                                             self._SCALE_UP_INTERVALS)
+        self.growing_intervals = 0
+        self.idle_intervals = 0
+        self.last_backlog = None
+        self.last_change = 0
+
+    def decide(self, processes, idle_ratio, backlog=None):
+        """Return SCALE_UP, SCALE_DOWN or 0 for the stats of the last poll
+        interval.
+
+        :param int processes: The number of running processes
+        :param float idle_ratio: The share of time the processes were idle or
+            None if it is not known
+        :param int backlog: The number of messages in the queue, if known
+        :rtype: int
+
+        """
+        now = time.time()
+        busy = (idle_ratio is not None and
+                idle_ratio <= self.scale_down_idle_ratio)
+        if (busy and backlog is not None and
+                self.last_backlog is not None and
+                backlog > self.last_backlog):
+            self.growing_intervals += 1
+        else:
+            self.growing_intervals = 0
+        if backlog is not None:
+            self.last_backlog = backlog
+        growing = self.growing_intervals >= self.scale_up_intervals
+        saturated = (idle_ratio is not None and
+                     idle_ratio < self.scale_up_idle_ratio)
+
+        if saturated or growing:
+            self.idle_intervals = 0
+            if processes >= self.maximum:
+                LOGGER.debug('Saturated but already at %i processes',
+                             processes)
+                return 0
+            if now - self.last_change < self.scale_up_cooldown:
+                LOGGER.debug('Saturated but in the scale up cooldown')
+                return 0
+            self.growing_intervals = 0
+            self.last_change = now
+            return self.SCALE_UP
+
+        if (idle_ratio is None or idle_ratio <= self.scale_down_idle_ratio or
+                backlog):
+            self.idle_intervals = 0
+            return 0
+
+        self.idle_intervals += 1
+        if (processes <= self.minimum or
+                self.idle_intervals < self.scale_down_intervals or
+                now - self.last_change < self.scale_down_cooldown):
+            return 0
+        self.idle_intervals = 0
+        self.last_change = now
+        return self.SCALE_DOWN
@@ -0,0 +1,137 @@
+"""
+Broker node selection for connections that list more than one RabbitMQ node,
+keeping a health score for each node so that failed nodes are avoided.
+
+"""
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Broker(object):
+    """A RabbitMQ node that a connection can be made to, carrying its health
+    score.
+
+    """
+    _HALF_LIFE = 60.0
+
+    def __init__(self, host, port):
+        """Create a new broker node
+
+        :param str host: The node hostname
+        :param int port: The node port
+
+        """
+        self.host = host
+        self.port = port
+        self.failures = 0
+        self.last_failure = 0
+        self.last_success = 0
+
+    def __repr__(self):
+        return '<Broker %s:%i>' % (self.host, self.port)
+
+    @property
+    def score(self):
+        """Return the failure score of the node, decaying the failure count
+        by half every _HALF_LIFE seconds since the last failure. Lower is
+        healthier.
+
+        :rtype: float
+
+        """
+        if not self.failures:
+            return 0.0
+        elapsed = time.time() - self.last_failure
+        return self.failures * (0.5 ** (elapsed / self._HALF_LIFE))
+
+    def failed(self):
+        """Note that connecting to or talking to the node failed."""
+        self.failures += 1
+        self.last_failure = time.time()
+
+    def succeeded(self):
+        """Note that a connection to the node was established, resetting the
+        failure count.
+
+        """
+        self.failures = 0
+        self.last_success = time.time()
+
+
+class Brokers(object):
+    """The list of RabbitMQ nodes for a Connections entry. The host value may
+    be a single hostname or a list of hostnames, optionally as host:port.
+
+    Nodes are picked either round-robin, skipping nodes that are unhealthy, or
+    by picking the healthiest node that failed least recently.
+
+    """
+    LEAST_RECENTLY_FAILED = 'least_recently_failed'
+    ROUND_ROBIN = 'round_robin'
+
+    _DEFAULT_PORT = 5672
+    _UNHEALTHY_SCORE = 0.5
+
+    def __init__(self, config):
+        """Create the broker list from a Connections entry
+
+        :param dict config: The Connections entry from the configuration
+        :raises: ValueError
+
+        """
+        self.strategy = config.get('failover', self.LEAST_RECENTLY_FAILED)
+        if self.strategy not in [self.LEAST_RECENTLY_FAILED, self.ROUND_ROBIN]:
+            raise ValueError('Invalid failover strategy: %s' % self.strategy)
+        hosts = config['host']
+        if isinstance(hosts, basestring):
+            hosts = [hosts]
+        port = config.get('port', self._DEFAULT_PORT)
+        self.nodes = [self._broker(host, port) for host in hosts]
+        self._offset = -1
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _broker(self, host, port):
+        """Return a Broker for a host or host:port value
+
+        :param str host: The host value
+        :param int port: The port to use if the host value has none
+        :rtype: Broker
+
+        """
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+        return Broker(host, int(port))
+
+    def next(self):
+        """Return the next broker node to connect to.
+
+        :rtype: Broker
+
+        """
+        if self.strategy == self.ROUND_ROBIN:
+            return self._next_round_robin()
+        return min(self.nodes, key=lambda node: (round(node.score, 2),
+                                                 node.last_failure))
+
+    def _next_round_robin(self):
+        """Return the next healthy node in the rotation, or the next node if
+        none of them are healthy.
+
+        :rtype: Broker
+
+        """
+        for offset in xrange(1, len(self.nodes) + 1):
+            node = self.nodes[(self._offset + offset) % len(self.nodes)]
+            if node.score < self._UNHEALTHY_SCORE:
+                self._offset = self.nodes.index(node)
+                return node
+        self._offset = (self._offset + 1) % len(self.nodes)
+        LOGGER.warning('No healthy nodes, using %r', self.nodes[self._offset])
+        return self.nodes[self._offset]
@@ -3,23 +3,19 @@ of writing message Consumers that enforce good behaviors in dealing with
 messages.
 
 """
-import bz2
+import collections
 import copy
-import csv
+import cStringIO as stringio
 import datetime
-try:
-    import simplejson as json
-except ImportError:
-    import json
+import itertools
 import logging
-import pickle
 import pika
-import plistlib
-import StringIO as stringio
+import threading
 import time
 import uuid
-import yaml
-import zlib
+
+from rejected import data
+from rejected import serialization
 
 logger = logging.getLogger(__name__)
 
@@ -66,14 +62,42 @@ class Consumer(object):
 
     """
     _CONFIG_KEYS = ['service', 'config_host', 'config_domain', 'config_ttl']
+
+    # The processing phases timed for each message
+    DECODE_DURATION = 'decode_duration'
+    DESERIALIZE_DURATION = 'deserialize_duration'
+    PUBLISH_DURATION = 'publish_duration'
+
     _DROP_INVALID_MESSAGES = False
     _DROP_EXPIRED_MESSAGES = False
     _MESSAGE_TYPE = None
-    _PICKLE_MIME_TYPES = ['application/pickle',
-                          'application/x-pickle',
-                          'application/x-vnd.python.pickle',
-                          'application/vnd.python.pickle']
-    _YAML_MIME_TYPES = ['text/yaml', 'text/x-yaml']
+    _PICKLE_MIME_TYPES = serialization.PICKLE_MIME_TYPES
+    _YAML_MIME_TYPES = serialization.YAML_MIME_TYPES
+
+    # Codec backends by content-type or content-encoding, see
+    # rejected.serialization, overridden by the codecs configuration key
+    _CODECS = dict()
+    _codecs = None
+
+    # The maximum size of a decompressed body in bytes, overridden by the
+    # max_body_size configuration key. Bodies are not limited when neither is
+    # set, leaving the consumer open to decompression bombs.
+    _MAX_BODY_SIZE = None
+
+    # The csv dialect name or formatting parameters of CSV bodies, overridden
+    # by the csv_dialect configuration key. If neither is set, the dialect is
+    # sniffed once for each message type or routing key.
+    _CSV_DIALECT = None
+
+    # The number of sniffed csv dialects to keep, dropping the least recently
+    # used when there are more message types or routing keys than this
+    _CSV_DIALECT_CACHE_SIZE = 128
+
+    # Schema locations by content-type for the codecs that need a schema, a
+    # directory of .avsc files for Avro and the module of the generated
+    # message classes for Protocol Buffers, overridden by the schemas
+    # configuration key
+    _SCHEMAS = dict()
 
     def __init__(self, configuration):
         """Creates a new instance of a Consumer class. To perform
@@ -91,7 +115,14 @@ class Consumer(object):
         # Each message received will be carried as an attribute
         self._message = None
         self._message_body = None
+        self._properties = None
 
+        # Select the codecs up front so the copies AsyncConsumer makes for
+        # each message share them, along with the sniffed csv dialects and
+        # the lock for the thread pool copies that use them
+        self._codecs = self._select_codecs()
+        self._csv_dialects = collections.OrderedDict()
+        self._csv_dialects_lock = threading.Lock()
 
     @property
     def message_app_id(self):
@@ -108,52 +139,116 @@ class Consumer(object):
         deserialized if possible.
 
         :rtype: any
+        :raises: MessageException
 
         """
         # Return a materialized view of the body if it has been previously set
         if self._message_body:
             return self._message_body
+        start = time.time()
 
         # Sanitize a improperly set content-encoding from mybPublish
         if self.message_content_encoding == 'utf-8':
             self._message.properties.content_encoding = None
-            self._message_body = self._message.body
             logger.debug('Coerced an incorrect content-encoding of UTF-8 to '
                          'None')
 
-        # Handle bzip2 compressed content
-        elif self.message_content_encoding == 'bzip2':
-            self._message_body = self._decode_bz2(self._message.body)
+        # Decode the body with the decoder method or the codec for the
+        # content-encoding
+        decoder = self._get_decoder(self.message_content_encoding)
+        if decoder:
+            self._message_body = decoder(self._message.body)
+        else:
+            self._message_body = self._decode(self.message_content_encoding,
+                                              self._message.body)
+        self._add_timing(self.DECODE_DURATION, start)
+        start = time.time()
+
+        # Deserialize the body with the loader method for the built-in
+        # content-types or the codec for the content-type
+        codec = self._get_codec(self.message_content_type)
+        loader = self._get_loader(self.message_content_type)
+        if codec and loader:
+            self._message_body = loader(self._message_body)
+        elif codec and codec.schema:
+            schema = self._get_schema(codec, self.message_content_type,
+                                      self._message.properties)
+            try:
+                self._message_body = codec.load(self._message_body, schema)
+            except Exception as error:
+                raise MessageException('Could not load the %s body: %s' %
+                                       (codec.name, error))
+        elif codec:
+            self._message_body = codec.load(self._message_body)
+        self._add_timing(self.DESERIALIZE_DURATION, start)
 
-        # Handle zlib compressed content
-        elif self.message_content_encoding == 'gzip':
-            self._message_body = self._decode_gzip(self._message.body)
+        # Return the message body
+        return self._message_body
 
-        # Else we want to assign self._message.body to self._message_body
-        else:
-            self._message_body = self._message.body
+    def message_body_chunks(self):
+        """Return an iterator of the decoded but not deserialized message
+        body in chunks, decompressing it incrementally if the content-encoding
+        supports it.
+
+        :rtype: iterator
+        :raises: MessageException
+
+        """
+        codec = self._get_codec(self.message_content_encoding)
+        if codec and codec.stream:
+            return self._stream(codec, self._message.body)
+        return iter([self._decode(self.message_content_encoding,
+                                  self._message.body)])
 
-        # Handle the auto-deserialization
-        if self.message_content_type == 'application/json':
-            self._message_body = self._load_json_value(self._message_body)
+    def message_body_lines(self):
+        """Return an iterator of the lines of the decoded but not deserialized
+        message body, such as for line delimited JSON or to pass to a
+        csv.reader, without decoding the whole body at once.
 
-        elif self.message_content_type in self._PICKLE_MIME_TYPES:
-            self._message_body = self._load_pickle_value(self._message_body)
+        :rtype: iterator
+        :raises: MessageException
 
-        elif self.message_content_type == 'application/x-plist':
-            self._message_body = self._load_plist_value(self._message_body)
+        """
+        pending = ''
+        for chunk in self.message_body_chunks():
+            for line in stringio.StringIO(chunk):
+                if pending:
+                    line, pending = pending + line, ''
+                if not line.endswith('\n'):
+                    pending = line
+                    continue
+                yield line
+        if pending:
+            yield pending
+
+    def message_csv_columns(self, types=None):
+        """Return the columns of a CSV message body with a header row as a
+        dict of the field names and lists of the values, without creating a
+        dict for each row. Values are converted with the types by field name,
+        which are callables or one of the rejected.serialization.CSV_TYPES
+        names such as int.
+
+        :param dict types: Column types by field name
+        :rtype: dict
+        :raises: MessageException
 
-        elif self.message_content_type == 'text/csv':
-            self._message_body = self._load_csv_value(self._message_body)
+        """
+        lines, dialect = self._csv_lines()
+        return serialization.load_csv_columns(lines, dialect, types)
 
-        elif bs4 and self.message_content_type in ('text/html', 'text/xml'):
-            self._message_body = self._load_bs4_value(self._message_body)
+    def message_csv_rows(self, types=None):
+        """Return the field names from the header row of a CSV message body
+        and an iterator of the remaining rows as lists, with the values
+        converted with the types by field name. The body is decoded and
+        parsed as the rows are read.
 
-        elif self.message_content_type in self._YAML_MIME_TYPES:
-            self._message_body = self._load_yaml_value(self._message_body)
+        :param dict types: Column types by field name
+        :rtype: tuple(list, iterator)
+        :raises: MessageException
 
-        # Return the message body
-        return self._message_body
+        """
+        lines, dialect = self._csv_lines()
+        return serialization.load_csv_rows(lines, dialect, types)
 
     @property
     def message_content_encoding(self):
@@ -331,17 +426,22 @@ class Consumer(object):
             return
 
         # Let the child object process the message
-        self._process()
+        return self._process()
 
     @property
     def properties(self):
         """Return the properties for the message as a rejected.data.Properties
-        object.
+        object. The properties are a lazy view of the message properties, so
+        changes to them do not change the message properties. The view is
+        created once for each message.
 
         :rtype: rejected.data.Properties
 
         """
-        return copy.copy(self._message.properties)
+        if (self._properties is None or
+                self._properties._header is not self._message.properties):
+            self._properties = data.Properties(self._message.properties)
+        return self._properties
 
     def set_channel(self, channel):
         """Assign the _channel attribute to the channel that was passed in.
@@ -351,6 +451,17 @@ class Consumer(object):
         """
         self._channel = channel
 
+    def _add_timing(self, name, start):
+        """Add the time since start to the named processing phase of the
+        message being processed.
+
+        :param str name: The phase name
+        :param float start: When the phase started
+
+        """
+        if isinstance(self._message, data.Message):
+            self._message.add_timing(name, time.time() - start)
+
     def _auto_encode(self, content_encoding, value):
         """Based upon the value of the content_encoding, encode the value.
 
@@ -359,52 +470,83 @@ class Consumer(object):
         :rtype: value
 
         """
-        if content_encoding == 'gzip':
-            return self._encode_gzip(value)
-
-        if content_encoding == 'bzip2':
-            return self._encode_bz2(value)
+        codec = self._get_codec(content_encoding)
+        if codec:
+            return codec.dump(value)
 
         logger.warning('Invalid content-encoding specified for auto-encoding')
         return value
 
-    def _auto_serialize(self, content_type, value):
+    def _auto_serialize(self, content_type, value, properties=None):
         """Auto-serialization of the value based upon the content-type value.
+        The properties name the schema for content-types that need one.
 
         :param str content_type: The content type to serialize
         :param any value: The value to serialize
+        :param rejected.data.Properties properties: The message properties
         :rtype: str
+        :raises: ConsumerException
+        :raises: MessageException
+        :raises: ValueError
 
         """
-        if content_type == 'application/json':
-            logger.debug('Auto-serializing content as JSON')
-            return self._dump_json_value(value)
+        codec = self._get_codec(content_type)
+        if codec and codec.schema:
+            if not properties:
+                raise ValueError('The %s codec requires the message '
+                                 'properties to name the schema' % codec.name)
+            logger.debug('Auto-serializing content as %s with %s',
+                         content_type, codec.name)
+            return codec.dump(value, self._get_schema(codec, content_type,
+                                                      properties))
+        if codec:
+            logger.debug('Auto-serializing content as %s with %s',
+                         content_type, codec.name)
+            return codec.dump(value)
 
-        if content_type  in self._PICKLE_MIME_TYPES:
-            logger.debug('Auto-serializing content as Pickle')
-            return self._dump_pickle_value(value)
-
-        if content_type  == 'application/x-plist':
-            logger.debug('Auto-serializing content as plist')
-            return self._dump_plist_value(value)
+        logger.warning('Invalid content-type specified for auto-serialization')
+        return value
 
-        if content_type  == 'text/csv':
-            logger.debug('Auto-serializing content as csv')
-            return self._dump_csv_value(value)
+    def _csv_lines(self):
+        """Return an iterator of the lines of the decoded message body and
+        the csv dialect for them, sniffing the dialect from the first lines
+        if it is not configured or cached.
 
-        # If it's XML or HTML auto
-        if (bs4 and isinstance(value, bs4.BeautifulSoup) and
-            content_type in ('text/html', 'text/xml')):
-            logger.debug('Dumping BS4 object into HTML or XML')
-            return self._dump_bs4_value(value)
+        :rtype: tuple(iterator, csv.Dialect)
 
-        # If it's YAML, load the content via pyyaml into a dict
-        if self.message_content_type in self._YAML_MIME_TYPES:
-            logger.debug('Auto-serializing content as YAML')
-            return self._dump_yaml_value(value)
+        """
+        lines = self.message_body_lines()
+        head = list()
+
+        def sample():
+            size = 0
+            for line in lines:
+                head.append(line)
+                size += len(line)
+                if size >= serialization.CSV_SAMPLE_SIZE:
+                    break
+            return ''.join(head)
+
+        dialect = self._get_csv_dialect(sample)
+        return itertools.chain(head, lines), dialect
+
+    def _decode(self, content_encoding, value):
+        """Return the value decoded for the content-encoding, limiting the
+        decoded size to the max body size if the codec supports incremental
+        decoding.
+
+        :param str content_encoding: The content encoding
+        :param str value: The encoded value
+        :rtype: str
+        :raises: MessageException
 
-        logger.warning('Invalid content-type specified for auto-serialization')
-        return value
+        """
+        codec = self._get_codec(content_encoding)
+        if not codec:
+            return value
+        if not codec.stream:
+            return codec.load(value)
+        return ''.join(self._stream(codec, value))
 
     def _decode_bz2(self, value):
         """Return a bz2 decompressed value
@@ -413,7 +555,7 @@ class Consumer(object):
         :rtype: str
 
         """
-        return bz2.decompress(value)
+        return self._decode('bzip2', value)
 
     def _decode_gzip(self, value):
         """Return a zlib decompressed value
@@ -422,7 +564,7 @@ class Consumer(object):
         :rtype: str
 
         """
-        return zlib.decompress(value)
+        return self._decode('gzip', value)
 
     def _dump_bs4_value(self, value):
         """Return a BeautifulSoup object as a string
@@ -440,13 +582,7 @@ class Consumer(object):
         :rtype: str
 
         """
-        buffer = stringio.StringIO()
-        writer = csv.writer(buffer,quotechar='"', quoting=csv.QUOTE_ALL)
-        writer.writerows(value)
-        buffer.seek(0)
-        value =  buffer.read()
-        buffer.close()
-        return value
+        return self._get_codec('text/csv').dump(value)
 
     def _dump_json_value(self, value):
         """Serialize a value into JSON
@@ -455,7 +591,7 @@ class Consumer(object):
         :rtype: str
 
         """
-        return json.dumps(value)
+        return self._get_codec('application/json').dump(value)
 
     def _dump_pickle_value(self, value):
         """Serialize a value into the pickle format
@@ -464,7 +600,7 @@ class Consumer(object):
         :rtype: str
 
         """
-        return pickle.dumps(value)
+        return self._get_codec(self._PICKLE_MIME_TYPES[0]).dump(value)
 
     def _dump_plist_value(self, value):
         """Create a plist value from a dictionary
@@ -473,7 +609,7 @@ class Consumer(object):
         :rtype: dict
 
         """
-        return plistlib.writePlistToString(value)
+        return self._get_codec('application/x-plist').dump(value)
 
     def _dump_yaml_value(self, value):
         """Dump a dict into a YAML string
@@ -482,7 +618,7 @@ class Consumer(object):
         :rtype: str
 
         """
-        return yaml.dump(value)
+        return self._get_codec(self._YAML_MIME_TYPES[0]).dump(value)
 
     def _encode_bz2(self, value):
         """Return a bzip2 compressed value
@@ -491,7 +627,7 @@ class Consumer(object):
         :rtype: str
 
         """
-        return bz2.compress(value)
+        return self._get_codec('bzip2').dump(value)
 
     def _encode_gzip(self, value):
         """Return zlib compressed value
@@ -500,7 +636,7 @@ class Consumer(object):
         :rtype: str
 
         """
-        return zlib.decompress(value)
+        return self._get_codec('gzip').dump(value)
 
     def _get_pika_properties(self, properties_in):
         """Return a pika.BasicProperties object for a rejected.data.Properties
@@ -540,6 +676,119 @@ class Consumer(object):
             properties.user_id = properties_in.user_id
         return properties
 
+    def _get_codec(self, key):
+        """Return the codec for the content-type or content-encoding,
+        selecting the codecs for the consumer the first time it is called.
+
+        :param str key: The content-type or content-encoding
+        :rtype: rejected.serialization.Codec or None
+
+        """
+        if self._codecs is None:
+            self._codecs = self._select_codecs()
+        return self._codecs.get(key)
+
+    def _get_csv_dialect(self, sample):
+        """Return the csv dialect configured for the consumer, or the dialect
+        cached for the message type or routing key, sniffing it from the
+        sample the first time. Only the _CSV_DIALECT_CACHE_SIZE most recently
+        used dialects are kept.
+
+        :param str|callable sample: The start of the CSV value or a callable
+            that returns it
+        :rtype: csv.Dialect
+
+        """
+        config = getattr(self, '_config', None)
+        if isinstance(config, dict) and config.get('csv_dialect'):
+            return serialization.csv_dialect(config['csv_dialect'])
+        if self._CSV_DIALECT:
+            return serialization.csv_dialect(self._CSV_DIALECT)
+
+        key = None
+        if self._message:
+            key = self.message_type or self.message_routing_key
+        dialects = getattr(self, '_csv_dialects', None)
+        if dialects is None:
+            dialects = self._csv_dialects = collections.OrderedDict()
+            self._csv_dialects_lock = threading.Lock()
+        if key:
+            with self._csv_dialects_lock:
+                if key in dialects:
+                    dialects[key] = dialects.pop(key)
+                    return dialects[key]
+
+        # Sniff outside of the lock, at worst a key is sniffed twice
+        dialect = serialization.sniff_csv_dialect(sample() if
+                                                  callable(sample) else
+                                                  sample)
+        if not key:
+            return dialect
+        logger.debug('Caching the sniffed csv dialect for %s', key)
+        with self._csv_dialects_lock:
+            dialects[key] = dialect
+            while len(dialects) > self._CSV_DIALECT_CACHE_SIZE:
+                dialects.popitem(last=False)
+        return dialect
+
+    def _get_decoder(self, content_encoding):
+        """Return the method that decodes the built-in content-encoding, so
+        that consumers can extend it, or None to decode with the codec.
+
+        :param str content_encoding: The content encoding
+        :rtype: callable or None
+
+        """
+        if content_encoding == 'bzip2':
+            return self._decode_bz2
+        elif content_encoding == 'gzip':
+            return self._decode_gzip
+
+    def _get_family_codec(self, content_types):
+        """Return the codec for the content-type of the message if it is one
+        of the content types, otherwise the codec for the first of them.
+
+        :param list content_types: The content types of the same format
+        :rtype: rejected.serialization.Codec or None
+
+        """
+        if self._message and self.message_content_type in content_types:
+            return self._get_codec(self.message_content_type)
+        return self._get_codec(content_types[0])
+
+    def _get_loader(self, content_type):
+        """Return the method that deserializes the built-in content-type, so
+        that consumers can extend it, or None to load with the codec.
+
+        :param str content_type: The content type
+        :rtype: callable or None
+
+        """
+        if content_type == 'application/json':
+            return self._load_json_value
+        elif content_type in self._PICKLE_MIME_TYPES:
+            return self._load_pickle_value
+        elif content_type == 'application/x-plist':
+            return self._load_plist_value
+        elif content_type == 'text/csv':
+            return self._load_csv_value
+        elif content_type in ('text/html', 'text/xml'):
+            return self._load_bs4_value
+        elif content_type in self._YAML_MIME_TYPES:
+            return self._load_yaml_value
+
+    def _get_max_body_size(self):
+        """Return the maximum decompressed body size from the configuration
+        or the consumer, or None if it is not limited.
+
+        :rtype: int or None
+
+        """
+        config = getattr(self, '_config', None)
+        if isinstance(config, dict) and config.get('max_body_size'):
+            return config['max_body_size']
+        return self._MAX_BODY_SIZE
+
     def _get_pgsql_cursor(self, host, port, dbname, user, password=None):
         """Connect to PostgreSQL and return the cursor.
 
@@ -577,6 +826,38 @@ class Consumer(object):
             raise ImportError('redis not installed')
         return redis.Redis(host=host, port=port, db=db)
 
+    def _get_schema(self, codec, content_type, properties):
+        """Return the schema named by the schema header or the type property
+        from the schema location for the content-type, resolving it once for
+        each process. A schema name from the message that is invalid or not
+        in the location rejects the message, while a missing or invalid
+        schema location is an error in the consumer configuration.
+
+        :param rejected.serialization.Codec codec: The codec for the schema
+        :param str content_type: The content-type
+        :param rejected.data.Properties properties: The message properties
+        :rtype: any
+        :raises: ConsumerException
+        :raises: MessageException
+
+        """
+        name = (properties.headers or dict()).get(
+            serialization.SCHEMA_HEADER) or properties.type
+        if not name:
+            raise MessageException('No schema header or type property for '
+                                   'the %s body' % content_type)
+        config = getattr(self, '_config', None)
+        locations = self._SCHEMAS
+        if isinstance(config, dict) and config.get('schemas'):
+            locations = config['schemas']
+        try:
+            return serialization.SCHEMAS.get(codec, name,
+                                             locations.get(content_type))
+        except serialization.SchemaNameError as error:
+            raise MessageException(str(error))
+        except serialization.SchemaError as error:
+            raise ConsumerException(str(error))
+
     def _get_service(self, fqdn):
         """Return the service notation for the fqdn value (tld_domain_service).
 
@@ -601,17 +882,15 @@ class Consumer(object):
         return bs4.BeautifulSoup(value)
 
     def _load_csv_value(self, value):
-        """Create a csv.DictReader instance for the sniffed dialect for the
-        value passed in.
+        """Create a csv.DictReader instance for the configured or cached
+        dialect, sniffing the dialect for the message type or routing key
+        from the value the first time.
 
         :param str value: The CSV value
         :rtype: csv.DictReader
 
         """
-        csv_buffer = stringio.StringIO(value)
-        dialect = csv.Sniffer().sniff(csv_buffer.read(1024))
-        csv_buffer.seek(0)
-        return csv.DictReader(csv_buffer, dialect=dialect)
+        return serialization.load_csv(value, self._get_csv_dialect(value))
 
     def _load_json_value(self, value):
         """Deserialize a JSON string returning the native Python data type
@@ -621,7 +900,7 @@ class Consumer(object):
         :rtype: object
 
         """
-        return json.loads(value, use_decimal=True)
+        return self._get_codec('application/json').load(value)
 
     def _load_pickle_value(self, value):
         """Deserialize a pickle string returning the native Python data type
@@ -631,7 +910,7 @@ class Consumer(object):
         :rtype: object
 
         """
-        return pickle.loads(value)
+        return self._get_family_codec(self._PICKLE_MIME_TYPES).load(value)
 
     def _load_plist_value(self, value):
         """Deserialize a plist string returning the native Python data type
@@ -641,7 +920,7 @@ class Consumer(object):
         :rtype: dict
 
         """
-        return plistlib.readPlistFromString(value)
+        return self._get_codec('application/x-plist').load(value)
 
     def _load_yaml_value(self, value):
         """Load an YAML string into an dict object.
@@ -651,7 +930,7 @@ class Consumer(object):
         :raises: ConsumerException
 
         """
-        return yaml.load(value)
+        return self._get_family_codec(self._YAML_MIME_TYPES).load(value)
 
     def _process(self):
         """Extend this method for implementing your Consumer logic.
@@ -690,6 +969,8 @@ class Consumer(object):
         :param no_encoding: Turn off auto-encoding of the body
 
         """
+        start = time.time()
+
         # Convert the rejected.data.Properties object to a pika.BasicProperties
         logger.debug('Converting properties')
         properties_out = self._get_pika_properties(properties)
@@ -698,7 +979,8 @@ class Consumer(object):
         if (not no_serialization and not isinstance(body, basestring) and
             properties.content_type):
             logger.debug('Auto-serializing message body')
-            body = self._auto_serialize(properties.content_type, body)
+            body = self._auto_serialize(properties.content_type, body,
+                                        properties)
 
         # Auto-encode the message body if needed
         if not no_encoding and properties.content_encoding:
@@ -711,6 +993,7 @@ class Consumer(object):
                                     routing_key=routing_key,
                                     properties=properties_out,
                                     body=body)
+        self._add_timing(self.PUBLISH_DURATION, start)
 
     def _reply(self, response_body, properties, auto_id=True,
                exchange=None, reply_to=None):
@@ -766,6 +1049,60 @@ class Consumer(object):
                               properties,
                               response_body)
 
+    def _select_codecs(self):
+        """Return the codecs for the consumer, with the backends chosen in
+        Consumer._CODECS and the codecs configuration key.
+
+        :rtype: dict
+
+        """
+        overrides = dict(self._CODECS)
+        config = getattr(self, '_config', None)
+        if isinstance(config, dict):
+            overrides.update(config.get('codecs') or dict())
+        return serialization.REGISTRY.select(overrides)
+
+    def _stream(self, codec, value):
+        """Return an iterator of the value incrementally decoded by the codec,
+        raising a MessageException to reject the message if it decodes to
+        more than the max body size.
+
+        :param rejected.serialization.Codec codec: The codec to decode with
+        :param str value: The encoded value
+        :rtype: iterator
+        :raises: MessageException
+
+        """
+        try:
+            for chunk in codec.stream(value, self._get_max_body_size()):
+                yield chunk
+        except serialization.MaxSizeExceeded as error:
+            logger.warning('Rejecting the message body: %s', error)
+            raise MessageException(str(error))
+
+
+class AsyncConsumer(Consumer):
+    """Consumer class for writing message Consumers that process messages as
+    Tornado coroutines. Extend AsyncConsumer._process decorating it with
+    tornado.gen.coroutine and yield on I/O bound operations.
+
+    When the max_concurrency setting for the consumer is greater than 1, the
+    rejected process will interleave multiple messages on its IOLoop. Each
+    message is processed by a shallow copy of the consumer so that the per
+    message attributes such as self._message are not shared between messages
+    that are in flight.
+
+    """
+    def process(self, message_in):
+        """Process the message from RabbitMQ on a copy of the consumer,
+        returning the future from AsyncConsumer._process.
+
+        :param rejected.Consumer.Message message_in: The message to process
+        :rtype: tornado.concurrent.Future
+
+        """
+        return super(AsyncConsumer, copy.copy(self)).process(message_in)
+
 
 class ConsumerException(Exception):
     """May be called when processing a message to indicate a problem that the
@@ -0,0 +1,54 @@
+"""
+Fixed layout counter blocks in shared memory, allowing the MCP to read the
+counters of every consumer process without signalling or messaging them.
+
+"""
+import collections
+import logging
+import multiprocessing
+
+LOGGER = logging.getLogger(__name__)
+
+# The per consumer stats the MCP calculates that are current values rather
+# than counts, exported as gauges by the HTTP endpoint and the metrics
+CONSUMER_GAUGES = ['backlog', 'backlog_seconds', 'idle_ratio', 'processes',
+                   'spares', 'spawn_latency', 'throughput', 'velocity']
+
+
+class CounterBlock(collections.MutableMapping):
+    """A dict like view of a block of doubles in shared memory, one slot per
+    counter in a fixed layout. The block is created by the MCP before the
+    consumer process is forked, written to only by the consumer process and
+    read by the MCP.
+
+    Unknown counters can not be added to the block.
+
+    """
+    def __init__(self, keys):
+        """Allocate a zeroed block for the list of counter names.
+
+        :param list keys: The counter names, in the order of the layout
+
+        """
+        self._keys = list(keys)
+        self._offsets = dict([(key, offset)
+                              for offset, key in enumerate(self._keys)])
+        self._values = multiprocessing.Array('d', len(self._keys), lock=False)
+
+    def __delitem__(self, key):
+        raise TypeError('Counters can not be removed from a CounterBlock')
+
+    def __getitem__(self, key):
+        return self._values[self._offsets[key]]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '<CounterBlock %r>' % dict(self)
+
+    def __setitem__(self, key, value):
+        self._values[self._offsets[key]] = value
@@ -26,12 +26,42 @@ class DataObject(object):
         return "<%s(%s)>" % (self.__class__.__name__, items)
 
 
-class Message(DataObject):
+class SlottedDataObject(object):
+    """A compact DataObject for classes that declare all of their attributes
+    in __slots__, avoiding the per-instance __dict__.
+
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        """Return a string representation of the object and all of its
+        assigned attributes.
+
+        :rtype: str
+
+        """
+        items = list()
+        for key in getattr(self, '_FIELDS', self.__slots__):
+            if hasattr(self, key):
+                items.append('%s=%s' % (key, getattr(self, key)))
+        return "<%s(%s)>" % (self.__class__.__name__, items)
+
+
+class Message(SlottedDataObject):
     """Class for containing all the attributes about a message object creating a
     flatter, move convenient way to access the data while supporting the legacy
     methods that were previously in place in rejected < 2.0
 
+    The body is a reference to the body pika received, not a copy. Call
+    Message.release once the message has been processed to drop it.
+
+    The time spent in each phase of processing the message, such as decoding
+    the body, is added to Message.timings by name.
+
     """
+    __slots__ = ('channel', 'method', 'properties', 'body', 'consumer_tag',
+                 'delivery_tag', 'exchange', 'redelivered', 'routing_key',
+                 'timings')
 
     def __init__(self, channel, method, header, body):
         """Initialize a message setting the attributes from the given channel,
@@ -43,11 +73,10 @@ class Message(DataObject):
         :param str body: Pika message body
 
         """
-        DataObject.__init__(self)
         self.channel = channel
         self.method = method
         self.properties = Properties(header)
-        self.body = copy.copy(body)
+        self.body = body
 
         # Map method properties
         self.consumer_tag = method.consumer_tag
@@ -55,13 +84,165 @@ class Message(DataObject):
         self.exchange = method.exchange
         self.redelivered = method.redelivered
         self.routing_key = method.routing_key
+        self.timings = dict()
+
+    def add_timing(self, name, duration):
+        """Add the duration to the time spent in the named processing phase.
+
+        :param str name: The phase name
+        :param float duration: The duration in seconds
+
+        """
+        self.timings[name] = self.timings.get(name, 0) + duration
+
+    def release(self):
+        """Drop the reference to the message body once processing has
+        finished so it can be freed.
+
+        """
+        self.body = None
+
+
+class Headers(dict):
+    """The headers table of a message. It shares its values with the table
+    it was created from, copying a value that is a container the first time
+    it is read so changing it in place does not change the original table.
+
+    """
+    def __init__(self, headers=None):
+        """Create the headers from the given headers table.
+
+        :param dict headers: The headers table
+
+        """
+        super(Headers, self).__init__(headers or dict())
+        self._shared = set(key for key, value in dict.iteritems(self)
+                           if isinstance(value, (dict, list)))
+
+    def __copy__(self):
+        """Return a copy of the headers that shares its values with them.
+
+        :rtype: rejected.data.Headers
+
+        """
+        return Headers(self)
+
+    def __deepcopy__(self, memo):
+        """Return a deep copy of the headers as a plain dict.
+
+        :param dict memo: The deepcopy memo
+        :rtype: dict
+
+        """
+        return copy.deepcopy(dict(self), memo)
+
+    def __delitem__(self, key):
+        self._shared.discard(key)
+        super(Headers, self).__delitem__(key)
 
+    def __getitem__(self, key):
+        if key in self._shared:
+            self._unshare(key)
+        return super(Headers, self).__getitem__(key)
 
-class Properties(DataObject):
+    def __setitem__(self, key, value):
+        self._shared.discard(key)
+        super(Headers, self).__setitem__(key, value)
+
+    def _unshare(self, key):
+        """Replace a shared container value with a copy of it.
+
+        :param str key: The header name
+
+        """
+        self._shared.discard(key)
+        super(Headers, self).__setitem__(
+            key, copy.deepcopy(super(Headers, self).__getitem__(key)))
+
+    def _unshare_all(self):
+        """Replace all of the shared container values with copies."""
+        for key in list(self._shared):
+            self._unshare(key)
+
+    def copy(self):
+        return self.__copy__()
+
+    def get(self, key, default=None):
+        if key in self._shared:
+            self._unshare(key)
+        return super(Headers, self).get(key, default)
+
+    def items(self):
+        self._unshare_all()
+        return super(Headers, self).items()
+
+    def iteritems(self):
+        self._unshare_all()
+        return super(Headers, self).iteritems()
+
+    def itervalues(self):
+        self._unshare_all()
+        return super(Headers, self).itervalues()
+
+    def pop(self, key, *args):
+        self._shared.discard(key)
+        return super(Headers, self).pop(key, *args)
+
+    def popitem(self):
+        self._unshare_all()
+        return super(Headers, self).popitem()
+
+    def setdefault(self, key, default=None):
+        if key in self._shared:
+            self._unshare(key)
+        return super(Headers, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def values(self):
+        self._unshare_all()
+        return super(Headers, self).values()
+
+
+def _property(name):
+    """Return a property for the named AMQP Basic.Properties field that reads
+    through to the header Properties was created with until it is assigned.
+
+    :param str name: The field name
+    :rtype: property
+
+    """
+    def getter(self):
+        if self._values and name in self._values:
+            return self._values[name]
+        return getattr(self._header, name, None)
+
+    def setter(self, value):
+        if self._values is None:
+            self._values = dict()
+        self._values[name] = value
+
+    return property(getter, setter)
+
+
+class Properties(SlottedDataObject):
     """A class that represents all of the field attributes of AMQP's
     Basic.Properties
 
+    When created from a pika header, Properties is a lazy view of the header.
+    Fields are read from the header when accessed and only stored on the
+    Properties object when they are assigned. The headers table is only
+    copied the first time it is read.
+
     """
+    __slots__ = ('_header', '_values')
+
+    _FIELDS = ('app_id', 'cluster_id', 'content_type', 'content_encoding',
+               'correlation_id', 'delivery_mode', 'expiration', 'headers',
+               'message_id', 'priority', 'reply_to', 'timestamp', 'type',
+               'user_id')
 
     def __init__(self, header=None):
         """Create a base object to contain all of the properties we need
@@ -69,34 +250,44 @@ class Properties(DataObject):
         :param pika.spec.BasicProperties header: A header object from Pika
 
         """
-        DataObject.__init__(self)
-        if header:
-            self.app_id = header.app_id
-            self.cluster_id = header.cluster_id
-            self.content_type = header.content_type
-            self.content_encoding = header.content_encoding
-            self.correlation_id = header.correlation_id
-            self.delivery_mode = header.delivery_mode
-            self.expiration = header.expiration
-            self.headers = copy.deepcopy(header.headers) or dict()
-            self.priority = header.priority
-            self.reply_to = header.reply_to
-            self.message_id = header.message_id
-            self.timestamp = header.timestamp
-            self.type = header.type
-            self.user_id = header.user_id
-        else:
-            self.app_id = None
-            self.cluster_id = None
-            self.content_type = 'text/text'
-            self.content_encoding = None
-            self.correlation_id = None
-            self.delivery_mode = 1
-            self.expiration = None
-            self.headers = dict()
-            self.message_id = str(uuid.uuid4())
-            self.priority = None
-            self.reply_to = None
-            self.timestamp = int(time.time())
-            self.type = None
-            self.user_id = None
+        self._header = header
+        self._values = None
+        if not header:
+            self._values = {'content_type': 'text/text',
+                            'delivery_mode': 1,
+                            'headers': dict(),
+                            'message_id': str(uuid.uuid4()),
+                            'timestamp': int(time.time())}
+
+    def __copy__(self):
+        """Return a new lazy view of these properties. Changes to the copy do
+        not change the properties it was created from.
+
+        :rtype: Properties
+
+        """
+        return Properties(self)
+
+    @property
+    def headers(self):
+        """Return the headers table. It shares its values with the header
+        until they are changed, so changes to it do not change the header.
+
+        :rtype: rejected.data.Headers
+
+        """
+        if self._values and 'headers' in self._values:
+            return self._values['headers']
+        self.headers = Headers(getattr(self._header, 'headers', None))
+        return self._values['headers']
+
+    @headers.setter
+    def headers(self, value):
+        if self._values is None:
+            self._values = dict()
+        self._values['headers'] = value
+
+
+for _field in Properties._FIELDS:
+    if _field != 'headers':
+        setattr(Properties, _field, _property(_field))
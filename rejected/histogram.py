@@ -0,0 +1,130 @@
+"""
+Fixed bucket, mergeable latency histograms in the style of HdrHistogram.
+
+Durations are recorded in microseconds into log-linear buckets: values
+below 2 ** _PRECISION each get their own bucket and every power of two above
+that is split into 2 ** (_PRECISION - 1) linear buckets, keeping the relative
+error of a recorded value within about 3%. Because the bucket layout is the
+same for every histogram, histograms from different processes are merged by
+adding their bucket counts together.
+
+"""
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+_PRECISION = 6
+_LINEAR = 2 ** _PRECISION
+_SUB_BUCKETS = 2 ** (_PRECISION - 1)
+
+# Record durations up to about 71 minutes
+_MAX_VALUE = 2 ** 32 - 1
+
+
+def bucket_index(value):
+    """Return the bucket index for a value in microseconds.
+
+    :param int value: The value to get the bucket for
+    :rtype: int
+
+    """
+    if value < _LINEAR:
+        return value
+    shift = value.bit_length() - _PRECISION
+    return _LINEAR + (shift - 1) * _SUB_BUCKETS + \
+        (value >> shift) - _SUB_BUCKETS
+
+
+def bucket_value(index):
+    """Return the highest value in microseconds that is recorded in the
+    bucket.
+
+    :param int index: The bucket index
+    :rtype: int
+
+    """
+    if index < _LINEAR:
+        return index
+    shift, offset = divmod(index - _LINEAR, _SUB_BUCKETS)
+    shift += 1
+    return ((offset + _SUB_BUCKETS) << shift) + (1 << shift) - 1
+
+
+class Histogram(object):
+    """A latency histogram that keeps a sparse dict of bucket counts, so it is
+    cheap to send to the MCP and to merge.
+
+    """
+    def __init__(self, counts=None):
+        """Create a new histogram, optionally with existing bucket counts.
+
+        :param dict counts: Bucket counts by bucket index
+
+        """
+        self.counts = dict(counts or {})
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def __repr__(self):
+        return '<Histogram count=%i p50=%.6f p99=%.6f>' % \
+            (len(self), self.percentile(50), self.percentile(99))
+
+    def merge(self, other):
+        """Add the bucket counts of another histogram to this one.
+
+        :param other: The histogram or bucket counts to merge in
+        :type other: Histogram or dict
+
+        """
+        if isinstance(other, Histogram):
+            other = other.counts
+        for index, count in other.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+    def percentile(self, percentile):
+        """Return the duration in seconds that the percentage of the recorded
+        values are less than or equal to, or 0 if nothing was recorded.
+
+        :param float percentile: The percentile, from 0 to 100
+        :rtype: float
+
+        """
+        total = len(self)
+        if not total:
+            return 0.0
+        target = max(1, total * percentile / 100.0)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return bucket_value(index) / 1000000.0
+        return bucket_value(max(self.counts)) / 1000000.0
+
+    def record(self, duration):
+        """Record a duration in seconds.
+
+        :param float duration: The duration to record
+
+        """
+        value = min(max(int(duration * 1000000), 0), _MAX_VALUE)
+        index = bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+    def reset(self):
+        """Remove all of the recorded values."""
+        self.counts = dict()
+
+    def total(self):
+        """Return the sum of the recorded durations in seconds, counting each
+        value as the middle of its bucket so it has the same relative error
+        as the percentiles.
+
+        :rtype: float
+
+        """
+        total = 0
+        for index, count in self.counts.items():
+            low = bucket_value(index - 1) + 1 if index else 0
+            total += (low + bucket_value(index)) / 2.0 * count
+        return total / 1000000.0
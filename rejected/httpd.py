@@ -0,0 +1,213 @@
+"""
+Optional HTTP endpoint for the MCP that serves the stats calculated at each
+poll interval as JSON and in the Prometheus text format. Requests are
+answered from the last calculated stats, rendered once per poll interval, so
+scraping never touches the consumer processes.
+
+"""
+import json
+import logging
+import re
+from tornado import httpserver
+from tornado import web
+
+from rejected import counters
+from rejected import process
+
+LOGGER = logging.getLogger(__name__)
+
+PREFIX = 'rejected'
+
+
+class Application(web.Application):
+    """The web application, rendering and caching the stats for each of the
+    formats until the MCP calculates new stats.
+
+    """
+    def __init__(self, get_stats, profile=None):
+        """Create the application
+
+        :param callable get_stats: Returns the last calculated MCP stats
+        :param callable profile: Starts the profiler for a consumer or
+            process name and number of seconds
+
+        """
+        super(Application, self).__init__([(r'/', StatsHandler),
+                                           (r'/metrics', MetricsHandler),
+                                           (r'/profile/([^/]+)',
+                                            ProfileHandler),
+                                           (r'/stats', StatsHandler)])
+        self._cache = dict()
+        self._cached_poll = None
+        self._get_stats = get_stats
+        self.profile = profile
+
+    def render(self, renderer):
+        """Return the last calculated stats rendered by the renderer,
+        rendering them only once for each poll.
+
+        :param callable renderer: Renders the stats dict as a str
+        :rtype: str
+
+        """
+        stats = self._get_stats()
+        if stats.get('last_poll') != self._cached_poll:
+            self._cache = dict()
+            self._cached_poll = stats.get('last_poll')
+        if renderer not in self._cache:
+            self._cache[renderer] = renderer(stats)
+        return self._cache[renderer]
+
+
+class MetricsHandler(web.RequestHandler):
+    """Serve the stats in the Prometheus text exposition format."""
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.application.render(to_prometheus))
+
+
+class ProfileHandler(web.RequestHandler):
+    """Start the sampling profiler for a consumer or a process, with an
+    optional seconds argument.
+
+    """
+    def post(self, name):
+        if not self.application.profile:
+            raise web.HTTPError(404)
+        try:
+            seconds = float(self.get_argument('seconds', 0))
+        except ValueError:
+            raise web.HTTPError(400, 'Invalid seconds value')
+        processes = self.application.profile(name, seconds)
+        if not processes:
+            raise web.HTTPError(404)
+        self.write({'processes': processes})
+
+
+class StatsHandler(web.RequestHandler):
+    """Serve the stats as JSON."""
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(self.application.render(to_json))
+
+
+def listening_fds(server):
+    """Return the file descriptors of the sockets the HTTP server listens
+    on, so a forked consumer process can close its copies of them.
+
+    :param tornado.httpserver.HTTPServer server: The HTTP stats server
+    :rtype: list
+
+    """
+    return sorted(server._sockets)
+
+
+def metric_name(*parts):
+    """Return a Prometheus metric name for the name parts.
+
+    :param str parts: The name parts
+    :rtype: str
+
+    """
+    return re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join((PREFIX,) + parts))
+
+
+def metric_labels(labels):
+    """Return the Prometheus label string for the dict of labels.
+
+    :param dict labels: The label names and values
+    :rtype: str
+
+    """
+    values = ['%s="%s"' % (key, str(labels[key]).replace('\\', r'\\')
+                                                 .replace('"', r'\"')
+                                                 .replace('\n', r'\n'))
+              for key in sorted(labels)]
+    return '{%s}' % ','.join(values)
+
+
+def to_json(stats):
+    """Render the stats as JSON.
+
+    :param dict stats: The MCP stats
+    :rtype: str
+
+    """
+    return json.dumps(stats, sort_keys=True)
+
+
+def to_prometheus(stats):
+    """Render the stats in the Prometheus text exposition format, with the
+    consumer totals, latency percentiles and the per process counters.
+
+    :param dict stats: The MCP stats
+    :rtype: str
+
+    """
+    metrics = dict()
+
+    # Summary counts are part of the summary and do not get their own type
+    def add(name, kind, labels, value):
+        if value is None:
+            return
+        if name not in metrics:
+            metrics[name] = (kind, list())
+        metrics[name][1].append((labels, value))
+
+    for consumer, values in stats.get('consumers', dict()).items():
+        labels = {'consumer': consumer}
+        for key, value in values.items():
+            if key == 'latency':
+                continue
+            add(metric_name(key),
+                'gauge' if key in counters.CONSUMER_GAUGES else 'counter',
+                labels, value)
+        for key, latency in values.get('latency', dict()).items():
+            name = metric_name(key, 'seconds')
+            for quantile, percentile in [('0.5', 'p50'), ('0.99', 'p99'),
+                                         ('0.999', 'p999')]:
+                add(name, 'summary',
+                    dict(labels, quantile=quantile), latency[percentile])
+            add(name + '_count', None, labels, latency['count'])
+            add(name + '_sum', None, labels, latency.get('sum'))
+
+    for consumer, processes in stats.get('process_data', dict()).items():
+        for process_name, values in processes.items():
+            labels = {'consumer': consumer, 'process': process_name}
+            for key, value in values['counts'].items():
+                add(metric_name('process', key),
+                    'gauge' if key in process.Process.GAUGES else 'counter',
+                    labels, value)
+            if 'state' in values:
+                add(metric_name('process', 'state'), 'gauge',
+                    dict(labels, state=values['state']), 1)
+
+    lines = list()
+    for name in sorted(metrics):
+        kind, samples = metrics[name]
+        if kind:
+            lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in sorted([(metric_labels(labels), value)
+                                     for labels, value in samples]):
+            lines.append('%s%s %s' % (name, labels, repr(float(value))))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def start(port, address, get_stats, io_loop, profile=None):
+    """Start the HTTP stats server on the IOLoop, returning the server.
+
+    :param int port: The port to listen on
+    :param str address: The address to listen on
+    :param callable get_stats: Returns the last calculated MCP stats
+    :param tornado.ioloop.IOLoop io_loop: The MCP IOLoop
+    :param callable profile: Starts the profiler for a consumer or process
+    :rtype: tornado.httpserver.HTTPServer
+
+    """
+    server = httpserver.HTTPServer(Application(get_stats, profile),
+                                   io_loop=io_loop)
+    server.listen(port, address)
+    LOGGER.info('Serving stats over HTTP on %s:%i', address or '*', port)
+    return server
@@ -2,16 +2,23 @@
 Master Control Program
 
 """
+import functools
 import logging
 import multiprocessing
 import os
-import Queue
 import signal
+import socket
 import sys
-import threading
 import time
+from tornado import ioloop
 
+from rejected import autoscaler
+from rejected import counters
+from rejected import histogram
+from rejected import httpd
+from rejected import metrics
 from rejected import process
+from rejected import registry
 from rejected import state
 from rejected import __version__
 
@@ -23,8 +30,10 @@ class MasterControlProgram(state.State):
     _MIN_CONSUMERS = 1
     _MAX_CONSUMERS = 2
     _MAX_SHUTDOWN_WAIT = 10
+    _PERCENTILES = [('p50', 50), ('p99', 99), ('p999', 99.9)]
     _POLL_INTERVAL = 30.0
-    _POLL_RESULTS_INTERVAL = 3.0
+    _RESPAWN_DELAY = 1
+    _RESPAWN_WINDOW = 10
     _SHUTDOWN_WAIT = 1
 
     def __init__(self, config, consumer=None):
@@ -42,12 +51,24 @@ class MasterControlProgram(state.State):
         self._consumer = consumer
         self._consumers = dict()
         self._config = config
+        self._counter_blocks = dict()
+        self._counter_reads = dict()
+        self._http_server = None
+        self._interval_counts = dict()
+        self._interval_histograms = dict()
+        self._ioloop = None
         self._last_poll_results = dict()
-        self._poll_data = {'time': 0, 'processes': list()}
+        self._metrics = None
+        self._poll_data = {'timestamp': time.time(), 'processes': set()}
         self._poll_timer = None
-        self._results_timer = None
+        self._profile_requests = dict()
+        self._queue_probes = dict()
+        self._ready_flags = dict()
+        self._registry = registry.Registry()
+        self._retired_counts = dict()
         self._stats = dict()
-        self._stats_queue = multiprocessing.Queue()
+        self._stats_pipes = dict()
+        self._stats_writers = dict()
 
         # Carry for logging internal stats collection data
         self._log_stats_enabled = config.get('log_stats', False)
@@ -57,52 +78,157 @@ class MasterControlProgram(state.State):
         self._poll_interval = config.get('poll_interval', self._POLL_INTERVAL)
         LOGGER.debug('Set process poll interval to %.2f', self._poll_interval)
 
-    @property
-    def _active_processes(self):
-        """Return a list of all active processes, pruning dead ones
+        # Serve the stats over HTTP if a port is configured
+        self._stats_address = config.get('stats_address', '127.0.0.1')
+        self._stats_port = config.get('stats_port')
 
-        :rtype: list
+    def _activate_spare(self, process_name):
+        """Move the spare process in to the consuming processes and signal it
+        to start consuming.
+
+        :param str process_name: The spare process name
 
         """
-        dead_processes = list()
-        active_processes = multiprocessing.active_children()
-        for process in active_processes:
-            if not process.is_alive():
-                dead_processes.append(process)
-        if dead_processes:
-            LOGGER.debug('Found %i dead processes to remove',
-                         len(dead_processes))
-            for process in dead_processes:
-                self._remove_process(process.name)
-                active_processes.remove(process)
-        return active_processes
+        record = self._registry.activate(process_name)
+        LOGGER.info('Activating spare consumer process %s for %s on %s',
+                    process_name, record.consumer, record.connection)
+        os.kill(int(record.pid), signal.SIGUSR1)
+        self._assign_queue_probe(record.consumer, record.connection)
+
+    def _add_process(self, name, connection):
+        """Add a consuming process for the consumer connection, activating a
+        spare process if one is running or starting a new process if not.
+
+        :param str name: The consumer name
+        :param str connection: The connection name
+
+        """
+        for process_name in self._registry.spares(name, connection):
+            if (self._process(name, process_name).is_alive() and
+                    self._is_ready(process_name)):
+                return self._activate_spare(process_name)
+        self._start_process(name, connection)
+
+    def _assign_queue_probe(self, name, connection):
+        """Pick the oldest consuming process of the consumer connection to
+        probe the queue for all of its processes.
+
+        :param str name: The consumer name
+        :param str connection: The connection name
+
+        """
+        names = self._registry.names(name, connection)
+        pid = self._registry.get(names[0]).pid if names else None
+        probe = self._queue_probe(name, connection)
+        probe[process.Process.PROBE_PID] = pid or 0
+
+    def _autoscale(self):
+        """Add or retire consumer processes for each consumer that has an
+        autoscaler, based upon the stats of the last poll interval.
+
+        """
+        for name in self._consumers:
+            scaler = self._consumers[name].get('autoscaler')
+            if not scaler or name not in self._stats.get('consumers', dict()):
+                continue
+            stats = self._stats['consumers'][name]
+            change = scaler.decide(self._process_count_by_consumer(name),
+                                   stats['idle_ratio'], stats.get('backlog'))
+            if change == autoscaler.Autoscaler.SCALE_UP:
+                self._scale_up(name)
+            elif change == autoscaler.Autoscaler.SCALE_DOWN:
+                self._scale_down(name)
 
     def _calculate_stats(self, data):
-        """Calculate the stats data for our process level data.
+        """Calculate the stats data for our process level data, including the
+        throughput of each consumer over the last poll interval.
 
         :param data: The collected stats data to report on
         :type data: dict
 
         """
-        timestamp = data['timestamp']
-        del data['timestamp']
+        timestamp = time.time()
+        duration = timestamp - self._poll_data['timestamp']
         LOGGER.debug('Calculating stats for data timestamp: %i', timestamp)
 
         # Iterate through the last poll results
         stats = self._consumer_stats_counter()
+        stats['throughput'] = 0
         consumer_stats = dict()
+        merged = dict()
         for name in data.keys():
             consumer_stats[name] = self._consumer_stats_counter()
+
+            # Start from the totals of the processes that were removed
+            for key, value in self._retired_counts.get(name, dict()).items():
+                if key in consumer_stats[name]:
+                    stats[key] += value
+                    consumer_stats[name][key] += value
             consumer_stats[name]['processes'] = \
                 self._process_count_by_consumer(name)
-            for process in data[name].keys():
-                for key in stats:
-                    value = data[name][process]['counts'][key]
+            consumer_stats[name]['spares'] = sum(
+                [len(self._registry.spares(name, connection))
+                 for connection in self._consumers[name]['connections']])
+            for process_name in data[name].keys():
+                for key in consumer_stats[name]:
+                    if key in ['processes', 'spares']:
+                        continue
+                    value = data[name][process_name]['counts'].get(key, 0)
                     stats[key] += value
                     consumer_stats[name][key] += value
 
+            # Messages per second processed by all of the consumer processes
+            processed = self._interval_counts.get(name, dict()).get(
+                process.Process.PROCESSED, 0)
+            throughput = float(processed) / duration if duration > 0 else 0
+            consumer_stats[name]['throughput'] = throughput
+            stats['throughput'] += throughput
+            consumer_stats[name]['velocity'] = \
+                self._calculate_velocity(consumer_stats[name])
+
+            # The messages waiting in the queue and how long they will take
+            backlog = self._consumer_backlog(name, data[name])
+            consumer_stats[name]['backlog'] = backlog
+            consumer_stats[name]['backlog_seconds'] = None
+            if backlog is not None and throughput:
+                consumer_stats[name]['backlog_seconds'] = backlog / throughput
+
+            # The share of the interval the processes spent idle
+            busy = self._interval_counts.get(name, dict()).get(
+                process.Process.TIME_SPENT, 0)
+            idle = self._interval_counts.get(name, dict()).get(
+                process.Process.TIME_WAITED, 0)
+            consumer_stats[name]['idle_ratio'] = \
+                float(idle) / (busy + idle) if busy + idle else None
+
+            # The slowest time from spawning a process to its first message
+            spawn = [data[name][process_name]['counts'].get(
+                process.Process.SPAWN_LATENCY) for process_name in data[name]]
+            spawn = [value for value in spawn if value]
+            consumer_stats[name]['spawn_latency'] = \
+                max(spawn) if spawn else None
+
+            # Latency percentiles of the values recorded in the interval
+            consumer_stats[name]['latency'] = dict()
+            histograms = self._interval_histograms.get(name, dict())
+            for key, value in histograms.items():
+                consumer_stats[name]['latency'][key] = \
+                    self._histogram_stats(value)
+                if key not in merged:
+                    merged[key] = histogram.Histogram()
+                merged[key].merge(value)
+        self._interval_counts = dict()
+        self._interval_histograms = dict()
+        stats['velocity'] = self._calculate_velocity(stats)
+        stats['latency'] = dict([(key, self._histogram_stats(value))
+                                 for key, value in merged.items()])
+
+        # Spare processes are not consuming, so they are counted apart
+        stats['spares'] = len([record for record in self._registry
+                               if record.spare])
+        stats['processes'] = len(self._registry) - stats['spares']
+
         # Return a data structure that can be used in reporting out the stats
-        stats['processes'] = len(self._active_processes)
         return {'last_poll': timestamp,
                 'consumers': consumer_stats,
                 'process_data': data,
@@ -119,6 +245,7 @@ class MasterControlProgram(state.State):
         total_time = counts['idle_time'] + counts['processing_time']
         if total_time == 0 or counts['processed'] == 0:
             LOGGER.debug('Returning 0')
+            return 0
         return float(counts['processed']) / float(total_time)
 
     def _check_consumer_process_counts(self):
@@ -126,15 +253,46 @@ class MasterControlProgram(state.State):
         processes needed.
 
         """
+        if not self.is_running:
+            return
         LOGGER.debug('Checking minimum consumer process levels')
         for name in self._consumers:
             for connection in self._consumers[name]['connections']:
 
                 processes_needed = self._process_spawn_qty(name, connection)
-                if processes_needed:
+                if processes_needed > 0:
                     LOGGER.debug('Need to spawn %i processes for %s on %s',
                                  processes_needed, name, connection)
-                    self._start_processes(name, connection, processes_needed)
+                    for offset in xrange(0, processes_needed):
+                        self._add_process(name, connection)
+
+                spares_needed = self._spare_spawn_qty(name, connection)
+                if spares_needed > 0:
+                    LOGGER.debug('Need to spawn %i spare processes for %s on '
+                                 '%s', spares_needed, name, connection)
+                    self._start_processes(name, connection, spares_needed,
+                                          True)
+
+    def _consumer_backlog(self, name, data):
+        """Return the number of messages waiting in the queue for the consumer
+        from the queue depth its processes last probed, adding up the depth
+        from each connection, or None if no process has probed the queue.
+
+        :param str name: The consumer name
+        :param dict data: The stats of the consumer processes
+        :rtype: int or None
+
+        """
+        backlog = None
+        for connection in self._consumers[name]['connections']:
+            depths = [data[process_name]['counts'][process.Process.QUEUE_DEPTH]
+                      for process_name
+                      in self._registry.names(name, connection)
+                      if process_name in data and process.Process.QUEUE_DEPTH
+                      in data[process_name]['counts']]
+            if depths:
+                backlog = (backlog or 0) + max(depths)
+        return backlog
 
     def _consumer_dict(self, configuration):
         """Return a consumer dict for the given name and configuration.
@@ -143,16 +301,27 @@ class MasterControlProgram(state.State):
         :rtype: dict
 
         """
-        # Keep a dict that has a list of processes by connection
-        connections = dict()
-        for connection in configuration['connections']:
-            connections[connection] = list()
-        return {'connections': connections,
-                'min': configuration.get('min', self._MIN_CONSUMERS),
-                'max': configuration.get('max', self._MAX_CONSUMERS),
+        # The processes of each connection are kept in the registry
+        connections = list(configuration['connections'])
+        minimum = configuration.get('min', self._MIN_CONSUMERS)
+        maximum = configuration.get('max', self._MAX_CONSUMERS)
+
+        # The min and max process counts are per connection, autoscaling
+        # between them has to be enabled for the consumer
+        scaler = None
+        if configuration.get('autoscale', False) and maximum > minimum:
+            scaler = autoscaler.Autoscaler(minimum * len(connections),
+                                           maximum * len(connections),
+                                           configuration)
+        return {'autoscaler': scaler,
+                'connections': connections,
+                'min': minimum,
+                'max': maximum,
                 'last_proc_num': 0,
+                'last_respawn': 0,
+                'respawn_delay': 0,
                 'queue': configuration['queue'],
-                'processes': dict()}
+                'spares': configuration.get('spares', 0)}
 
     def _consumer_keyword(self, counts):
         """Return consumer or consumers depending on the process count.
@@ -177,48 +346,103 @@ class MasterControlProgram(state.State):
                 process.Process.TIME_WAITED: 0}
 
     def _collect_results(self, data_values):
-        """Receive the data from the consumers polled and process it.
+        """Receive a stats snapshot pushed by a consumer process, adding the
+        counter deltas to the totals for the process and the poll interval.
 
-        :param dict data_values: The poll data returned from the consumer
+        :param dict data_values: The stats snapshot from the consumer process
         :type data_values: dict
 
         """
-        self._last_poll_results['timestamp'] = self._poll_data['timestamp']
-
-        # Get the name and consumer name and remove it from what is reported
         consumer_name = data_values['consumer_name']
-        del data_values['consumer_name']
         process_name = data_values['name']
-        del data_values['name']
 
         # Add it to our last poll global data
         if consumer_name not in self._last_poll_results:
             self._last_poll_results[consumer_name] = dict()
-        self._last_poll_results[consumer_name][process_name] = data_values
+        if process_name not in self._last_poll_results[consumer_name]:
+            self._last_poll_results[consumer_name][process_name] = \
+                {'counts': dict()}
+        process_data = self._last_poll_results[consumer_name][process_name]
+        for key in ['pid', 'state', 'timestamp']:
+            if key in data_values:
+                process_data[key] = data_values[key]
+
+        # Sum the deltas into the process totals and the interval totals
+        if consumer_name not in self._interval_counts:
+            self._interval_counts[consumer_name] = dict()
+        interval_counts = self._interval_counts[consumer_name]
+        for key, value in data_values['counts'].items():
+            process_data['counts'][key] = \
+                process_data['counts'].get(key, 0) + value
+            interval_counts[key] = interval_counts.get(key, 0) + value
+        process_data['counts'].update(data_values['gauges'])
+
+        # Merge the histograms into the consumer histograms for the interval
+        if consumer_name not in self._interval_histograms:
+            self._interval_histograms[consumer_name] = dict()
+        histograms = self._interval_histograms[consumer_name]
+        for key, value in data_values.get('histograms', dict()).items():
+            if key not in histograms:
+                histograms[key] = histogram.Histogram()
+            histograms[key].merge(value)
+
+        # Keep the latest stats with the process and note that it reported
+        record = self._registry.get(process_name)
+        if record:
+            record.stats = process_data
+        self._poll_data['processes'].discard(process_name)
+
+    def _histogram_stats(self, value):
+        """Return the count, sum and the percentiles in _PERCENTILES for the
+        histogram.
+
+        :param rejected.histogram.Histogram value: The histogram
+        :rtype: dict
 
-        # Find the position to remove the consumer from the list
-        try:
-            position = self._poll_data['processes'].index(process_name)
-        except ValueError:
-            LOGGER.error('Poll data from unexpected process: %s', process_name)
-            position = None
+        """
+        stats = {'count': len(value), 'sum': value.total()}
+        for key, percentile in self._PERCENTILES:
+            stats[key] = value.percentile(percentile)
+        return stats
 
-        # Remove the consumer from the list we're waiting for data from
-        if position is not None:
-            self._poll_data['processes'].pop(position)
+    def _close_stats_pipe(self, process_name):
+        """Collect any stats left in the stats pipe of a process that is
+        being removed and close it.
 
-        # Calculate global stats
-        if self._poll_data['processes']:
-            LOGGER.debug('Still waiting on %i processes for stats',
-                         len(self._poll_data['processes']))
-            return
+        :param str process_name: The process name
 
-        # Calculate the stats
-        self._stats = self._calculate_stats(self._last_poll_results)
+        """
+        self._drain_stats_pipe(process_name)
+        reader = self._stats_pipes.pop(process_name, None)
+        if reader:
+            if self._ioloop:
+                self._ioloop.remove_handler(reader.fileno())
+            reader.close()
 
-        # If stats logging is enabled, log the stats
-        if self._log_stats_enabled:
-            self._log_stats()
+    def _drain_stats_pipe(self, process_name):
+        """Collect all of the stats snapshots waiting in the stats pipe of
+        the process, no longer watching the pipe once the process closed it.
+
+        :param str process_name: The process name
+
+        """
+        reader = self._stats_pipes.get(process_name)
+        if not reader:
+            return
+        try:
+            while reader.poll():
+                stats = reader.recv()
+                LOGGER.debug('Received stats from %s', stats['name'])
+                self._collect_results(stats)
+        except (EOFError, IOError) as error:
+            LOGGER.debug('Stats pipe of %s closed: %r', process_name, error)
+            if self._ioloop:
+                self._ioloop.remove_handler(reader.fileno())
+
+    def _drain_stats_pipes(self):
+        """Collect all of the stats snapshots waiting in the stats pipes."""
+        for process_name in list(self._stats_pipes):
+            self._drain_stats_pipe(process_name)
 
     def _kill_processes(self):
         """Gets called on shutdown by the timer when too much time has gone by,
@@ -240,24 +464,38 @@ class MasterControlProgram(state.State):
 
         return self._set_state(self.STATE_STOPPED)
 
+    def _is_ready(self, process_name):
+        """Return True if the process reported it has set up its signal
+        handlers, before which sending it a signal would kill it.
+
+        :param str process_name: The process name
+        :rtype: bool
+
+        """
+        ready = self._ready_flags.get(process_name)
+        return bool(ready and ready.value)
+
     def _log_stats(self):
         """Output the stats to the LOGGER."""
         LOGGER.info('%i total %s have processed %i  messages with %i '
                     'errors, waiting %.2f seconds and have spent %.2f seconds '
                     'processing messages with an overall velocity of %.2f '
-                    'messages per second.',
+                    'messages per second and a throughput of %.2f messages '
+                    'per second.',
                     self._stats['counts']['processes'],
                     self._consumer_keyword(self._stats['counts']),
                     self._stats['counts']['processed'],
                     self._stats['counts']['failed'],
                     self._stats['counts']['idle_time'],
                     self._stats['counts']['processing_time'],
-                    self._calculate_velocity(self._stats['counts']))
+                    self._calculate_velocity(self._stats['counts']),
+                    self._stats['counts']['throughput'])
         for key in self._stats['consumers'].keys():
             LOGGER.info('%i %s for %s have processed %i messages with %i '
                         'errors, waiting %.2f seconds and have spent %.2f '
                         'seconds processing messages with an overall velocity '
-                        'of %.2f messages per second.',
+                        'of %.2f messages per second and a throughput of %.2f '
+                        'messages per second.',
                         self._stats['consumers'][key]['processes'],
                         self._consumer_keyword(self._stats['consumers'][key]),
                         key,
@@ -265,18 +503,33 @@ class MasterControlProgram(state.State):
                         self._stats['consumers'][key]['failed'],
                         self._stats['consumers'][key]['idle_time'],
                         self._stats['consumers'][key]['processing_time'],
-                        self._calculate_velocity(self._stats['consumers'][key]))
+                        self._calculate_velocity(self._stats['consumers'][key]),
+                        self._stats['consumers'][key]['throughput'])
+            if self._stats['consumers'][key]['backlog'] is not None:
+                seconds = self._stats['consumers'][key]['backlog_seconds']
+                LOGGER.info('%s has %i messages waiting in %s, %s seconds of '
+                            'work at the current throughput', key,
+                            self._stats['consumers'][key]['backlog'],
+                            self._consumers[key]['queue'],
+                            'unknown' if seconds is None else
+                            '%.2f' % seconds)
+            for name in sorted(self._stats['consumers'][key]['latency']):
+                latency = self._stats['consumers'][key]['latency'][name]
+                LOGGER.info('%s %s for %i messages: p50 %.6f, p99 %.6f, '
+                            'p999 %.6f seconds', key, name, latency['count'],
+                            latency['p50'], latency['p99'], latency['p999'])
         if self._poll_data['processes']:
-            LOGGER.warning('%i process(es) did not respond with stats in '
-                           'time: %r',
+            LOGGER.warning('%i process(es) did not send stats in the last '
+                           'poll interval: %r',
                            len(self._poll_data['processes']),
-                           self._poll_data['processes'])
+                           sorted(self._poll_data['processes']))
 
-    def _new_process(self, consumer_name, connection_name):
+    def _new_process(self, consumer_name, connection_name, spare=False):
         """Create a new consumer instances
 
         :param str consumer_name: The name of the consumer
         :param str connection_name: The name of the connection
+        :param bool spare: Create a spare process that waits to be activated
         :return tuple: (str, process.Process)
 
         """
@@ -284,10 +537,27 @@ class MasterControlProgram(state.State):
                                   self._new_process_number(consumer_name))
         LOGGER.debug('Creating a new process for %s: %s',
                      connection_name, process_name)
+        self._counter_blocks[process_name] = \
+            counters.CounterBlock(process.Process.COUNTERS)
+        self._profile_requests[process_name] = \
+            multiprocessing.Value('d', 0, lock=False)
+        self._ready_flags[process_name] = \
+            multiprocessing.Value('b', 0, lock=False)
+        reader, writer = multiprocessing.Pipe(False)
+        self._stats_pipes[process_name] = reader
+        self._stats_writers[process_name] = writer
         kwargs = {'config': self._config,
                   'connection_name': connection_name,
                   'consumer_name': consumer_name,
-                  'stats_queue': self._stats_queue}
+                  'counters': self._counter_blocks[process_name],
+                  'listening_fds': (httpd.listening_fds(self._http_server)
+                                    if self._http_server else []),
+                  'profile_seconds': self._profile_requests[process_name],
+                  'queue_probe': self._queue_probe(consumer_name,
+                                                   connection_name),
+                  'ready': self._ready_flags[process_name],
+                  'spare': spare,
+                  'stats_pipe': writer}
         return process_name, process.Process(name=process_name, kwargs=kwargs)
 
     def _new_process_number(self, name):
@@ -301,42 +571,48 @@ class MasterControlProgram(state.State):
         self._consumers[name]['last_proc_num'] += 1
         return self._consumers[name]['last_proc_num']
 
+    def _on_sigchld(self, unused_signum, unused_frame):
+        """Called when a child process exits, reaping the consumer processes
+        on the IOLoop.
+
+        :param int unused_signum: The signal number
+        :param frame unused_frame: The python frame the signal was received at
+
+        """
+        self._ioloop.add_callback_from_signal(self._reap_processes)
+
+    def _on_stats_pipe_ready(self, process_name, unused_fd, unused_events):
+        """Invoked by the IOLoop when there are stats waiting in the stats
+        pipe of a process.
+
+        :param str process_name: The process name
+        :param int unused_fd: The stats pipe file descriptor
+        :param int unused_events: The IOLoop events
+
+        """
+        self._drain_stats_pipe(process_name)
+
     def _poll(self):
-        """Start the poll process by invoking the get_stats method of the
-        consumers. If we hit this after another interval without fully
-        processing, note it with a warning.
+        """Collect the stats the consumer processes sent on their stats
+        pipes since the last poll, check for dead processes and start new
+        ones as needed.
 
         """
-        # Check to see if we have outstanding things to poll
-        #if self._poll_data['processes']:
-        #    LOGGER.warn('Poll interval failure for consumer(s): %r',
-        #                 ', '.join(self._poll_data['processes']))
+        # Calculate the stats for the last interval
+        self._read_counters()
+        self._poll_results_check()
+        self._prune_poll_results()
 
-        # Keep track of running consumers
-        dead_processes = list()
+        # Remove any dead processes that have not been reaped yet
+        self._reap_processes()
 
         # Start our data collection dict
         self._poll_data = {'timestamp': time.time(),
-                           'processes': list()}
+                           'processes': set([record.name
+                                             for record in self._registry])}
 
-        # Iterate through all of the consumers
-        for process in self._active_processes:
-            LOGGER.debug('Checking runtime state of %s', process.name)
-            if process == multiprocessing.current_process():
-                LOGGER.debug('Matched current process in active_processes')
-                continue
-
-            if not process.is_alive():
-                LOGGER.critical('Found dead consumer %s', process.name)
-                dead_processes.append(process.name)
-            else:
-                LOGGER.debug('Asking %s for stats', process.name)
-                #self._poll_data['processes'].append(process.name)
-                os.kill(process.pid, signal.SIGPROF)
-
-        # Remove the objects if we have them
-        for process_name in dead_processes:
-            self._remove_process(process_name)
+        # Scale the consumer processes between their min and max
+        self._autoscale()
 
         # Check if we need to start more processes
         self._check_consumer_process_counts()
@@ -346,46 +622,60 @@ class MasterControlProgram(state.State):
             LOGGER.debug('Did not find any active consumers in poll')
             return self._set_state(self.STATE_STOPPED)
 
-        # Check to see if any consumers reported back and start timer if not
-        #self._poll_results_check()
+    def _poll_results_check(self):
+        """Drain the stats snapshots the consumer processes sent on their
+        stats pipes, then calculate and optionally log the stats.
 
-        # Start the timer again
-        self._start_poll_timer()
+        """
+        LOGGER.debug('Checking for poll results')
+        self._drain_stats_pipes()
 
-    @property
-    def _poll_duration_exceeded(self):
-        """Return true if the poll time has been exceeded.
-        :rtype: bool
+        # Calculate the stats
+        self._stats = self._calculate_stats(self._last_poll_results)
 
-        """
-        return  (time.time() -
-                 self._poll_data['timestamp']) >= self._poll_interval
+        # Send the stats to StatsD or Graphite
+        if self._metrics:
+            self._metrics.emit(self._stats)
 
-    def _poll_results_check(self):
-        """Check the polling results by checking to see if the stats queue is
-        empty. If it is not, try and collect stats. If it is set a timer to
-        call ourselves in _POLL_RESULTS_INTERVAL.
+        # If stats logging is enabled, log the stats
+        if self._log_stats_enabled:
+            self._log_stats()
+
+    def _preload_consumer(self, name, config):
+        """Import the consumer module in the MCP so the consumer processes
+        that are forked from it do not have to import it and its
+        dependencies. Errors are left for the consumer process to report.
+
+        Preloading is opt-in with the preload consumer setting, since a
+        module that creates threads, connections or IOLoops when it is
+        imported would share them with every forked process.
+
+        :param str name: The consumer name
+        :param dict config: The consumer configuration
 
         """
-        LOGGER.debug('Checking for poll results')
-        results = True
-        while results:
-            try:
-                stats = self._stats_queue.get(False)
-            except Queue.Empty:
-                LOGGER.debug('Stats queue is empty')
-                break
-            LOGGER.debug('Received stats from %s', stats['name'])
-            self._collect_results(stats)
+        if not config.get('preload', False):
+            LOGGER.debug('Not preloading the consumer module for %s', name)
+            return
+        start_time = time.time()
+        try:
+            process.import_namespaced_class(config['consumer'])
+        except Exception as error:
+            LOGGER.warning('Could not preload %s for %s: %s',
+                           config['consumer'], name, error)
+            return
+        LOGGER.info('Preloaded %s for %s in %.3f seconds', config['consumer'],
+                    name, time.time() - start_time)
 
-        # If there are pending consumers to get stats for, start the timer
-        if self._poll_data['processes']:
+    def _prune_poll_results(self):
+        """Retire the stats of processes that sent a snapshot after they
+        were removed, so they are not kept or reported.
 
-            if self._poll_duration_exceeded and self._log_stats_enabled:
-                self._log_stats()
-            LOGGER.debug('Starting poll results timer for %i consumer(s)',
-                         len(self._poll_data['processes']))
-            self._start_poll_results_timer()
+        """
+        for consumer_name in self._last_poll_results:
+            for process_name in list(self._last_poll_results[consumer_name]):
+                if not self._registry.get(process_name):
+                    self._retire_poll_results(consumer_name, process_name)
 
     def _process(self, consumer_name, process_name):
         """Return the process handle for the given consumer name and process
@@ -396,7 +686,7 @@ class MasterControlProgram(state.State):
         :rtype: rejected.process.Process
 
         """
-        return self._consumers[consumer_name]['processes'][process_name]
+        return self._registry.get(process_name).process
 
     def _process_count(self, name, connection):
         """Return the process count for the given consumer name and connection.
@@ -406,7 +696,7 @@ class MasterControlProgram(state.State):
         :rtype: int
 
         """
-        return len(self._consumers[name]['connections'][connection])
+        return self._registry.count(name, connection)
 
     def _process_count_by_consumer(self, name):
         """Return the process count by consumer only.
@@ -415,10 +705,7 @@ class MasterControlProgram(state.State):
         :rtype: int
 
         """
-        count = 0
-        for connection in self._consumers[name]['connections']:
-            count += len(self._consumers[name]['connections'][connection])
-        return count
+        return self._registry.count(name)
 
     def _process_spawn_qty(self, name, connection):
         """Return the number of processes to spawn for the given consumer name
@@ -432,36 +719,199 @@ class MasterControlProgram(state.State):
         return self._consumers[name]['min'] - self._process_count(name,
                                                                   connection)
 
-    def _remove_process(self, process):
-        """Remove the specified consumer process
+    def _queue_probe(self, name, connection):
+        """Return the queue probe shared by the processes of the consumer
+        connection, so the queue is only probed by one of them.
+
+        :param str name: The consumer name
+        :param str connection: The connection name
+        :rtype: multiprocessing.Array
+
+        """
+        key = (name, connection)
+        if key not in self._queue_probes:
+            self._queue_probes[key] = multiprocessing.Array('d', [0, -1, -1],
+                                                            lock=False)
+        return self._queue_probes[key]
+
+    def _read_counters(self):
+        """Read the shared memory counter block of each consumer process,
+        collecting the change since the last read as a stats snapshot.
+
+        """
+        timestamp = time.time()
+        for record in list(self._registry):
+            self._read_counter_block(record, timestamp)
+
+    def _read_counter_block(self, record, timestamp):
+        """Read the shared memory counter block of the consumer process,
+        collecting the change since the last read as a stats snapshot. The
+        max ack latency is skipped, since the process resets it each time
+        it sends its stats snapshot and sends it with the snapshot.
+
+        :param rejected.registry.ProcessRecord record: The process record
+        :param float timestamp: When the counters were read
+
+        """
+        if record.name not in self._counter_blocks:
+            return
+        values = dict(self._counter_blocks[record.name])
+        last = self._counter_reads.get(record.name, dict())
+        self._counter_reads[record.name] = values
+        counts, gauges = dict(), dict()
+        for key, value in values.items():
+            if key == process.Process.ACK_LATENCY_MAX:
+                continue
+            elif key in process.Process.GAUGES:
+                gauges[key] = value
+            elif value != last.get(key, 0):
+                counts[key] = value - last.get(key, 0)
+        self._collect_results({'name': record.name,
+                               'consumer_name': record.consumer,
+                               'pid': record.pid,
+                               'timestamp': timestamp,
+                               'counts': counts,
+                               'gauges': gauges})
+
+    def _reap_processes(self):
+        """Remove the consumer processes that exited and start replacements
+        for any consumer that dropped below its minimum process count.
+        Processes that were retired by the autoscaler do not count as
+        restarts.
+
+        """
+        exited = set()
+        for record in list(self._registry):
+            if record.process.is_alive():
+                continue
+            if record.retiring:
+                LOGGER.info('Consumer process %s (%s) retired', record.name,
+                            record.pid)
+                self._remove_process(record.name)
+                continue
+            LOGGER.warning('Consumer process %s (%s) exited with %r',
+                           record.name, record.pid, record.process.exitcode)
+            self._remove_process(record.name, True)
+            exited.add(record.consumer)
+        if self.is_running:
+            for name in exited:
+                self._schedule_respawn(name)
+
+    def _remove_process(self, process, exited=False):
+        """Remove the specified consumer process, reading its counters one
+        last time and folding its totals in to the consumer totals.
 
         :param str process: The process name to remove
+        :param bool exited: The process exited instead of being stopped
 
         """
-        for consumer_name in self._consumers:
-            if process in self._consumers[consumer_name]['processes']:
-                del self._consumers[consumer_name]['processes'][process]
-                self._remove_process_from_list(consumer_name, process)
-                LOGGER.debug('Removed %s from %s\'s process list',
-                             process, consumer_name)
-                return
-        LOGGER.warning('Could not find process %s to remove', process)
+        record = self._registry.get(process)
+        if record:
+            self._read_counter_block(record, time.time())
+            self._retire_poll_results(record.consumer, process)
+        self._close_stats_pipe(process)
+        self._counter_blocks.pop(process, None)
+        self._counter_reads.pop(process, None)
+        self._profile_requests.pop(process, None)
+        self._ready_flags.pop(process, None)
+        record = self._registry.remove(process, exited)
+        if record:
+            LOGGER.debug('Removed %s from %s\'s process list',
+                         process, record.consumer)
+            self._assign_queue_probe(record.consumer, record.connection)
+
+    def _retire_poll_results(self, consumer_name, process_name):
+        """Remove the stats of a process that is no longer running, adding
+        its counter totals to the retired totals of the consumer.
+
+        :param str consumer_name: The consumer name
+        :param str process_name: The process name
+
+        """
+        process_data = self._last_poll_results.get(consumer_name,
+                                                   dict()).pop(process_name,
+                                                               None)
+        if not process_data:
+            return
+        if consumer_name not in self._retired_counts:
+            self._retired_counts[consumer_name] = dict()
+        retired = self._retired_counts[consumer_name]
+        for key, value in process_data['counts'].items():
+            if key not in process.Process.GAUGES:
+                retired[key] = retired.get(key, 0) + value
 
-    def _remove_process_from_list(self, name, process):
-        """Remove the process from the consumer connections list.
+    def _schedule_respawn(self, name):
+        """Replace the exited processes of a consumer right away, backing off
+        when processes keep exiting within _RESPAWN_WINDOW of being replaced.
+
+        :param str name: The consumer name
+
+        """
+        consumer = self._consumers[name]
+        if not any([self._process_spawn_qty(name, connection) > 0
+                    for connection in consumer['connections']]):
+            return
+        now = time.time()
+        if now - consumer['last_respawn'] < self._RESPAWN_WINDOW:
+            consumer['respawn_delay'] = min(max(consumer['respawn_delay'] * 2,
+                                                self._RESPAWN_DELAY),
+                                            self._poll_interval)
+        else:
+            consumer['respawn_delay'] = 0
+        consumer['last_respawn'] = now + consumer['respawn_delay']
+        if not consumer['respawn_delay']:
+            return self._check_consumer_process_counts()
+        LOGGER.warning('Processes for %s keep exiting, respawning in %i '
+                       'seconds', name, consumer['respawn_delay'])
+        self._ioloop.call_later(consumer['respawn_delay'],
+                                self._check_consumer_process_counts)
+
+    def _scale_down(self, name):
+        """Retire the newest process on the connection with the most
+        processes for the consumer, if it is above the minimum.
 
         :param str name: The consumer name
-        :param str process: The process name
 
         """
-        for conn in self._consumers[name]['connections']:
-            if process in self._consumers[name]['connections'][conn]:
-                idx = self._consumers[name]['connections'][conn].index(process)
-                self._consumers[name]['connections'][conn].pop(idx)
-                LOGGER.debug('Process %s removed from %s connections',
-                             process, name)
-                return
-        LOGGER.warning('Could not find %s in %s\'s process list', process, name)
+        connections = self._consumers[name]['connections']
+        connection = max(connections,
+                         key=lambda value: self._process_count(name, value))
+        if (self._process_count(name, connection) <=
+                self._consumers[name]['min']):
+            return
+        process_name = self._registry.names(name, connection)[-1]
+        LOGGER.info('Retiring idle consumer process %s for %s on %s',
+                    process_name, name, connection)
+        self._registry.get(process_name).retiring = True
+        self._stop_process(self._process(name, process_name))
+
+    def _scale_up(self, name):
+        """Start a new process on the connection with the fewest processes
+        for the consumer, if it is below the maximum.
+
+        :param str name: The consumer name
+
+        """
+        connections = self._consumers[name]['connections']
+        connection = min(connections,
+                         key=lambda value: self._process_count(name, value))
+        if (self._process_count(name, connection) >=
+                self._consumers[name]['max']):
+            return
+        LOGGER.info('Adding a consumer process for %s on %s', name, connection)
+        self._add_process(name, connection)
+
+    def _set_state(self, new_state):
+        """Assign the specified state to the MCP, stopping the IOLoop when
+        the MCP has stopped.
+
+        :param int new_state: The new state of the object
+        :raises: ValueError
+
+        """
+        super(MasterControlProgram, self)._set_state(new_state)
+        if new_state == self.STATE_STOPPED and self._ioloop:
+            self._ioloop.add_callback_from_signal(self._ioloop.stop)
 
     def _set_process_name(self):
         """Set the process name for the top level process so that it shows up
@@ -475,72 +925,98 @@ class MasterControlProgram(state.State):
                 process.name = name.split('.')[0]
                 break
 
-    def _start_poll_results_timer(self):
-        """Start the poll results timer to see if there are results from the
-        last poll yet.
+    def _start_http_server(self):
+        """Start serving the stats over HTTP on the IOLoop if a stats port is
+        configured.
+
         """
-        self._results_timer = self._start_timer(self._results_timer,
-                                                'poll_results_timer',
-                                                self._POLL_RESULTS_INTERVAL,
-                                                self._poll_results_check)
+        if not self._stats_port:
+            return
+        try:
+            self._http_server = httpd.start(self._stats_port,
+                                            self._stats_address,
+                                            lambda: self.stats, self._ioloop,
+                                            self.profile)
+        except socket.error as error:
+            LOGGER.error('Could not serve stats on %s:%i: %s',
+                         self._stats_address or '*', self._stats_port, error)
+
+    def _start_metrics(self):
+        """Create the emitter for sending the stats to StatsD or Graphite at
+        each poll interval if metrics are configured.
+
+        """
+        try:
+            emitter = metrics.from_config(self._config.get('metrics'))
+        except ValueError as error:
+            LOGGER.error('Could not send metrics: %s', error)
+            return
+        if emitter:
+            self._metrics = metrics.StatsEmitter(emitter,
+                                                 process.Process.GAUGES)
 
     def _start_poll_timer(self):
-        """Start the poll timer to fire the polling at the next interval"""
-        self._poll_timer = self._start_timer(self._poll_timer, 'poll_timer',
-                                             self._poll_interval, self._poll)
+        """Start the poll timer to fire the polling at each interval"""
+        self._poll_timer = ioloop.PeriodicCallback(self._poll,
+                                                   self._poll_interval * 1000,
+                                                   io_loop=self._ioloop)
+        self._poll_timer.start()
+
+    def _spare_spawn_qty(self, name, connection):
+        """Return the number of spare processes to spawn for the given
+        consumer name and connection, never keeping more spares than the
+        connection has room for below its maximum process count.
+
+        :param str name: The consumer name
+        :param str connection: The connection name
+        :rtype: int
+
+        """
+        wanted = min(self._consumers[name]['spares'],
+                     self._consumers[name]['max'] -
+                     self._process_count(name, connection))
+        return wanted - len(self._registry.spares(name, connection))
 
-    def _start_process(self, name, connection):
+    def _start_process(self, name, connection, spare=False):
         """Start a new consumer process for the given consumer & connection name
 
         :param str name: The consumer name
         :param str connection: The connection name
+        :param bool spare: Start a spare process that waits to be activated
 
         """
-        LOGGER.info('Spawning new consumer process for %s to %s',
-                    name, connection)
+        LOGGER.info('Spawning new %sconsumer process for %s to %s',
+                    'spare ' if spare else '', name, connection)
 
         # Create the new consumer process
-        process_name, process = self._new_process(name, connection)
-
-        # Append the process to the consumer process list
-        self._consumers[name]['processes'][process_name] = process
-        self._consumers[name]['connections'][connection].append(process_name)
+        process_name, process = self._new_process(name, connection, spare)
 
-        # Start the process
+        # Add the process to the registry and index it by pid once started
+        self._registry.add(process_name, name, connection, process, spare)
         process.start()
-
-    def _start_processes(self, name, connection, quantity):
+        self._registry.started(process_name)
+
+        # Only the child writes to its stats pipe, collect them as they arrive
+        self._stats_writers.pop(process_name).close()
+        if self._ioloop:
+            self._ioloop.add_handler(
+                self._stats_pipes[process_name].fileno(),
+                functools.partial(self._on_stats_pipe_ready, process_name),
+                ioloop.IOLoop.READ)
+        self._assign_queue_probe(name, connection)
+
+    def _start_processes(self, name, connection, quantity, spare=False):
         """Start the specified quantity of consumer processes for the given
         consumer and connection.
 
         :param str name: The consumer name
         :param str connection: The connection name
         :param int quantity: The quantity of processes to start
+        :param bool spare: Start spare processes that wait to be activated
 
         """
         for process in xrange(0, quantity):
-            self._start_process(name, connection)
-
-    def _start_timer(self, timer, name, duration, callback):
-        """Start a timer for the given object, name, duration and callback.
-
-        :param threading.Timer timer: The previous timer instance
-        :param str name: The timer name
-        :param int or float duration: The timer duration
-        :param method callback: The method to call when timer fires
-        :rtype: threading.Timer
-
-        """
-        if timer and timer.is_alive():
-            timer.cancel()
-            LOGGER.debug('Cancelled live timer: %s', name)
-
-        timer = threading.Timer(duration, callback)
-        timer.name = name
-        timer.start()
-        LOGGER.debug('Started %s timer for %.2f seconds calling back %r',
-                     name, duration, callback)
-        return timer
+            self._start_process(name, connection, spare)
 
     def _setup_consumers(self):
         """Iterate through each consumer in the configuration and kick off the
@@ -561,10 +1037,16 @@ class MasterControlProgram(state.State):
             # Create the dictionary values for this process
             self._consumers[name] = self._consumer_dict(config)
 
+            # Import the consumer once instead of in each process
+            self._preload_consumer(name, config)
+
             # Iterate through the connections to create new consumer processes
             for connection in self._consumers[name]['connections']:
                 self._start_processes(name, connection,
                                       self._consumers[name]['min'])
+                self._start_processes(name, connection,
+                                      self._spare_spawn_qty(name, connection),
+                                      True)
 
     def _stop_process(self, process):
         """Stop the specified process
@@ -580,20 +1062,27 @@ class MasterControlProgram(state.State):
         os.kill(int(process.pid), signal.SIGABRT)
 
     def _stop_timers(self):
-        """Stop all the active timeouts."""
-        if self._poll_timer and self._poll_timer.is_alive():
+        """Stop all the active timeouts and the HTTP stats server."""
+        if self._poll_timer:
             LOGGER.debug('Stopping the poll timer')
-            self._poll_timer.cancel()
-
-        if self._results_timer and self._results_timer.is_alive():
-            LOGGER.debug('Stopping the poll results timer')
-            self._results_timer.cancel()
+            self._poll_timer.stop()
+            self._poll_timer = None
+        if self._http_server:
+            LOGGER.debug('Stopping the HTTP stats server')
+            self._http_server.stop()
+            self._http_server = None
 
     def stop_processes(self):
         """Iterate through all of the consumer processes shutting them down."""
         self._set_state(self.STATE_SHUTTING_DOWN)
         LOGGER.debug('Stopping consumer processes')
         self._stop_timers()
+        if self._metrics:
+            self._metrics.close()
+            self._metrics = None
+
+        # Don't let exiting processes cut the shutdown waits short
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
 
         active_processes = multiprocessing.active_children()
 
@@ -612,7 +1101,7 @@ class MasterControlProgram(state.State):
         iterations = 0
         while multiprocessing.active_children():
             LOGGER.debug('Waiting on %i active processes to shut down',
-                         self.total_process_count)
+                         len(multiprocessing.active_children()))
             time.sleep(1)
             iterations += 1
 
@@ -624,6 +1113,40 @@ class MasterControlProgram(state.State):
         LOGGER.debug('All consumer processes stopped')
         self._set_state(self.STATE_STOPPED)
 
+    def profile(self, name, seconds=None):
+        """Start the sampling profiler in the consuming processes of a
+        consumer or in a single process, returning the names of the processes
+        that were signalled. Processes that have not set up their signal
+        handlers yet are skipped.
+
+        :param str name: The consumer or process name
+        :param float seconds: How long to profile for, defaults to the
+            profile_duration configured for the processes
+        :rtype: list
+
+        """
+        profiled = list()
+        for record in list(self._registry):
+            if name not in [record.name, record.consumer] or record.spare:
+                continue
+            if not self._is_ready(record.name):
+                LOGGER.warning('Not profiling %s, it is still starting',
+                               record.name)
+                continue
+            if record.name in self._profile_requests:
+                self._profile_requests[record.name].value = seconds or 0
+            LOGGER.info('Profiling %s (%s) for %s', record.name, record.pid,
+                        '%s seconds' % seconds if seconds else
+                        'the profile duration')
+            try:
+                os.kill(int(record.pid), signal.SIGUSR2)
+            except OSError as error:
+                LOGGER.warning('Could not signal %s to profile: %s',
+                               record.name, error)
+                continue
+            profiled.append(record.name)
+        return sorted(profiled)
+
     def run(self):
         """When the consumer is ready to start running, kick off all of our
         consumer consumers and then loop while we process messages.
@@ -647,19 +1170,37 @@ class MasterControlProgram(state.State):
                                  consumer, self._consumer)
                     del self._config['Consumers'][consumer]
 
+        # The IOLoop is not made current so it is not used by the children
+        self._ioloop = ioloop.IOLoop(make_current=False)
+
+        # Replace processes that exit as soon as they do
+        signal.signal(signal.SIGCHLD, self._on_sigchld)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
         # Setup consumers and start the processes
         self._setup_consumers()
 
         # Kick off the poll timer
         self._start_poll_timer()
+        self._start_http_server()
+        self._start_metrics()
 
-        # Loop for the lifetime of the app, sleeping 0.2 seconds at a time
-        while self.is_running:
-            time.sleep(0.2)
+        # Run the IOLoop for the lifetime of the app
+        self._ioloop.start()
+        self._ioloop.close()
 
         # Note we're exiting run
         LOGGER.info('Exiting Master Control Program')
 
+    @property
+    def stats(self):
+        """Return the stats calculated at the last poll interval.
+
+        :rtype: dict
+
+        """
+        return self._stats
+
     @property
     def total_process_count(self):
         """Returns the active consumer process count
@@ -667,4 +1208,4 @@ class MasterControlProgram(state.State):
         :rtype: int
 
         """
-        return len(self._active_processes)
+        return len(self._registry)
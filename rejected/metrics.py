@@ -0,0 +1,242 @@
+"""
+Send the rejected counters to StatsD or Graphite as a time series. Metrics
+are buffered and sent in batched, non-blocking UDP packets so a slow or
+missing collector never holds up the MCP or a consumer process.
+
+The MCP sends the stats it aggregates at each poll interval per consumer and
+per process. Consumer processes can also send the timing of each message
+directly when the direct mode is enabled, for higher resolution timings than
+the poll interval percentiles.
+
+"""
+import errno
+import logging
+import re
+import socket
+import time
+
+from rejected import counters
+
+LOGGER = logging.getLogger(__name__)
+
+GRAPHITE = 'graphite'
+STATSD = 'statsd'
+PROTOCOLS = [GRAPHITE, STATSD]
+
+
+class Emitter(object):
+    """Buffer metrics and send them in UDP packets of up to max_packet
+    bytes, in the StatsD or the Graphite plaintext format. StatsD timings
+    are sent in milliseconds, all Graphite values are sent as is.
+
+    """
+    _MAX_PACKET = 1432
+    _PORTS = {GRAPHITE: 2003, STATSD: 8125}
+
+    def __init__(self, host='localhost', port=None, prefix='rejected',
+                 protocol=STATSD, max_packet=_MAX_PACKET):
+        """Create the emitter
+
+        :param str host: The collector host
+        :param int port: The collector UDP port
+        :param str prefix: The prefix for all metric names
+        :param str protocol: statsd or graphite
+        :param int max_packet: The maximum UDP packet size in bytes
+        :raises: ValueError
+
+        """
+        if protocol not in PROTOCOLS:
+            raise ValueError('Unsupported metrics protocol: %s' % protocol)
+        self._address = None
+        self._buffer = list()
+        self._buffer_size = 0
+        self._host = host
+        self._max_packet = max_packet
+        self._port = port or self._PORTS[protocol]
+        self._prefix = prefix
+        self._protocol = protocol
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(0)
+
+        # Resolve the host up front so sending does not block on DNS
+        self._resolve()
+
+    def close(self):
+        """Send any buffered metrics and close the socket."""
+        self.flush()
+        self._socket.close()
+
+    def counter(self, name, value):
+        """Add to a counter.
+
+        :param str name: The metric name
+        :param int|float value: The amount to add
+
+        """
+        self._add(name, value, 'c')
+
+    def flush(self):
+        """Send all of the buffered metrics."""
+        if not self._buffer:
+            return
+        packet = '\n'.join(self._buffer)
+        self._buffer = list()
+        self._buffer_size = 0
+        if not self._address and not self._resolve():
+            return
+        try:
+            self._socket.sendto(packet, self._address)
+        except socket.error as error:
+            # Metrics are dropped rather than blocking or failing, resolving
+            # the host again for the next flush in case its address changed
+            if error.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                LOGGER.debug('Could not send metrics to %s:%i: %s',
+                             self._host, self._port, error)
+                self._address = None
+
+    def gauge(self, name, value):
+        """Set a gauge to the current value.
+
+        :param str name: The metric name
+        :param int|float value: The value
+
+        """
+        self._add(name, value, 'g')
+
+    def timing(self, name, duration):
+        """Record a timing.
+
+        :param str name: The metric name
+        :param float duration: The duration in seconds
+
+        """
+        if self._protocol == STATSD:
+            self._add(name, duration * 1000, 'ms')
+        else:
+            self._add(name, duration, 'ms')
+
+    def _resolve(self):
+        """Resolve the collector host to the address metrics are sent to,
+        returning False if it can not be resolved.
+
+        :rtype: bool
+
+        """
+        try:
+            addresses = socket.getaddrinfo(self._host, self._port,
+                                           socket.AF_INET, socket.SOCK_DGRAM)
+        except socket.error as error:
+            LOGGER.warning('Could not resolve the metrics host %s: %s',
+                           self._host, error)
+            return False
+        self._address = addresses[0][4]
+        return True
+
+    def _add(self, name, value, kind):
+        """Add the metric to the buffer, sending the buffer first if the
+        metric would not fit in the packet.
+
+        :param str name: The metric name
+        :param int|float value: The value
+        :param str kind: The StatsD metric type
+
+        """
+        if self._protocol == STATSD:
+            line = '%s.%s:%s|%s' % (self._prefix, name, value, kind)
+        else:
+            line = '%s.%s %s %i' % (self._prefix, name, value, time.time())
+        if self._buffer and \
+                self._buffer_size + len(line) + 1 > self._max_packet:
+            self.flush()
+        self._buffer.append(line)
+        self._buffer_size += len(line) + 1
+
+
+class StatsEmitter(object):
+    """Send the stats the MCP calculates at each poll interval, per consumer
+    and per process. The process counters are totals, so the change since
+    the last poll is sent for each counter.
+
+    """
+    # The consumer stats that are current values
+    CONSUMER_GAUGES = counters.CONSUMER_GAUGES
+
+    def __init__(self, emitter, gauges):
+        """Create the stats emitter
+
+        :param Emitter emitter: The emitter to send the metrics with
+        :param list gauges: The process counters that are current values
+
+        """
+        self._emitter = emitter
+        self._gauges = gauges
+        self._last = dict()
+
+    def close(self):
+        """Send any buffered metrics and close the emitter."""
+        self._emitter.close()
+
+    def emit(self, stats):
+        """Send the metrics for the MCP stats.
+
+        :param dict stats: The stats calculated by the MCP
+
+        """
+        # Only the counters of the processes that are still running are kept
+        last = dict()
+        for consumer, processes in stats.get('process_data', dict()).items():
+            totals = dict()
+            for process_name, values in processes.items():
+                for key, value in values['counts'].items():
+                    name = metric_name(consumer, process_name, key)
+                    if key in self._gauges:
+                        self._emitter.gauge(name, value)
+                        continue
+                    delta = value - self._last.get(name, 0)
+                    last[name] = value
+                    totals[key] = totals.get(key, 0) + delta
+                    if delta:
+                        self._emitter.counter(name, delta)
+            for key, value in totals.items():
+                self._emitter.counter(metric_name(consumer, key), value)
+        self._last = last
+
+        for consumer, values in stats.get('consumers', dict()).items():
+            for key in self.CONSUMER_GAUGES:
+                if values.get(key) is not None:
+                    self._emitter.gauge(metric_name(consumer, key),
+                                        values[key])
+            for key, latency in values.get('latency', dict()).items():
+                for percentile in ['p50', 'p99', 'p999']:
+                    self._emitter.gauge(metric_name(consumer, key,
+                                                    percentile),
+                                        latency[percentile])
+        self._emitter.flush()
+
+
+def from_config(config):
+    """Return an Emitter for the metrics section of the configuration or
+    None if metrics are not configured.
+
+    :param dict config: The metrics section of the configuration
+    :rtype: Emitter or None
+    :raises: ValueError
+
+    """
+    if not config or not config.get('host'):
+        return None
+    return Emitter(config['host'], config.get('port'),
+                   config.get('prefix', 'rejected'),
+                   config.get('protocol', STATSD),
+                   config.get('max_packet', Emitter._MAX_PACKET))
+
+
+def metric_name(*parts):
+    """Return the dotted metric name for the parts, replacing characters
+    that have a meaning in the StatsD and Graphite formats.
+
+    :param str parts: The name parts
+    :rtype: str
+
+    """
+    return '.'.join([re.sub(r'[\s.:|@/]', '_', str(part)) for part in parts])
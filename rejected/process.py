@@ -3,25 +3,43 @@ connection state and collects stats about the consuming process.
 
 """
 from pika import exceptions
+import collections
+import copy
+import functools
 import logging
 import math
 import multiprocessing
 import os
 import pika
 from pika.adapters import tornado_connection
+import random
 import signal
 import sys
+import tempfile
 import time
+from tornado import concurrent
 from tornado import ioloop
 import traceback
 
 from rejected import __version__
+from rejected import brokers
 from rejected import consumer
+from rejected import counters
+from rejected import histogram
+from rejected import metrics
+from rejected import profiler
 from rejected import data
 from rejected import state
 
 LOGGER = logging.getLogger(__name__)
 
+# Optional imports
+try:
+    from concurrent import futures
+except ImportError:
+    LOGGER.warning('futures not found, disabling the threads executor')
+    futures = None
+
 
 def import_namespaced_class(namespaced_class):
     """Pass in a string in the format of foo.Bar, foo.bar.Baz, foo.bar.baz.Qux
@@ -61,16 +79,60 @@ class Process(multiprocessing.Process, state.State):
 
     # Counter constants
     ACKED = 'acked'
+    ACK_FRAMES_SAVED = 'ack_frames_saved'
+    ACK_LATENCY_MAX = 'ack_latency_max'
     ERROR = 'failed'
     FAILURES = 'failures_until_stop'
     PROCESSED = 'processed'
+    PROCESSING_LATENCY = 'processing_latency'
+    QOS_ADJUSTMENTS = 'qos_adjustments'
+    QOS_PREFETCH = 'qos_prefetch'
+    QUEUE_CONSUMERS = 'queue_consumers'
+    QUEUE_DEPTH = 'queue_depth'
     RECONNECTED = 'reconnected'
+    RECONNECT_ATTEMPTS = 'reconnect_attempts'
     REDELIVERED = 'redelivered_messages'
     REJECTED = 'rejected_messages'
     REQUEUED = 'requeued_messages'
+    SPAWN_LATENCY = 'spawn_latency'
+    TIME_DISCONNECTED = 'disconnected_time'
     TIME_SPENT = 'processing_time'
     TIME_WAITED = 'idle_time'
     UNHANDLED_EXCEPTIONS = 'unhandled_exceptions'
+    VELOCITY = 'message_velocity'
+
+    # Histogram constants
+    ACK_DURATION = 'ack_duration'
+    ACK_LATENCY = 'ack_latency'
+    CONSTRUCT_DURATION = 'construct_duration'
+    CONSUMER_DURATION = 'consumer_duration'
+    DECODE_DURATION = consumer.Consumer.DECODE_DURATION
+    DESERIALIZE_DURATION = consumer.Consumer.DESERIALIZE_DURATION
+    PROCESSING_DURATION = 'processing_duration'
+    PUBLISH_DURATION = consumer.Consumer.PUBLISH_DURATION
+    QUEUE_WAIT = 'queue_wait'
+    HISTOGRAMS = [ACK_DURATION, ACK_LATENCY, CONSTRUCT_DURATION,
+                  CONSUMER_DURATION, DECODE_DURATION, DESERIALIZE_DURATION,
+                  PROCESSING_DURATION, PUBLISH_DURATION, QUEUE_WAIT]
+
+    # The fixed layout of the counters in the shared memory counter block
+    COUNTERS = [ACKED, ACK_FRAMES_SAVED, ACK_LATENCY_MAX, ERROR, FAILURES,
+                PROCESSED, PROCESSING_LATENCY, QOS_ADJUSTMENTS, QOS_PREFETCH,
+                QUEUE_CONSUMERS, QUEUE_DEPTH, RECONNECTED, RECONNECT_ATTEMPTS,
+                REDELIVERED, REJECTED, REQUEUED, SPAWN_LATENCY,
+                TIME_DISCONNECTED, TIME_SPENT, TIME_WAITED,
+                UNHANDLED_EXCEPTIONS, VELOCITY]
+
+    # Counters that are current values and not totals, sent as is in stats
+    GAUGES = [ACK_LATENCY_MAX, FAILURES, PROCESSING_LATENCY, QOS_PREFETCH,
+              QUEUE_CONSUMERS, QUEUE_DEPTH, SPAWN_LATENCY, VELOCITY]
+
+    # The layout of the queue probe shared by the processes of a consumer
+    # connection, the pid of the process that probes the queue and the last
+    # queue depth and consumer count, which are -1 until it is probed
+    PROBE_PID = 0
+    PROBE_DEPTH = 1
+    PROBE_CONSUMERS = 2
 
     _HBINTERVAL = 30
 
@@ -78,14 +140,32 @@ class Process(multiprocessing.Process, state.State):
     INI_DIRS = ['.', '/etc/', '/etc/newrelic']
     INI_FILE = 'newrelic.ini'
 
+    # Default ack coalescing values, a batch size of 1 disables coalescing
+    _ACK_BATCH_SIZE = 1
+    _ACK_BATCH_TIMEOUT = 100
+
     # Default message pre-allocation value
     _QOS_PREFETCH_COUNT = 1
     _QOS_PREFETCH_MULTIPLIER = 1.25
     _QOS_MAX = 10000
+
+    # Dynamic QoS controller interval in seconds, the EWMA smoothing factor
+    # and the relative change needed before the prefetch count is updated
+    _QOS_INTERVAL = 10
+    _QOS_SMOOTHING = 0.3
+    _QOS_THRESHOLD = 0.1
+
+    _EXECUTOR_POOL_SIZE = 4
+    _MAX_CONCURRENCY = 1
     _MAX_ERROR_COUNT = 5
     _MAX_ERROR_WINDOW = 60
     _MAX_SHUTDOWN_WAIT = 5
-    _RECONNECT_DELAY = 10
+    _METRICS_FLUSH_INTERVAL = 1
+    _POLL_INTERVAL = 30.0
+    _PROFILE_DURATION = 30
+    _QUEUE_PROBE_INTERVAL = 10
+    _RECONNECT_DELAY = 1
+    _RECONNECT_MAX_DELAY = 30
 
     def __init__(self, group=None, target=None, name=None, args=(),
                  kwargs=None):
@@ -93,36 +173,123 @@ class Process(multiprocessing.Process, state.State):
             kwargs = {}
         super(Process, self).__init__(group, target, name, args, kwargs)
         self._ack = True
+        self._ack_batch_size = self._ACK_BATCH_SIZE
+        self._ack_batch_timeout = self._ACK_BATCH_TIMEOUT
+        self._ack_timeout = None
         self._application = None
+        self._broker = None
+        self._brokers = None
+        self._buffered = collections.deque()
+        self._buffered_starting = False
         self._channel = None
         self._config = None
         self._connection_name = None
         self._connections = None
+        self._connection = None
         self._consumer = None
-        self._counts = self.new_counter_dict()
+        self._counts = kwargs.get('counters')
+        if self._counts is None:
+            self._counts = self.new_counter_dict()
+        self._deliveries = dict()
+        self._disconnected_at = None
         self._dynamic_qos = True
+        self._executor = None
+        self._generation = 0
         self._hbinterval = self._HBINTERVAL
+        self._histograms = dict([(name, histogram.Histogram())
+                                 for name in self.HISTOGRAMS])
         self._last_counts = None
         self._last_failure = 0
         self._last_stats_time = None
+        self._latency_ewma = None
+        self._latency_samples = 0
+        self._latency_total = 0
+        self._max_concurrency = self._MAX_CONCURRENCY
         self._max_framesize = pika.spec.FRAME_MAX_SIZE
+        self._metrics = None
+        self._metrics_prefix = None
+        self._metrics_timer = None
+        self._pending_acks = list()
+        self._profile_duration = self._PROFILE_DURATION
+        self._profile_seconds = kwargs.get('profile_seconds')
+        self._profile_timeout = None
+        self._profiler = None
+        self._qos_interval = self._QOS_INTERVAL
         self._qos_prefetch = None
+        self._qos_timer = None
+        self._queue_consumers = None
+        self._queue_depth = None
+        self._queue_probe = kwargs.get('queue_probe')
+        self._queue_probe_timer = None
+        self._ready = kwargs.get('ready')
+        self._reconnect_attempts = 0
+        self._reconnect_delay = self._RECONNECT_DELAY
+        self._reconnect_max_delay = self._RECONNECT_MAX_DELAY
+        self._reconnect_timeout = None
+        self._spare = kwargs.get('spare', False)
+        self._spawned = time.time()
         self._state = self.STATE_INITIALIZING
+        self._state_counted = 0
         self._state_start = time.time()
-        self._stats_queue = None
+        self._stats_interval = self._POLL_INTERVAL
+        self._stats_pipe = None
+        self._stats_timer = None
+        self._submitted_counts = dict()
+        self._velocity_ewma = None
 
         # Override ACTIVE with PROCESSING
         self._STATES[0x04] = 'Processing'
 
-    def ack_message(self, delivery_tag):
-        """Acknowledge the message on the broker and log the ack
+    def ack_message(self, delivery_tag, received=None):
+        """Acknowledge the message on the broker and log the ack. If ack
+        coalescing is enabled, the delivery tag is buffered and acknowledged
+        with a single Basic.Ack when the batch is full or the batch timeout
+        fires.
 
         :param str delivery_tag: Delivery tag to acknowledge
+        :param float received: When the message was delivered, if known
+
+        """
+        if not self._channel or not self._channel.is_open:
+            LOGGER.warning('Can not ack %s without an open channel',
+                           delivery_tag)
+            return
+        if self._ack_batch_size <= 1:
+            LOGGER.debug('Acking %s', delivery_tag)
+            start = time.time()
+            self._channel.basic_ack(delivery_tag=delivery_tag)
+            now = time.time()
+            self.record_timing(self.ACK_DURATION, now - start)
+            self.increment_count(self.ACKED)
+            if received:
+                self.record_timing(self.ACK_LATENCY, now - received)
+            return
+
+        self._pending_acks.append((delivery_tag, time.time(), received))
+        if len(self._pending_acks) >= self._ack_batch_size:
+            self.flush_acks()
+        elif not self._ack_timeout:
+            self._ack_timeout = \
+                self._connection.add_timeout(self._ack_batch_timeout / 1000.0,
+                                             self.on_ack_timeout)
+
+    def activate(self):
+        """Start consuming if the process is a spare, invoked on the IOLoop
+        when the MCP sends SIGUSR1. If the channel is not open yet, the
+        process starts consuming once it is.
 
         """
-        LOGGER.debug('Acking %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag=delivery_tag)
-        self.increment_count(self.ACKED)
+        if not self._spare:
+            LOGGER.debug('Activation requested but process is not a spare')
+            return
+        LOGGER.info('Activating spare process')
+        self._spare = False
+
+        # Measure the first message latency from the activation
+        self._spawned = time.time()
+        self._state_counted = self._spawned
+        if self._channel and self._channel.is_open:
+            self.start_consuming()
 
     def add_on_channel_close_callback(self):
         """This method tells pika to call the on_channel_closed method if
@@ -150,79 +317,146 @@ class Process(multiprocessing.Process, state.State):
         return self._config.get('qos_prefetch', self._QOS_PREFETCH_COUNT)
 
     def calculate_qos_prefetch(self):
-        """Determine if the channel should use the dynamic QoS value, stay at
-        the same QoS or use the default QoS.
+        """Determine the prefetch count the channel should use, bounded by the
+        configured base QoS prefetch value and _QOS_MAX, changing it only if
+        the new value differs from the current one by more than
+        _QOS_THRESHOLD. The prefetch can be larger than the max concurrency,
+        the messages delivered beyond it are buffered by the process until
+        there is room for them, not requeued.
 
-        :rtype: bool or int
+        :rtype: bool
 
         """
-        qos_prefetch = self.dynamic_qos_pretch
-
-        # Don't change anything
-        if qos_prefetch == self._qos_prefetch:
+        qos_prefetch = min(max(self.dynamic_qos_pretch,
+                               self.base_qos_prefetch,
+                               self._max_concurrency), self._QOS_MAX)
+
+        # Don't grow past this process's share of the messages waiting in
+        # the queue, there is nothing more for a larger prefetch to fetch
+        if self._queue_depth is not None and qos_prefetch > self._qos_prefetch:
+            share = int(math.ceil(float(self._queue_depth) /
+                                  max(self._queue_consumers, 1)))
+            qos_prefetch = min(qos_prefetch, self._qos_prefetch + share)
+
+        # Don't change anything if the change is too small to matter
+        change = abs(qos_prefetch - self._qos_prefetch)
+        if change <= self._qos_prefetch * self._QOS_THRESHOLD:
             LOGGER.debug('No change in QoS prefetch calculation of %i',
                          self._qos_prefetch)
             return False
 
-        # Don't change anything
-        if self.count_processed_last_interval < qos_prefetch:
-            LOGGER.error('Processed fewer messages last interval than the '
-                         'qos_prefetch value')
-            return False
-
-        # If calculated QoS exceeds max
-        if qos_prefetch > self._QOS_MAX:
-            return self.set_qos_prefetch(self._QOS_MAX)
+        LOGGER.debug('QoS calculation changed from %i to %i',
+                     self._qos_prefetch, qos_prefetch)
+        self.set_qos_prefetch(qos_prefetch)
+        self.increment_count(self.QOS_ADJUSTMENTS)
+        return True
 
-        # Set to base value if QoS calc is < than the base
-        if self.base_qos_prefetch > qos_prefetch:
-            LOGGER.debug('QoS calculation is lower than base: %i < %i',
-                         qos_prefetch, self.base_qos_prefetch)
-            return self.set_qos_prefetch()
+    @property
+    def can_process(self):
+        """Returns a bool specifying if the process can accept another message
+        based upon its state and the number of messages in flight.
 
-        # Increase the QoS setting
-        if qos_prefetch > self._qos_prefetch:
-            LOGGER.debug('QoS calculation is higher than previous: %i > %i',
-                         qos_prefetch, self._qos_prefetch)
-            return self.set_qos_prefetch(qos_prefetch)
+        :rtype: bool
 
-        # Lower the QoS value based upon the processed qty
-        if qos_prefetch < self._qos_prefetch:
-            LOGGER.debug('QoS calculation is lower than previous: %i < %i',
-                         qos_prefetch, self._qos_prefetch)
-            return self.set_qos_prefetch(qos_prefetch)
+        """
+        if self.is_idle:
+            return True
+        return (self._state == self.STATE_PROCESSING and
+                len(self._deliveries) < self._max_concurrency)
 
     def cancel_consumer_with_rabbitmq(self):
         """Tell RabbitMQ the process no longer wants to consumer messages."""
+        if self._spare:
+            LOGGER.debug('Spare process is not consuming')
+            return
         LOGGER.info('Sending a Basic.Cancel to RabbitMQ')
         if self._channel and self._channel.is_open:
+            self.flush_acks()
             self._channel.basic_cancel(consumer_tag=self.name)
 
+    def clear_pending_acks(self):
+        """Discard any buffered delivery tags without acknowledging them,
+        used when the channel they were received on has gone away.
+
+        """
+        if self._pending_acks:
+            LOGGER.warning('Discarding %i unacknowledged delivery tags',
+                           len(self._pending_acks))
+        self._pending_acks = list()
+        self.remove_ack_timeout()
+
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
         LOGGER.info('Closing connection')
         self._connection.close()
 
+    def close_listening_fds(self):
+        """Close the file descriptors of the sockets the MCP listens on that
+        the process inherited when it was forked, so they are not held open
+        after the MCP stops listening on them.
+
+        """
+        for fd in self._kwargs.get('listening_fds', []):
+            try:
+                os.close(fd)
+            except OSError as error:
+                LOGGER.debug('Could not close inherited fd %i: %r', fd, error)
+
+    def connect(self):
+        """Connect to RabbitMQ, failing over to the other broker nodes for the
+        connection and scheduling a reconnect attempt if none of them could
+        be connected to.
+
+        """
+        for attempt in xrange(0, len(self.brokers)):
+            self._broker = self.brokers.next()
+            try:
+                self._connection = \
+                    self.connect_to_rabbitmq(self._connections,
+                                             self._connection_name)
+                return
+            except exceptions.AMQPConnectionError as error:
+                LOGGER.error('Could not connect to %r: %r',
+                             self._broker, error)
+                self._broker.failed()
+        self._connection = None
+        self.schedule_reconnect()
+
+    @property
+    def brokers(self):
+        """Return the broker nodes for the connection.
+
+        :rtype: rejected.brokers.Brokers
+
+        """
+        if not self._brokers:
+            config = self._connections[self._connection_name]
+            self._brokers = brokers.Brokers(config)
+        return self._brokers
+
     def connect_to_rabbitmq(self, config, name):
-        """Connect to RabbitMQ returning the connection handle.
+        """Connect to RabbitMQ returning the connection handle. If a broker
+        node has not been picked, the first one for the connection is used.
 
         :param dict config: The Connections section of the configuration
         :param str name: The name of the connection
         :rtype: pika.adapters.tornado_conneciton.TornadoConnection
 
         """
+        if not self._broker:
+            self._broker = brokers.Brokers(config[name]).next()
         LOGGER.debug('Connecting to %s:%i:%s as %s',
-                     config[name]['host'], config[name]['port'],
+                     self._broker.host, self._broker.port,
                      config[name]['vhost'], config[name]['user'])
         self.set_state(self.STATE_CONNECTING)
-        parameters = self.get_connection_parameters(config[name]['host'],
-                                                    config[name]['port'],
+        parameters = self.get_connection_parameters(self._broker.host,
+                                                    self._broker.port,
                                                     config[name]['vhost'],
                                                     config[name]['user'],
                                                     config[name]['pass'])
         return tornado_connection.TornadoConnection(parameters,
                                                     self.on_connection_open,
-                                                    True)
+                                                    False)
 
     def count(self, stat):
         """Return the current count quantity for a specific stat.
@@ -233,6 +467,22 @@ class Process(multiprocessing.Process, state.State):
         """
         return self._counts.get(stat, 0)
 
+    def count_state_time(self):
+        """Add the time spent idle or processing since the current state was
+        entered or since it was last counted to the idle or processing time
+        counters.
+
+        """
+        now = time.time()
+        elapsed = now - max(self._state_start, self._state_counted)
+        self._state_counted = now
+        if self._spare:
+            return
+        elif self.is_idle:
+            self.increment_count(self.TIME_WAITED, elapsed)
+        elif self.is_processing:
+            self.increment_count(self.TIME_SPENT, elapsed)
+
     @property
     def count_processed_last_interval(self):
         """Return the number of messages counted in the last interval. If
@@ -247,18 +497,129 @@ class Process(multiprocessing.Process, state.State):
 
     @property
     def dynamic_qos_pretch(self):
-        """Calculate the prefetch count based upon the message velocity * the
-        _QOS_PREFETCH_MULTIPLIER.
+        """Calculate the prefetch count based upon the smoothed message
+        velocity * the _QOS_PREFETCH_MULTIPLIER. The velocity is capped at the
+        rate the process could sustain given the smoothed processing latency,
+        so a consumer that slows down stops hoarding messages.
 
         :rtype: int
 
         """
+        if not self._velocity_ewma:
+            return 0
+        velocity = self._velocity_ewma
+        if self._latency_ewma:
+            velocity = min(velocity,
+                           float(self._max_concurrency) / self._latency_ewma)
+
         # Round up the velocity * the multiplier
-        value = int(math.ceil(self.message_velocity *
+        value = int(math.ceil(velocity *
                               float(self._QOS_PREFETCH_MULTIPLIER)))
         LOGGER.debug('Calculated prefetch value: %i', value)
         return value
 
+    def ewma(self, average, value):
+        """Return the exponentially weighted moving average updated with the
+        value, or the value if there is no average yet.
+
+        :param float average: The current average
+        :param float value: The new sample
+        :rtype: float
+
+        """
+        if average is None:
+            return value
+        return (self._QOS_SMOOTHING * value +
+                (1 - self._QOS_SMOOTHING) * average)
+
+    def flush_acks(self):
+        """Acknowledge all of the buffered delivery tags with a single
+        Basic.Ack using the multiple flag, updating the frames saved and ack
+        latency counters.
+
+        """
+        self.remove_ack_timeout()
+        if not self._pending_acks:
+            return
+        if not self._channel or not self._channel.is_open:
+            return self.clear_pending_acks()
+
+        # Only tags below the oldest message in flight can be acked with the
+        # multiple flag, anything after it needs to be acked on its own
+        in_flight = min(self._deliveries) if self._deliveries else None
+        coalesced, individual = list(), list()
+        for delivery_tag, buffered, received in self._pending_acks:
+            if in_flight is None or delivery_tag < in_flight:
+                coalesced.append(delivery_tag)
+            else:
+                individual.append(delivery_tag)
+
+        now = time.time()
+        oldest = min([value[1] for value in self._pending_acks])
+        for delivery_tag, buffered, received in self._pending_acks:
+            if received:
+                self.record_timing(self.ACK_LATENCY, now - received)
+        count = len(self._pending_acks)
+        self._pending_acks = list()
+        start = time.time()
+        if coalesced:
+            LOGGER.debug('Acking %i messages up to %s', len(coalesced),
+                         max(coalesced))
+            self._channel.basic_ack(delivery_tag=max(coalesced), multiple=True)
+        for delivery_tag in individual:
+            LOGGER.debug('Acking %s', delivery_tag)
+            self._channel.basic_ack(delivery_tag=delivery_tag)
+        self.record_timing(self.ACK_DURATION, time.time() - start)
+
+        frames = len(individual) + (1 if coalesced else 0)
+        self.increment_count(self.ACKED, count)
+        self.increment_count(self.ACK_FRAMES_SAVED, count - frames)
+        latency = now - oldest
+        if latency > self._counts[self.ACK_LATENCY_MAX]:
+            self._counts[self.ACK_LATENCY_MAX] = latency
+
+    def finish_message(self, message, processed, generation=None):
+        """Complete the processing of a message, acking it if it was processed
+        successfully and resetting the state if there are no other messages
+        in flight. Messages that were received on a channel that has since
+        been replaced by a reconnect are not acked, their delivery tag could
+        belong to a different message on the new channel.
+
+        :param Message message: The message that was processed
+        :param bool processed: Was the message processed successfully
+        :param int generation: The channel generation it was received on
+
+        """
+        if self.is_stale(message, generation):
+            LOGGER.warning('Not acking message %s, the channel it was '
+                           'received on was replaced', message.delivery_tag)
+            message.release()
+            return
+        received = self._deliveries.pop(message.delivery_tag, None)
+        if received:
+            duration = time.time() - received
+            self.record_timing(self.PROCESSING_DURATION, duration)
+            self._latency_samples += 1
+            self._latency_total += duration
+
+            # The consumer code gets the time not spent in the other phases
+            for name, value in message.timings.items():
+                self.record_timing(name, value)
+            consumer_duration = duration - sum(message.timings.values())
+            self.record_timing(self.CONSUMER_DURATION,
+                               max(0, consumer_duration))
+        if processed:
+            self.increment_count(self.PROCESSED)
+            if self._ack:
+                self.ack_message(message.delivery_tag, received)
+        else:
+            LOGGER.debug('Bypassing ack due to False return from _process')
+        message.release()
+        if self._buffered:
+            self.process_buffered()
+        if not self._deliveries and self.is_processing:
+            self.reset_state()
+
     def get_config(self, config, number, name, connection):
         """Initialize a new consumer thread, setting defaults and config values
 
@@ -290,6 +651,20 @@ class Process(multiprocessing.Process, state.State):
                                          frame_max=self._max_framesize,
                                          heartbeat_interval=self._hbinterval)
 
+    def get_executor(self, pool_size):
+        """Return a bounded thread pool executor for running blocking
+        consumers outside of the IOLoop thread.
+
+        :param int pool_size: The maximum number of worker threads
+        :rtype: concurrent.futures.ThreadPoolExecutor
+        :raises: ImportError
+
+        """
+        if not futures:
+            raise ImportError('futures not installed')
+        LOGGER.info('Processing messages in a pool of %i threads', pool_size)
+        return futures.ThreadPoolExecutor(max_workers=pool_size)
+
     def get_consumer(self, config):
         """Import and create a new instance of the configured message consumer.
 
@@ -369,6 +744,18 @@ class Process(multiprocessing.Process, state.State):
         """
         return self._state in [self.STATE_PROCESSING, self.STATE_STOP_REQUESTED]
 
+    def is_stale(self, message, generation=None):
+        """Returns True if the message is no longer in flight or was received
+        on a channel that has since been replaced by a reconnect.
+
+        :param Message message: The message to check
+        :param int generation: The channel generation it was received on
+        :rtype: bool
+
+        """
+        return (message.delivery_tag not in self._deliveries or
+                (generation is not None and generation != self._generation))
+
     @property
     def message_velocity(self):
         """Return the message consuming velocity for the process.
@@ -390,22 +777,21 @@ class Process(multiprocessing.Process, state.State):
         return velocity
 
     def new_counter_dict(self):
-        """Return a dict object for our internal stats keeping.
+        """Return a dict object for our internal stats keeping, used when the
+        MCP did not pass in a shared memory counter block.
 
         :rtype: dict
 
         """
-        return {self.ACKED: 0,
-                self.ERROR: 0,
-                self.FAILURES: 0,
-                self.UNHANDLED_EXCEPTIONS: 0,
-                self.PROCESSED: 0,
-                self.RECONNECTED: 0,
-                self.REDELIVERED: 0,
-                self.REJECTED: 0,
-                self.REQUEUED: 0,
-                self.TIME_SPENT: 0,
-                self.TIME_WAITED: 0}
+        return dict([(key, 0) for key in self.COUNTERS])
+
+    def on_ack_timeout(self):
+        """Invoked by the IOLoop when the ack batch timeout has fired, flushing
+        any buffered delivery tags.
+
+        """
+        self._ack_timeout = None
+        self.flush_acks()
 
     def on_channel_closed(self, method_frame):
         """Invoked by pika when RabbitMQ unexpectedly closes the channel.
@@ -420,8 +806,9 @@ class Process(multiprocessing.Process, state.State):
         LOGGER.critical('Channel was closed: (%s) %s',
                         method_frame.method.reply_code,
                         method_frame.method.reply_text)
-        del self._channel
-        raise ReconnectConnection
+        self._channel = None
+        if not self.is_shutting_down and not self.is_stopped:
+            self.reconnect()
 
     def on_channel_open(self, channel):
         """This method is invoked by pika when the channel has been opened. It
@@ -437,17 +824,43 @@ class Process(multiprocessing.Process, state.State):
         self.set_state(self.STATE_IDLE)
         self.setup_channel()
 
-    def on_connection_closed(self, unused):
+    def on_queue_probe(self, method_frame):
+        """Invoked by pika when the passive Queue.Declare of the queue probe
+        is answered, recording the queue depth and consumer count.
+
+        :param pika.frame.Method method_frame: The Queue.DeclareOk frame
+
+        """
+        self._queue_depth = method_frame.method.message_count
+        self._queue_consumers = method_frame.method.consumer_count
+        if self._queue_probe is not None:
+            self._queue_probe[self.PROBE_DEPTH] = self._queue_depth
+            self._queue_probe[self.PROBE_CONSUMERS] = self._queue_consumers
+        self._counts[self.QUEUE_DEPTH] = self._queue_depth
+        self._counts[self.QUEUE_CONSUMERS] = self._queue_consumers
+        LOGGER.debug('%s has %i messages waiting for %i consumers',
+                     self._queue_name, self._queue_depth,
+                     self._queue_consumers)
+
+    def on_connection_closed(self, connection):
         """This method is invoked by pika when the connection to RabbitMQ is
-        closed unexpectedly. Since it is unexpected, we will reconnect to
-        RabbitMQ if it disconnects.
+        closed. If the process is stopped, the IOLoop is stopped. If it is
+        unexpected, we will reconnect to RabbitMQ. Connections that have
+        already been replaced by a reconnect are ignored.
 
-        :param pika.connection.Connection unused: The closed connection
+        :param pika.connection.Connection connection: The closed connection
 
         """
-        LOGGER.critical('Connection from RabbitMQ closed: %r', unused)
+        if self.is_stopped:
+            LOGGER.info('Connection to RabbitMQ closed')
+            return ioloop.IOLoop.instance().stop()
+        if connection is not self._connection:
+            LOGGER.debug('Ignoring close of a replaced connection')
+            return
+        LOGGER.critical('Connection from RabbitMQ closed: %r', connection)
         self._channel = None
         if not self.is_shutting_down:
+            self._broker.failed()
             self.reconnect()
 
     def on_connection_open(self, unused):
@@ -459,6 +872,15 @@ class Process(multiprocessing.Process, state.State):
 
         """
         LOGGER.info('Connection opened')
+        if self._disconnected_at:
+            self.increment_count(self.TIME_DISCONNECTED,
+                                 time.time() - self._disconnected_at)
+            LOGGER.info('Reconnected after %.2f seconds and %i attempts',
+                        time.time() - self._disconnected_at,
+                        self._reconnect_attempts)
+            self._disconnected_at = None
+        self._reconnect_attempts = 0
+        self._broker.succeeded()
         self.add_on_connection_close_callback()
         self.open_channel()
 
@@ -467,33 +889,126 @@ class Process(multiprocessing.Process, state.State):
         # Set the state to shutting down if it wasn't set as that during loop
         self.set_state(self.STATE_SHUTTING_DOWN)
 
-        # If the connection is still around, close it
-        if self._connection.is_open:
-            LOGGER.debug('Closing connection to RabbitMQ')
-            self._connection.close()
+        # Acknowledge any buffered messages before closing the connection
+        self.flush_acks()
+
+        # Do not reconnect if a reconnect was scheduled
+        self.remove_reconnect_timeout()
+
+        # Stop adjusting the QoS prefetch count and probing the queue
+        if self._qos_timer:
+            self._qos_timer.stop()
+            self._qos_timer = None
+        if self._queue_probe_timer:
+            self._queue_probe_timer.stop()
+            self._queue_probe_timer = None
+
+        # Write the profile if the profiler is running
+        self.stop_profiling()
+
+        # Send the final stats for the process
+        if self._stats_timer:
+            self._stats_timer.stop()
+            self._stats_timer = None
+            self.submit_stats()
+        if self._metrics_timer:
+            self._metrics_timer.stop()
+            self._metrics_timer = None
+        if self._metrics:
+            self._metrics.close()
+            self._metrics = None
 
         # Allow the consumer to gracefully stop and then stop the IOLoop
         self.stop_consumer()
 
+        # Release the worker threads if processing in a thread pool
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
         # Note that shutdown is complete and set the state accordingly
         LOGGER.info('Shutdown complete')
         self.set_state(self.STATE_STOPPED)
 
-    def on_sigprof(self, unused_signum, unused_frame):
-        """Called when SIGPROF is sent to the process, will dump the stats, in
-        future versions, queue them for the master process to get data.
+        # Close the connection, stopping the IOLoop once it has closed
+        if self._connection and self._connection.is_open:
+            LOGGER.debug('Closing connection to RabbitMQ')
+            self._connection.close()
+        else:
+            ioloop.IOLoop.instance().stop()
+
+    def on_sigprof(self, unused_signum, frame):
+        """Called when SIGPROF is sent to the process. While the profiler is
+        running SIGPROF is sent by the CPU time interval timer and the stacks
+        are sampled, otherwise the stats are dumped to the log. Stats are
+        pushed to the MCP by submit_stats.
 
         :param int unused_signum: The signal number
-        :param frame unused_frame: The python frame the signal was received at
+        :param frame frame: The python frame the signal was received at
 
         """
+        if self._profiler and self._profiler.active:
+            return self._profiler.sample(frame)
         LOGGER.info('Currently %s: %r', self.state_description, self._counts)
 
+    def on_sigusr1(self, unused_signum, unused_frame):
+        """Called when SIGUSR1 is sent to the process by the MCP to activate
+        a spare process.
+
+        :param int unused_signum: The signal number
+        :param frame unused_frame: The python frame the signal was received at
+
+        """
+        ioloop.IOLoop.instance().add_callback_from_signal(self.activate)
+
+    def on_sigusr2(self, unused_signum, unused_frame):
+        """Called when SIGUSR2 is sent to the process by the MCP to start the
+        sampling profiler.
+
+        :param int unused_signum: The signal number
+        :param frame unused_frame: The python frame the signal was received at
+
+        """
+        ioloop.IOLoop.instance().add_callback_from_signal(
+            self.start_profiling)
+
+    def on_processed(self, message, future, generation=None):
+        """Invoked by the IOLoop when a consumer that processes messages
+        asynchronously has finished with the message. If the process has
+        reconnected since the message was received, the result is dropped
+        since the message can no longer be acked or rejected.
+
+        :param Message message: The message that was processed
+        :param tornado.concurrent.Future future: The processing result
+        :param int generation: The channel generation it was received on
+
+        """
+        if self.is_stale(message, generation):
+            return self.finish_message(message, False, generation)
+        self.finish_message(message, self._process(message, future),
+                            generation)
+
     def open_channel(self):
         """Open a channel on the existing open connection to RabbitMQ"""
         LOGGER.info('Opening a channel on %r', self._connection)
         self._connection.channel(self.on_channel_open)
 
+    def probe_queue(self):
+        """Invoked periodically by the IOLoop to ask RabbitMQ how many messages
+        are waiting in the queue with a passive Queue.Declare. When the MCP
+        shares the probe between the processes of the consumer connection,
+        only the process it picked sends the Queue.Declare and the others
+        read the result from the shared probe.
+
+        """
+        if (self._queue_probe is not None and
+                int(self._queue_probe[self.PROBE_PID]) != os.getpid()):
+            return self.read_queue_probe()
+        if self._spare:
+            return
+        if self._channel and self._channel.is_open:
+            self._channel.queue_declare(self.on_queue_probe,
+                                        queue=self._queue_name, passive=True)
+
     def process(self, channel=None, method=None, header=None, body=None):
         """Process a message from Rabbit
 
@@ -503,23 +1018,69 @@ class Process(multiprocessing.Process, state.State):
         :param str body: The message body
 
         """
-        if not self.is_idle:
-            LOGGER.critical('Received a message while in state: %s',
-                            self.state_description)
+        # Hold on to the messages the prefetch delivers beyond the max
+        # concurrency until one of the messages in flight finishes
+        if self._state == self.STATE_PROCESSING and not self.can_process:
+            LOGGER.debug('Buffering message #%s with %i messages in flight',
+                         method.delivery_tag, len(self._deliveries))
+            self._buffered.append((channel, method, header, body))
+            return
+        if not self.can_process:
+            LOGGER.critical('Received a message while in state: %s with %i '
+                            'messages in flight', self.state_description,
+                            len(self._deliveries))
             return self.reject(method.delivery_tag, True)
-        self.set_state(self.STATE_PROCESSING)
+        if self.is_idle:
+            self.set_state(self.STATE_PROCESSING)
         LOGGER.debug('Received message #%s', method.delivery_tag)
+        start = time.time()
         message = data.Message(channel, method, header, body)
+        self.record_timing(self.CONSTRUCT_DURATION, time.time() - start)
         if method.redelivered:
             self.increment_count(self.REDELIVERED)
-        self._state_start = time.time()
-        if not self._process(message):
-            LOGGER.debug('Bypassing ack due to False return from _process')
+        self._deliveries[method.delivery_tag] = time.time()
+
+        # How long it took from creating the process to the first message
+        if self._spawned:
+            self._counts[self.SPAWN_LATENCY] = \
+                self._deliveries[method.delivery_tag] - self._spawned
+            LOGGER.info('Received the first message %.3f seconds after the '
+                        'process was spawned',
+                        self._counts[self.SPAWN_LATENCY])
+            self._spawned = None
+
+        # How long the message waited in the broker, if it was timestamped
+        timestamp = getattr(header, 'timestamp', None)
+        if timestamp:
+            wait = self._deliveries[method.delivery_tag] - timestamp
+            if wait >= 0:
+                self.record_timing(self.QUEUE_WAIT, wait)
+        result = self._process(message)
+        if result is None:
+            LOGGER.debug('Message #%s is in flight', method.delivery_tag)
+            return
+        self.finish_message(message, result)
+
+    def process_buffered(self):
+        """Start processing the buffered messages while there is room for
+        more messages in flight, or requeue them if the process is waiting to
+        shut down. Messages that finish right away start the next buffered
+        message from this loop instead of recursing.
+
+        """
+        if self._buffered_starting:
+            return
+        if self.is_waiting_to_shutdown:
+            while self._buffered:
+                method = self._buffered.popleft()[1]
+                self.reject(method.delivery_tag, True)
             return
-        self.increment_count(self.PROCESSED)
-        if self._ack:
-            self.ack_message(method.delivery_tag)
-        self.reset_state()
+        self._buffered_starting = True
+        try:
+            while self._buffered and self.can_process:
+                self.process(*self._buffered.popleft())
+        finally:
+            self._buffered_starting = False
 
     def processing_failure(self):
         """Called when message processing failure happens due to a
@@ -537,27 +1098,66 @@ class Process(multiprocessing.Process, state.State):
             LOGGER.critical('Error threshold exceeded (%i), reconnecting',
                             self._counts[self.ERROR])
             self.cancel_consumer_with_rabbitmq()
-            self.close_connection()
             self.reconnect()
 
+    def read_queue_probe(self):
+        """Use the queue depth and consumer count from the probe shared by
+        the processes of the consumer connection, if it has been probed.
+
+        """
+        if self._queue_probe[self.PROBE_CONSUMERS] < 0:
+            return
+        self._queue_depth = int(self._queue_probe[self.PROBE_DEPTH])
+        self._queue_consumers = int(self._queue_probe[self.PROBE_CONSUMERS])
+
+    def on_reconnect_timeout(self):
+        """Invoked by the IOLoop when it is time to try and reconnect."""
+        self._reconnect_timeout = None
+        self.connect()
+
     def reconnect(self):
-        """Reconnect to RabbitMQ after sleeping for _RECONNECT_DELAY"""
-        LOGGER.info('Reconnecting to RabbitMQ in %i seconds',
-                    self._RECONNECT_DELAY)
+        """Drop the current connection to RabbitMQ and schedule a reconnect on
+        the IOLoop.
+
+        """
+        if self._reconnect_timeout:
+            LOGGER.debug('Reconnect already scheduled')
+            return
         self.increment_count(self.RECONNECTED)
         self.set_state(self.STATE_INITIALIZING)
+        self.clear_pending_acks()
+        self._buffered.clear()
+        self._deliveries = dict()
+        self._generation += 1
+        self._qos_prefetch = None
+        if not self._disconnected_at:
+            self._disconnected_at = time.time()
         if self._connection:
-            if self._connection.socket:
+            if self._connection.is_open:
+                self._connection.close()
+            elif self._connection.socket and not self._connection.is_closing:
                 fd = self._connection.socket.fileno()
                 self._connection.ioloop.remove_handler(fd)
-            self._connection.ioloop.stop()
-            del self._connection
-        else:
-            _ioloop = ioloop.IOLoop.instance()
-            _ioloop.stop()
-        time.sleep(self._RECONNECT_DELAY)
-        self._connection = self.connect_to_rabbitmq(self._connections,
-                                                    self._connection_name)
+            self._connection = None
+
+        # Fail over to the other broker nodes right away on the first pass
+        # through them, after that back off so a node that accepts and then
+        # drops connections does not cause a tight reconnect loop
+        if self._reconnect_attempts < len(self.brokers) - 1:
+            return self.schedule_reconnect(0)
+        self.schedule_reconnect()
+
+    @property
+    def reconnect_delay(self):
+        """Return the delay before the next reconnect attempt, using
+        exponential backoff with full jitter, capped at the max delay.
+
+        :rtype: float
+
+        """
+        delay = min(self._reconnect_max_delay,
+                    self._reconnect_delay * (2 ** self._reconnect_attempts))
+        return random.uniform(0, delay)
 
     def record_exception(self, error, handled=False):
         """Record an exception
@@ -589,12 +1189,43 @@ class Process(multiprocessing.Process, state.State):
         """
         if not self._ack:
             raise RuntimeError('Can not rejected messages when ack is False')
+        if not self._channel or not self._channel.is_open:
+            LOGGER.warning('Can not reject %s without an open channel',
+                           delivery_tag)
+            return
         LOGGER.warning('Rejecting message %s %s requeue', delivery_tag,
                        'with' if requeue else 'without')
+        self.flush_acks()
+        start = time.time()
         self._channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+        self.record_timing(self.ACK_DURATION, time.time() - start)
         self.increment_count(self.REQUEUED if requeue else self.REJECTED)
-        if self.is_processing:
-            self.reset_state()
+
+    def remove_reconnect_timeout(self):
+        """Remove the scheduled reconnect from the IOLoop if it is set"""
+        if self._reconnect_timeout:
+            ioloop.IOLoop.instance().remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+
+    def record_timing(self, name, duration):
+        """Record a duration in the named histogram and send it as a timing
+        if direct metrics are enabled.
+
+        :param str name: The histogram name
+        :param float duration: The duration in seconds
+
+        """
+        self._histograms[name].record(duration)
+        if self._metrics:
+            self._metrics.timing('%s.%s' % (self._metrics_prefix, name),
+                                 duration)
+
+    def remove_ack_timeout(self):
+        """Remove the pending ack batch timeout from the IOLoop if it is set"""
+        if self._ack_timeout:
+            if self._connection:
+                self._connection.remove_timeout(self._ack_timeout)
+            self._ack_timeout = None
 
     def reset_failure_counter(self):
         """Reset the failure counter to the max error count"""
@@ -619,11 +1250,23 @@ class Process(multiprocessing.Process, state.State):
 
     def run(self):
         """Start the consumer"""
+        # Don't use the IOLoop or SIGCHLD handler of the MCP that was forked
+        ioloop.IOLoop.clear_current()
+        ioloop.IOLoop.clear_instance()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        # Close the copies of the MCP's listening sockets made by the fork
+        self.close_listening_fds()
+
+        # Handle the MCP's signals before telling it the process is ready
+        self.setup_signal_handlers()
+        if self._ready is not None:
+            self._ready.value = 1
         try:
             self.setup(self._kwargs['config'],
                        self._kwargs['connection_name'],
                        self._kwargs['consumer_name'],
-                       self._kwargs['stats_queue'])
+                       self._kwargs['stats_pipe'])
         except ImportError as error:
             name = self._kwargs['consumer_name']
             consumer = self._kwargs['config']['Consumers'][name]['consumer']
@@ -631,16 +1274,30 @@ class Process(multiprocessing.Process, state.State):
                             consumer, error)
             return
 
-        while not self.is_waiting_to_shutdown:
+        while not self.is_stopped:
             try:
-                self._connection.ioloop.start()
+                ioloop.IOLoop.instance().start()
             except KeyboardInterrupt:
                 self.stop()
-                self._connection.ioloop.start()
-            while not self._connection and self.is_connecting:
-                time.sleep(0.1)
         LOGGER.debug('Exiting %s', self.name)
 
+    def schedule_reconnect(self, delay=None):
+        """Schedule the next attempt to connect to RabbitMQ on the IOLoop,
+        using the backoff delay if a delay is not specified.
+
+        :param int|float delay: Seconds to wait before connecting
+
+        """
+        if delay is None:
+            delay = self.reconnect_delay
+        self._reconnect_attempts += 1
+        self.increment_count(self.RECONNECT_ATTEMPTS)
+        LOGGER.info('Reconnecting to RabbitMQ in %.2f seconds (attempt %i)',
+                    delay, self._reconnect_attempts)
+        self._reconnect_timeout = \
+            ioloop.IOLoop.instance().add_timeout(time.time() + delay,
+                                                 self.on_reconnect_timeout)
+
     def set_qos_prefetch(self, value=None):
         """Set the QOS Prefetch count for the channel.
 
@@ -650,6 +1307,7 @@ class Process(multiprocessing.Process, state.State):
         qos_prefetch = int(value or self.base_qos_prefetch)
         if qos_prefetch != self._qos_prefetch:
             self._qos_prefetch = qos_prefetch
+            self._counts[self.QOS_PREFETCH] = qos_prefetch
             LOGGER.info('Setting the QOS Prefetch to %i', qos_prefetch)
             self._channel.basic_qos(prefetch_count=qos_prefetch)
 
@@ -661,30 +1319,28 @@ class Process(multiprocessing.Process, state.State):
 
         """
         # Keep track of how much time we're spending waiting and processing
-        if new_state == self.STATE_PROCESSING and self.is_idle:
-            self.increment_count(self.TIME_WAITED, self.time_in_state)
-
-        elif new_state == self.STATE_IDLE and self.is_processing:
-            self.increment_count(self.TIME_SPENT, self.time_in_state)
+        if ((new_state == self.STATE_PROCESSING and self.is_idle) or
+                (new_state == self.STATE_IDLE and self.is_processing)):
+            self.count_state_time()
 
         # Use the parent object to set the state
         super(Process, self)._set_state(new_state)
 
-    def setup(self, config, connection_name, consumer_name, stats_queue):
+    def setup(self, config, connection_name, consumer_name, stats_pipe):
         """Initialize the consumer, setting up needed attributes and connecting
         to RabbitMQ.
 
         :param dict config: Consumer config section
         :param str connection_name: The name of the connection
         :param str consumer_name: Consumer name for config
-        :param multiprocessing.Queue stats_queue: The queue to append stats in
+        :param multiprocessing.Connection stats_pipe: The pipe to send stats on
         :raises: ImportError
 
         """
         LOGGER.info('Initializing for %s on %s', self.name, connection_name)
 
-        # The queue for populating stats data
-        self._stats_queue = stats_queue
+        # The pipe for sending stats data to the MCP
+        self._stats_pipe = stats_pipe
 
         # Hold the consumer config
         self._connection_name = connection_name
@@ -700,12 +1356,31 @@ class Process(multiprocessing.Process, state.State):
         # Set the routing information
         self._queue_name = self._config['queue']
 
-        # Set the dynamic QoS toggle
+        # Set the dynamic QoS toggle and how often to recalculate in seconds
         self._dynamic_qos = self._config.get('dynamic_qos', True)
+        self._qos_interval = self._config.get('dynamic_qos_interval',
+                                              self._QOS_INTERVAL)
 
         # Set the various control nobs
         self._ack = self._config.get('ack', True)
 
+        # Run blocking consumers in a bounded thread pool if configured
+        max_concurrency = self._MAX_CONCURRENCY
+        if self._config.get('executor') == 'threads':
+            max_concurrency = int(self._config.get('executor_pool_size',
+                                                   self._EXECUTOR_POOL_SIZE))
+            self._executor = self.get_executor(max_concurrency)
+
+        # How many messages may be in flight at the same time
+        self._max_concurrency = int(self._config.get('max_concurrency',
+                                                     max_concurrency))
+
+        # Ack coalescing, batch size and max time in milliseconds to buffer
+        self._ack_batch_size = int(self._config.get('ack_batch_size',
+                                                    self._ACK_BATCH_SIZE))
+        self._ack_batch_timeout = self._config.get('ack_batch_timeout',
+                                                   self._ACK_BATCH_TIMEOUT)
+
         # How many errors until the process stops
         self._max_error_count = int(self._config.get('max_errors',
                                                      self._MAX_ERROR_COUNT))
@@ -719,42 +1394,138 @@ class Process(multiprocessing.Process, state.State):
         self._max_framesize = self._config.get('max_frame_size',
                                                pika.spec.FRAME_MAX_SIZE)
 
-        # Setup the signal handler for stats
-        self.setup_signal_handlers()
+        # Reconnect backoff base delay and the cap in seconds
+        self._reconnect_delay = self._config.get('reconnect_delay',
+                                                 self._RECONNECT_DELAY)
+        self._reconnect_max_delay = self._config.get('reconnect_max_delay',
+                                                     self._RECONNECT_MAX_DELAY)
+
+        # Where and for how long to profile when the MCP sends SIGUSR2
+        self._profiler = profiler.Profiler(
+            config.get('profile_dir', tempfile.gettempdir()), self.name,
+            config.get('profile_interval'))
+        self._profile_duration = config.get('profile_duration',
+                                            self._PROFILE_DURATION)
+
+        # Push stats to the MCP at the same interval it polls them at
+        self._stats_interval = config.get('poll_interval', self._POLL_INTERVAL)
+        self._stats_timer = \
+            ioloop.PeriodicCallback(self.submit_stats,
+                                    self._stats_interval * 1000)
+        self._stats_timer.start()
+
+        # Send the timing of each message directly to StatsD if enabled
+        self.setup_metrics(config.get('metrics'))
+
+        # Periodically adjust the QoS prefetch count from the message velocity
+        if self._dynamic_qos and self._ack:
+            self._qos_timer = \
+                ioloop.PeriodicCallback(self.update_qos_prefetch,
+                                        self._qos_interval * 1000)
+            self._qos_timer.start()
+
+        # Periodically check the queue depth, an interval of 0 disables it
+        interval = self._config.get('queue_probe_interval',
+                                    self._QUEUE_PROBE_INTERVAL)
+        if interval:
+            self._queue_probe_timer = ioloop.PeriodicCallback(self.probe_queue,
+                                                              interval * 1000)
+            self._queue_probe_timer.start()
 
         # Create the RabbitMQ Connection
-        self._connection = self.connect_to_rabbitmq(self._connections,
-                                                    self._connection_name)
+        self.connect()
 
     def setup_channel(self):
-        """Setup the channel that will be used to communicate with RabbitMQ and
-        set the QoS, send a Basic.Recover and set the channel object in the
-        consumer object.
+        """Setup the channel that will be used to communicate with RabbitMQ,
+        set the channel object in the consumer object, set the QoS and start
+        consuming unless the process is a spare.
 
         """
-        # Set the channel in the consumer
+        # Set the channel in the consumer, publishing from the IOLoop thread
+        # if the consumer is running in the thread pool
+        channel = self._channel
+        if self._executor:
+            channel = ThreadSafeChannel(self._channel, self._connection.ioloop)
         try:
-            self._consumer.set_channel(self._channel)
+            self._consumer.set_channel(channel)
         except AttributeError:
             LOGGER.debug('Consumer does not support channel assignment')
 
-        # Setup QoS, Send a Basic.Recover and then Basic.Consume
+        # Setup QoS, spares wait to be activated before consuming
         self.set_qos_prefetch()
-        self._channel.basic_recover(requeue=True)
-        self._channel.basic_consume(consumer_callback=self.process,
-                                    queue=self._queue_name,
-                                    no_ack=not self._ack,
-                                    consumer_tag=self.name)
+        if self._spare:
+            LOGGER.info('Spare process is ready, waiting to be activated')
+            return
+        self.start_consuming()
+
+    def setup_metrics(self, config):
+        """Create the metrics emitter for the direct mode, sending the timings
+        of each message from the process instead of only the percentiles the
+        MCP sends at each poll interval.
+
+        :param dict config: The metrics section of the configuration
+
+        """
+        if not config or not config.get('direct'):
+            return
+        if config.get('protocol', metrics.STATSD) != metrics.STATSD:
+            LOGGER.warning('Direct metrics are only supported for StatsD')
+            return
+        try:
+            self._metrics = metrics.from_config(config)
+        except ValueError as error:
+            LOGGER.error('Could not send metrics: %s', error)
+            return
+        if not self._metrics:
+            return
+        self._metrics_prefix = metrics.metric_name(self._consumer_name,
+                                                   self.name)
+        interval = config.get('flush_interval', self._METRICS_FLUSH_INTERVAL)
+        self._metrics_timer = ioloop.PeriodicCallback(self._metrics.flush,
+                                                      interval * 1000)
+        self._metrics_timer.start()
 
     def setup_signal_handlers(self):
-        """Setup the stats and stop signal handlers. Use SIGABRT instead of
-        SIGTERM due to the multiprocessing's behavior with SIGTERM.
+        """Setup the stats, spare activation and stop signal handlers. Use
+        SIGABRT instead of SIGTERM due to the multiprocessing's behavior with
+        SIGTERM.
 
         """
         signal.signal(signal.SIGABRT, self.stop)
         signal.signal(signal.SIGPROF, self.on_sigprof)
+        signal.signal(signal.SIGUSR1, self.on_sigusr1)
+        signal.signal(signal.SIGUSR2, self.on_sigusr2)
         signal.siginterrupt(signal.SIGABRT, False)
         signal.siginterrupt(signal.SIGPROF, False)
+        signal.siginterrupt(signal.SIGUSR1, False)
+        signal.siginterrupt(signal.SIGUSR2, False)
+
+    def start_consuming(self):
+        """Send a Basic.Recover and then a Basic.Consume to start receiving
+        messages from the queue.
+
+        """
+        self._channel.basic_recover(requeue=True)
+        self._channel.basic_consume(consumer_callback=self.process,
+                                    queue=self._queue_name,
+                                    no_ack=not self._ack,
+                                    consumer_tag=self.name)
+
+    def start_profiling(self):
+        """Start the sampling profiler for the number of seconds the MCP
+        requested, or the configured profile duration.
+
+        """
+        if not self._profiler or self._profiler.active:
+            LOGGER.warning('Profiling requested but the profiler is %s',
+                           'running' if self._profiler else 'not setup')
+            return
+        seconds = self._profile_duration
+        if self._profile_seconds and self._profile_seconds.value:
+            seconds = self._profile_seconds.value
+        self._profiler.start()
+        self._profile_timeout = \
+            ioloop.IOLoop.instance().call_later(seconds, self.stop_profiling)
 
     def stop(self, signum=None, frame_unused=None):
         """Stop the consumer from consuming by calling BasicCancel and setting
@@ -786,6 +1557,17 @@ class Process(multiprocessing.Process, state.State):
 
         self.on_ready_to_stop()
 
+    def stop_profiling(self):
+        """Stop the sampling profiler if it is running, writing the collapsed
+        stacks to the profile directory.
+
+        """
+        if self._profile_timeout:
+            ioloop.IOLoop.instance().remove_timeout(self._profile_timeout)
+            self._profile_timeout = None
+        if self._profiler and self._profiler.active:
+            self._profiler.stop()
+
     def stop_consumer(self):
         """Stop the consumer object and allow it to do a clean shutdown if it
         has the ability to do so.
@@ -797,6 +1579,54 @@ class Process(multiprocessing.Process, state.State):
         except AttributeError:
             LOGGER.debug('Consumer does not have a shutdown method')
 
+    def submit_stats(self):
+        """Push a snapshot of the counters and histograms on to the stats
+        queue for the MCP, sending only the counters that changed since the
+        last snapshot as deltas and the current value of the gauges. The
+        counters are left out if the MCP reads them from shared memory.
+
+        The histograms and the max ack latency only contain the values
+        recorded since the last snapshot, so the max ack latency is sent
+        with the snapshot even when the counters are in shared memory.
+
+        """
+        self.count_state_time()
+        counts, gauges, histograms = dict(), dict(), dict()
+        if not isinstance(self._counts, counters.CounterBlock):
+            for key, value in self._counts.items():
+                if key in self.GAUGES:
+                    gauges[key] = value
+                elif value != self._submitted_counts.get(key, 0):
+                    counts[key] = value - self._submitted_counts.get(key, 0)
+            self._submitted_counts = dict(self._counts)
+        else:
+            value = self._counts[self.ACK_LATENCY_MAX]
+            if value or self._submitted_counts.get(self.ACK_LATENCY_MAX):
+                gauges[self.ACK_LATENCY_MAX] = value
+            self._submitted_counts = {self.ACK_LATENCY_MAX: value}
+
+        # The max ack latency is reported per snapshot
+        self._counts[self.ACK_LATENCY_MAX] = 0
+
+        for name, value in self._histograms.items():
+            if value.counts:
+                histograms[name] = value.counts
+                value.reset()
+        if not (counts or gauges or histograms):
+            return
+        try:
+            self._stats_pipe.send({'name': self.name,
+                                   'consumer_name': self._consumer_name,
+                                   'pid': os.getpid(),
+                                   'state': self.state_description,
+                                   'timestamp': time.time(),
+                                   'counts': counts,
+                                   'gauges': gauges,
+                                   'histograms': histograms})
+        except (IOError, OSError) as error:
+            LOGGER.warning('Could not send stats snapshot to the MCP: %r',
+                           error)
+
     @property
     def time_in_state(self):
         """Return the time that has been spent in the current state.
@@ -815,16 +1645,57 @@ class Process(multiprocessing.Process, state.State):
         """
         return self.count(self.ERROR) >= self._max_error_count
 
-    def _process(self, message):
-        """Wrap the actual processor processing bits
+    def update_qos_prefetch(self):
+        """Invoked periodically by the IOLoop to update the message velocity
+        and processing latency averages for the last interval and adjust the
+        QoS prefetch count accordingly.
+
+        """
+        now = time.time()
+        if self._last_stats_time:
+            velocity = self.message_velocity
+            self._velocity_ewma = self.ewma(self._velocity_ewma, velocity)
+            if self._latency_samples:
+                latency = float(self._latency_total) / self._latency_samples
+                self._latency_ewma = self.ewma(self._latency_ewma, latency)
+            self._counts[self.VELOCITY] = self._velocity_ewma
+            self._counts[self.PROCESSING_LATENCY] = self._latency_ewma or 0
+        self._last_counts = dict(self._counts)
+        self._last_stats_time = now
+        self._latency_samples = 0
+        self._latency_total = 0
+
+        # Only adjust the prefetch count on an open, consuming channel
+        if (self._velocity_ewma is not None and self._qos_prefetch and
+                self._channel and self._channel.is_open):
+            self.calculate_qos_prefetch()
+
+    def _process(self, message, future=None):
+        """Wrap the actual processor processing bits. If the consumer returns
+        a future, the message is in flight and None is returned. When the
+        future has resolved, it is passed back in to get the result.
 
         :param Message message: Message to process
+        :param tornado.concurrent.Future future: The async processing result
+        :rtype: bool or None
         :raises: consumer.ConsumerException
 
         """
         # Try and process the message
         try:
-            self._consumer.process(message)
+            if future is None:
+                if self._executor:
+                    result = self._executor.submit(
+                        copy.copy(self._consumer).process, message)
+                else:
+                    result = self._consumer.process(message)
+                if concurrent.is_future(result):
+                    self._connection.ioloop.add_future(
+                        result, functools.partial(self.on_processed, message,
+                                                  generation=self._generation))
+                    return None
+            else:
+                future.result()
 
         except KeyboardInterrupt:
             self.reject(message.delivery_tag, True)
@@ -861,5 +1732,37 @@ class Process(multiprocessing.Process, state.State):
         return True
 
 
+class ThreadSafeChannel(object):
+    """Channel proxy handed to consumers that are processing messages in the
+    thread pool. Pika is not thread-safe, so publishing is scheduled on the
+    IOLoop thread instead of writing to the socket from the worker thread.
+
+    """
+    def __init__(self, channel, io_loop):
+        """Create a new proxy for the channel
+
+        :param pika.channel.Channel channel: The channel to proxy
+        :param tornado.ioloop.IOLoop io_loop: The IOLoop the channel is on
+
+        """
+        self._channel = channel
+        self._ioloop = io_loop
+
+    def __getattr__(self, name):
+        """Return attributes that are not overridden from the channel
+
+        :param str name: The attribute name
+        :rtype: any
+
+        """
+        return getattr(self._channel, name)
+
+    def basic_publish(self, *args, **kwargs):
+        """Schedule the Basic.Publish on the IOLoop thread."""
+        publish = functools.partial(self._channel.basic_publish,
+                                    *args, **kwargs)
+        self._ioloop.add_callback(publish)
+
+
 class ReconnectConnection(Exception):
     pass
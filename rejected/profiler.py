@@ -0,0 +1,116 @@
+"""
+A low overhead sampling profiler for consumer processes. While it is running,
+the CPU time interval timer sends SIGPROF every interval seconds of CPU time
+and the stacks of every thread are counted. When it is stopped, the stacks are
+written in the collapsed format used by flame graph tools:
+
+    frame;frame;frame count
+
+Only the stacks are walked in the signal handler, the samples are written to
+disk when the profiler is stopped.
+
+"""
+import collections
+import logging
+import os
+import signal
+import sys
+import thread
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Profiler(object):
+    """Sample the stacks of the threads of the process on SIGPROF."""
+    _INTERVAL = 0.01
+
+    def __init__(self, directory, name, interval=None):
+        """Create the profiler
+
+        :param str directory: The directory to write the profiles to
+        :param str name: The process name to use in the profile filenames
+        :param float interval: Seconds of CPU time between the samples
+
+        """
+        self.directory = directory
+        self.interval = interval or self._INTERVAL
+        self.name = name
+        self.samples = 0
+        self.started = None
+        self._labels = dict()
+        self._stacks = collections.Counter()
+
+    @property
+    def active(self):
+        """Returns True if the profiler is sampling
+
+        :rtype: bool
+
+        """
+        return self.started is not None
+
+    def label(self, code):
+        """Return the frame label for the code object.
+
+        :param code code: The code object of the frame
+        :rtype: str
+
+        """
+        if code not in self._labels:
+            self._labels[code] = '%s (%s:%i)' % (code.co_name,
+                                                 code.co_filename,
+                                                 code.co_firstlineno)
+        return self._labels[code]
+
+    def sample(self, frame):
+        """Count the current stack of each thread, invoked from the SIGPROF
+        signal handler with the frame it interrupted.
+
+        :param frame frame: The frame the signal was received at
+
+        """
+        frames = sys._current_frames()
+        frames[thread.get_ident()] = frame
+        for frame in frames.values():
+            stack = list()
+            while frame is not None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            self._stacks[';'.join(stack)] += 1
+        self.samples += 1
+
+    def start(self):
+        """Start sampling, discarding any samples from a previous run."""
+        self.samples = 0
+        self.started = time.time()
+        self._stacks = collections.Counter()
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        LOGGER.info('Started profiling with a %.3f second interval',
+                    self.interval)
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks to the profile
+        directory, returning the path of the file or None if it could not be
+        written.
+
+        :rtype: str or None
+
+        """
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        path = os.path.join(self.directory,
+                            '%s-%i-%i.collapsed' % (self.name, os.getpid(),
+                                                    self.started))
+        self.started = None
+        try:
+            with open(path, 'w') as handle:
+                for stack, count in sorted(self._stacks.items()):
+                    handle.write('%s %i\n' % (stack, count))
+        except (IOError, OSError) as error:
+            LOGGER.error('Could not write the profile to %s: %s', path, error)
+            return None
+        finally:
+            self._stacks = collections.Counter()
+        LOGGER.info('Wrote %i samples to %s', self.samples, path)
+        return path
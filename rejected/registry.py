@@ -0,0 +1,218 @@
+"""
+The registry of the consumer processes the MCP is running, indexed by process
+name, pid and consumer connection so that lookups, removals and counts do not
+scan every consumer and process.
+
+"""
+import collections
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ProcessRecord(object):
+    """A consumer process and the metadata the MCP keeps about it."""
+
+    def __init__(self, name, consumer, connection, process, restarts=0,
+                 spare=False):
+        """Create a new process record
+
+        :param str name: The process name
+        :param str consumer: The consumer name
+        :param str connection: The connection name
+        :param multiprocessing.Process process: The process
+        :param int restarts: The number of processes that exited on the
+            consumer connection before this one was started
+        :param bool spare: The process is a spare that is not consuming
+
+        """
+        self.name = name
+        self.consumer = consumer
+        self.connection = connection
+        self.process = process
+        self.restarts = restarts
+        self.retiring = False
+        self.spare = spare
+        self.started = time.time()
+        self.stats = None
+
+    def __repr__(self):
+        return '<ProcessRecord %s pid=%r>' % (self.name, self.pid)
+
+    @property
+    def pid(self):
+        """Return the pid of the process or None if it is not started.
+
+        :rtype: int or None
+
+        """
+        return self.process.pid
+
+
+class Registry(object):
+    """The consumer processes by name and pid, with the process names for
+    each consumer connection kept in the order they were started.
+
+    Spare processes are kept apart from the consuming processes and are not
+    included in the counts until they are activated.
+
+    """
+    def __init__(self):
+        self._by_connection = dict()
+        self._by_consumer = collections.Counter()
+        self._by_name = dict()
+        self._by_pid = dict()
+        self._restarts = collections.Counter()
+        self._spares = dict()
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __iter__(self):
+        return iter(self._by_name.values())
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def activate(self, name):
+        """Move a spare process in to the consuming processes of its consumer
+        connection as the newest process.
+
+        :param str name: The process name
+        :rtype: ProcessRecord
+
+        """
+        record = self._by_name[name]
+        key = (record.consumer, record.connection)
+        del self._spares[key][name]
+        record.spare = False
+        self._index(record)
+        return record
+
+    def add(self, name, consumer, connection, process, spare=False):
+        """Add a process to the registry, returning its record.
+
+        :param str name: The process name
+        :param str consumer: The consumer name
+        :param str connection: The connection name
+        :param multiprocessing.Process process: The process
+        :param bool spare: The process is a spare that is not consuming
+        :rtype: ProcessRecord
+
+        """
+        record = ProcessRecord(name, consumer, connection, process,
+                               self._restarts[(consumer, connection)], spare)
+        self._by_name[name] = record
+        if record.pid:
+            self._by_pid[record.pid] = record
+        if spare:
+            key = (consumer, connection)
+            if key not in self._spares:
+                self._spares[key] = collections.OrderedDict()
+            self._spares[key][name] = record
+        else:
+            self._index(record)
+        return record
+
+    def by_pid(self, pid):
+        """Return the record for the process pid, or None if it is not a
+        registered process.
+
+        :param int pid: The process id
+        :rtype: ProcessRecord or None
+
+        """
+        return self._by_pid.get(pid)
+
+    def count(self, consumer, connection=None):
+        """Return the number of processes for the consumer, optionally only
+        on the specified connection.
+
+        :param str consumer: The consumer name
+        :param str connection: The connection name
+        :rtype: int
+
+        """
+        if connection is None:
+            return self._by_consumer[consumer]
+        return len(self._by_connection.get((consumer, connection), ()))
+
+    def get(self, name):
+        """Return the record for the process name, or None if it is not a
+        registered process.
+
+        :param str name: The process name
+        :rtype: ProcessRecord or None
+
+        """
+        return self._by_name.get(name)
+
+    def _index(self, record):
+        """Add a consuming process to its consumer connection.
+
+        :param ProcessRecord record: The process record
+
+        """
+        key = (record.consumer, record.connection)
+        if key not in self._by_connection:
+            self._by_connection[key] = collections.OrderedDict()
+        self._by_connection[key][record.name] = record
+        self._by_consumer[record.consumer] += 1
+
+    def names(self, consumer, connection):
+        """Return the process names for the consumer connection, oldest
+        first.
+
+        :param str consumer: The consumer name
+        :param str connection: The connection name
+        :rtype: list
+
+        """
+        return list(self._by_connection.get((consumer, connection), ()))
+
+    def remove(self, name, exited=False):
+        """Remove the process from the registry, returning its record or None
+        if it was not registered. When the process exited on its own, the
+        restart count of its consumer connection is incremented.
+
+        :param str name: The process name
+        :param bool exited: The process exited instead of being stopped
+        :rtype: ProcessRecord or None
+
+        """
+        record = self._by_name.pop(name, None)
+        if not record:
+            LOGGER.warning('Could not find process %s to remove', name)
+            return None
+        if self._by_pid.get(record.pid) is record:
+            del self._by_pid[record.pid]
+        key = (record.consumer, record.connection)
+        if record.spare:
+            del self._spares[key][name]
+            return record
+        del self._by_connection[key][name]
+        self._by_consumer[record.consumer] -= 1
+        if exited:
+            self._restarts[key] += 1
+        return record
+
+    def spares(self, consumer, connection):
+        """Return the spare process names for the consumer connection, oldest
+        first.
+
+        :param str consumer: The consumer name
+        :param str connection: The connection name
+        :rtype: list
+
+        """
+        return list(self._spares.get((consumer, connection), ()))
+
+    def started(self, name):
+        """Index the process by its pid once it has been started.
+
+        :param str name: The process name
+
+        """
+        record = self._by_name[name]
+        self._by_pid[record.pid] = record
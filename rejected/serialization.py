@@ -0,0 +1,661 @@
+"""
+Registry of the codecs used to decode and deserialize the bodies of the
+messages a consumer receives, and to serialize and encode the bodies of the
+messages it publishes. Codecs are registered for a content-type or a
+content-encoding and each one can have more than one backend, such as the
+standard library and the simplejson JSON codecs.
+
+Consumers choose a backend or add codecs of their own in Consumer._CODECS or
+in the codecs section of their configuration, by backend name or by the
+import path of a Codec:
+
+    codecs:
+      application/json: json
+      text/yaml: yaml_c
+      application/x-custom: mypackage.codecs.custom
+
+The Avro and Protocol Buffers codecs need a schema, which is named by the
+schema header or the type property of the message. Schemas are resolved from
+the location configured for the content-type, in the Consumer._SCHEMAS or the
+schemas section of the configuration, and cached for the life of the process:
+
+    schemas:
+      application/x-avro: /etc/rejected/schemas
+      application/x-protobuf: mypackage.events_pb2
+
+Content-encoding codecs can also decode incrementally, returning the decoded
+value in chunks and raising MaxSizeExceeded once the decoded value is larger
+than the maximum size, so a small compressed body can not inflate without
+bounds.
+
+"""
+import bz2
+import cPickle
+import cStringIO as stringio
+import csv
+import decimal
+import importlib
+import itertools
+import json
+import logging
+import os
+import pickle
+import plistlib
+import re
+import yaml
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+# Optional backends
+try:
+    import avro.io
+    import avro.schema
+except ImportError:
+    LOGGER.warning('avro not found, disabling Avro support')
+    avro = None
+
+try:
+    import bs4
+except ImportError:
+    bs4 = None
+
+try:
+    import msgpack
+except ImportError:
+    LOGGER.warning('msgpack not found, disabling MessagePack support')
+    msgpack = None
+
+try:
+    from google.protobuf import json_format
+    from google.protobuf import message as protobuf_message
+except ImportError:
+    LOGGER.warning('protobuf not found, disabling Protocol Buffers support')
+    json_format = None
+    protobuf_message = None
+
+try:
+    import simplejson
+except ImportError:
+    LOGGER.debug('simplejson not found, disabling the simplejson codec')
+    simplejson = None
+
+try:
+    import ujson
+except ImportError:
+    LOGGER.debug('ujson not found, disabling the ujson codec')
+    ujson = None
+
+PICKLE_MIME_TYPES = ['application/pickle',
+                     'application/x-pickle',
+                     'application/x-vnd.python.pickle',
+                     'application/vnd.python.pickle']
+YAML_MIME_TYPES = ['text/yaml', 'text/x-yaml']
+AVRO_MIME_TYPES = ['application/x-avro', 'avro/binary']
+MSGPACK_MIME_TYPES = ['application/msgpack', 'application/x-msgpack']
+PROTOBUF_MIME_TYPES = ['application/x-protobuf', 'application/protobuf']
+
+# The message header that names the schema, the type property is used if the
+# header is not set
+SCHEMA_HEADER = 'schema'
+
+# Schema names are dotted names, so they can not reach outside of the schema
+# location
+_SCHEMA_NAME = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)*$')
+
+# The number of characters csv dialects are sniffed from
+CSV_SAMPLE_SIZE = 1024
+
+# The column types that can be configured by name for typed CSV rows
+CSV_TYPES = {'decimal': decimal.Decimal,
+             'float': float,
+             'int': int,
+             'str': str}
+
+# The size of the chunks decoded values are returned in
+CHUNK_SIZE = 65536
+
+# bz2 can not limit the size of its output, so it is fed less input than
+# the smallest compressed block to decompress at most one block at a time
+_BZ2_INPUT_SIZE = 32
+
+# The most a single bzip2 block can decompress to, 900k of run length encoded
+# data with each 5 byte run expanding to 255 bytes
+_BZ2_MAX_BLOCK_SIZE = 900000 // 5 * 255
+
+
+class Codec(object):
+    """A named backend that dumps values to strings and loads them back,
+    optionally with a stream function that loads a value incrementally. If
+    the codec has a schema function, the schema is passed to dump and load
+    after the value.
+
+    """
+    def __init__(self, name, dump, load, stream=None, schema=None):
+        """Create a codec
+
+        :param str name: The backend name
+        :param callable dump: Returns the value as a string
+        :param callable load: Returns the value for a string
+        :param callable stream: Returns an iterator of the loaded chunks for
+            a string and the maximum loaded size
+        :param callable schema: Returns the schema for a schema name and the
+            configured schema location
+
+        """
+        self.name = name
+        self.dump = dump
+        self.load = load
+        self.schema = schema
+        self.stream = stream
+
+    def __repr__(self):
+        return '<Codec(%s)>' % self.name
+
+
+class MaxSizeExceeded(ValueError):
+    """Raised when a decoded value is larger than the maximum size."""
+    pass
+
+
+class SchemaError(ValueError):
+    """Raised when a schema can not be resolved."""
+    pass
+
+
+class SchemaLocationError(SchemaError):
+    """Raised when the schema location is not configured or does not
+    exist.
+
+    """
+    pass
+
+
+class SchemaNameError(SchemaError):
+    """Raised when the schema name is invalid or is not in the schema
+    location.
+
+    """
+    pass
+
+
+class Registry(object):
+    """The codecs for each content-type and content-encoding by backend
+    name, with the default backend for each.
+
+    """
+    def __init__(self):
+        self._codecs = dict()
+        self._defaults = dict()
+
+    def __contains__(self, key):
+        return key in self._codecs
+
+    def backends(self, key):
+        """Return the names of the backends registered for the content-type
+        or content-encoding.
+
+        :param str key: The content-type or content-encoding
+        :rtype: list
+
+        """
+        return sorted(self._codecs.get(key, dict()))
+
+    def get(self, key, backend=None):
+        """Return the codec for the content-type or content-encoding, using
+        the default backend if one is not specified.
+
+        :param str key: The content-type or content-encoding
+        :param str backend: The backend name
+        :rtype: Codec or None
+
+        """
+        return self._codecs.get(key, dict()).get(backend or
+                                                 self._defaults.get(key))
+
+    def register(self, keys, codec, default=False):
+        """Register the codec for one or more content-types or
+        content-encodings. The first codec registered for each is the default
+        unless another is registered with default set.
+
+        :param str|list keys: The content-types or content-encodings
+        :param Codec codec: The codec to register
+        :param bool default: Make the codec the default backend
+
+        """
+        for key in [keys] if isinstance(keys, basestring) else keys:
+            self._codecs.setdefault(key, dict())[codec.name] = codec
+            if default or key not in self._defaults:
+                self._defaults[key] = codec.name
+
+    def select(self, overrides=None):
+        """Return the codec to use for each content-type and content-encoding,
+        replacing the default backends with the overrides. An override is a
+        backend name, a Codec or the import path of a Codec.
+
+        :param dict overrides: Backends by content-type or content-encoding
+        :rtype: dict
+        :raises: ValueError
+
+        """
+        codecs = dict([(key, self.get(key)) for key in self._codecs])
+        for key, backend in (overrides or dict()).items():
+            if isinstance(backend, Codec):
+                codecs[key] = backend
+            elif backend in self._codecs.get(key, dict()):
+                codecs[key] = self.get(key, backend)
+            elif '.' in backend:
+                codecs[key] = import_codec(backend)
+            else:
+                raise ValueError('No %s codec registered for %s' %
+                                 (backend, key))
+        return codecs
+
+
+class SchemaCache(object):
+    """The schemas resolved by the codecs, cached by codec, location and
+    schema name for the life of the process.
+
+    """
+    def __init__(self):
+        self._schemas = dict()
+
+    def __len__(self):
+        return len(self._schemas)
+
+    def clear(self):
+        """Remove all of the cached schemas."""
+        self._schemas = dict()
+
+    def get(self, codec, name, location=None):
+        """Return the schema for the codec, resolving it the first time it is
+        requested.
+
+        :param Codec codec: The codec that uses the schema
+        :param str name: The schema name
+        :param str location: The configured schema location
+        :rtype: any
+        :raises: SchemaError
+        :raises: SchemaLocationError
+        :raises: SchemaNameError
+
+        """
+        key = (codec.name, location, name)
+        if key not in self._schemas:
+            if not _SCHEMA_NAME.match(name or ''):
+                raise SchemaNameError('Invalid schema name: %r' % name)
+            if not location:
+                raise SchemaLocationError('No schema location for the %s '
+                                          'codec' % codec.name)
+            LOGGER.info('Resolving the %s schema %s from %s', codec.name,
+                        name, location)
+            self._schemas[key] = codec.schema(name, location)
+        return self._schemas[key]
+
+
+def avro_schema(name, location):
+    """Return the Avro schema parsed from the name.avsc file in the location
+    directory.
+
+    :param str name: The schema name
+    :param str location: The schema directory
+    :rtype: avro.schema.Schema
+    :raises: SchemaError
+    :raises: SchemaLocationError
+    :raises: SchemaNameError
+
+    """
+    if not os.path.isdir(location):
+        raise SchemaLocationError('Avro schema directory %s does not exist' %
+                                  location)
+    path = os.path.join(location, '%s.avsc' % name)
+    try:
+        with open(path) as handle:
+            return avro.schema.parse(handle.read())
+    except IOError as error:
+        raise SchemaNameError('Could not read the Avro schema %s: %s' %
+                              (path, error))
+    except avro.schema.SchemaParseException as error:
+        raise SchemaError('Could not parse the Avro schema %s: %s' %
+                          (path, error))
+
+
+def csv_dialect(value):
+    """Return the csv dialect for a dialect name such as excel-tab, or for a
+    dict of the formatting parameters that differ from the excel dialect.
+
+    :param str|dict|csv.Dialect value: The dialect name or parameters
+    :rtype: csv.Dialect
+    :raises: csv.Error
+
+    """
+    if isinstance(value, basestring):
+        return csv.get_dialect(value)
+    if isinstance(value, dict):
+        class ConfiguredDialect(csv.excel):
+            pass
+        for key, param in value.items():
+            setattr(ConfiguredDialect, str(key),
+                    str(param) if isinstance(param, unicode) else param)
+        return ConfiguredDialect
+    return value
+
+
+def dump_avro(value, schema):
+    """Return the value encoded as Avro binary with the schema.
+
+    :param any value: The value to encode
+    :param avro.schema.Schema schema: The schema
+    :rtype: str
+
+    """
+    output = stringio.StringIO()
+    avro.io.DatumWriter(schema).write(value, avro.io.BinaryEncoder(output))
+    return output.getvalue()
+
+
+def dump_csv(value):
+    """Return a list of lists as a CSV string.
+
+    :param list value: The rows
+    :rtype: str
+
+    """
+    csv_buffer = stringio.StringIO()
+    writer = csv.writer(csv_buffer, quotechar='"', quoting=csv.QUOTE_ALL)
+    writer.writerows(value)
+    value = csv_buffer.getvalue()
+    csv_buffer.close()
+    return value
+
+
+def dump_protobuf(value, schema):
+    """Return a Protocol Buffers message, or a dict of the fields of the
+    schema message, as a string.
+
+    :param protobuf.message.Message|dict value: The value to encode
+    :param type schema: The protobuf message class
+    :rtype: str
+
+    """
+    if not isinstance(value, protobuf_message.Message):
+        value = json_format.ParseDict(value, schema())
+    return value.SerializeToString()
+
+
+def dump_yaml(value):
+    """Return the value as a YAML string using the C dumper.
+
+    :param any value: The value to dump
+    :rtype: str
+
+    """
+    return yaml.dump(value, Dumper=yaml.CDumper)
+
+
+def import_codec(path):
+    """Import a Codec from a module by its path, such as
+    mypackage.codecs.custom.
+
+    :param str path: The module and attribute name of the codec
+    :rtype: Codec
+    :raises: ValueError
+
+    """
+    module_name, name = path.rsplit('.', 1)
+    try:
+        codec = getattr(importlib.import_module(module_name), name)
+    except (AttributeError, ImportError) as error:
+        raise ValueError('Could not import the codec %s: %s' % (path, error))
+    if not isinstance(codec, Codec):
+        raise ValueError('%s is not a Codec' % path)
+    return codec
+
+
+def load_csv(value, dialect=None):
+    """Return a csv.DictReader for the CSV string, using the dialect sniffed
+    from the start of the value if one is not passed in.
+
+    :param str value: The CSV string
+    :param csv.Dialect dialect: The dialect of the value
+    :rtype: csv.DictReader
+
+    """
+    return csv.DictReader(stringio.StringIO(value),
+                          dialect=dialect or sniff_csv_dialect(value))
+
+
+def load_csv_columns(lines, dialect, types=None):
+    """Return the columns of CSV lines with a header row as a dict of the
+    field names and lists of the values, converting the values of the
+    columns in types. Values missing from short rows are None.
+
+    :param iterator lines: The CSV lines
+    :param csv.Dialect dialect: The dialect of the lines
+    :param dict types: Column types by field name
+    :rtype: dict
+
+    """
+    fields, rows = load_csv_rows(lines, dialect, types)
+    columns = list(itertools.izip_longest(*rows))
+    columns.extend([()] * (len(fields) - len(columns)))
+    return dict(zip(fields, [list(column) for column in columns]))
+
+
+def load_csv_rows(lines, dialect, types=None):
+    """Return the field names from the header row and an iterator of the
+    remaining rows of CSV lines as lists, converting the values of the
+    columns in types. A type is a callable or one of the CSV_TYPES names.
+
+    :param iterator lines: The CSV lines
+    :param csv.Dialect dialect: The dialect of the lines
+    :param dict types: Column types by field name
+    :rtype: tuple(list, iterator)
+    :raises: ValueError
+
+    """
+    reader = csv.reader(lines, dialect)
+    fields = next(reader, [])
+    if not types:
+        return fields, reader
+    converters = list()
+    for field in fields:
+        converter = types.get(field)
+        if isinstance(converter, basestring):
+            if converter not in CSV_TYPES:
+                raise ValueError('Unsupported CSV type %s for %s' %
+                                 (converter, field))
+            converter = CSV_TYPES[converter]
+        converters.append(converter)
+    return fields, ([convert(value) if convert else value
+                     for convert, value in zip(converters, row)]
+                    for row in reader)
+
+
+def load_avro(value, schema):
+    """Return the value decoded from Avro binary with the schema.
+
+    :param str value: The Avro binary value
+    :param avro.schema.Schema schema: The schema
+    :rtype: any
+
+    """
+    return avro.io.DatumReader(schema).read(
+        avro.io.BinaryDecoder(stringio.StringIO(value)))
+
+
+def load_protobuf(value, schema):
+    """Return the Protocol Buffers message parsed from the value.
+
+    :param str value: The serialized message
+    :param type schema: The protobuf message class
+    :rtype: protobuf.message.Message
+
+    """
+    message = schema()
+    message.ParseFromString(value)
+    return message
+
+
+def load_yaml(value):
+    """Return the value for a YAML string using the C loader.
+
+    :param str value: The YAML string
+    :rtype: any
+
+    """
+    return yaml.load(value, Loader=yaml.CLoader)
+
+
+def protobuf_schema(name, location):
+    """Return the Protocol Buffers message class with the name, which can be
+    a nested message such as Event.Click, in the location module.
+
+    :param str name: The message name
+    :param str location: The module of the message classes
+    :rtype: type
+    :raises: SchemaLocationError
+    :raises: SchemaNameError
+
+    """
+    try:
+        schema = importlib.import_module(location)
+    except ImportError as error:
+        raise SchemaLocationError('Could not import the protobuf module %s: '
+                                  '%s' % (location, error))
+    try:
+        for part in name.split('.'):
+            schema = getattr(schema, part)
+    except AttributeError as error:
+        raise SchemaNameError('Could not find the protobuf message %s.%s: %s'
+                              % (location, name, error))
+    if not (isinstance(schema, type) and
+            issubclass(schema, protobuf_message.Message)):
+        raise SchemaNameError('%s.%s is not a protobuf message' %
+                              (location, name))
+    return schema
+
+
+def sniff_csv_dialect(sample):
+    """Return the csv dialect sniffed from the start of the sample.
+
+    :param str sample: The start of a CSV value
+    :rtype: csv.Dialect
+    :raises: csv.Error
+
+    """
+    return csv.Sniffer().sniff(sample[:CSV_SAMPLE_SIZE])
+
+
+def stream_bz2(value, max_size=None):
+    """Decompress a bzip2 value incrementally, returning an iterator of the
+    decompressed chunks.
+
+    The size is checked as each block is decompressed, feeding only as much
+    input at a time as could complete the blocks that fit in what is left of
+    max_size. A block is decompressed whole, so a crafted block of a few
+    bytes still decompresses to as much as _BZ2_MAX_BLOCK_SIZE bytes before
+    MaxSizeExceeded is raised. When max_size is None the decompressed size
+    is not limited, so there is no protection against decompression bombs.
+
+    :param str value: The compressed value
+    :param int max_size: The maximum decompressed size in bytes, or None to
+        not limit it
+    :rtype: iterator
+    :raises: MaxSizeExceeded
+
+    """
+    decompressor = bz2.BZ2Decompressor()
+    offset, size = 0, 0
+    while offset < len(value):
+        if max_size:
+            blocks = max(1, (max_size - size) // _BZ2_MAX_BLOCK_SIZE)
+            input_size = _BZ2_INPUT_SIZE * blocks
+        else:
+            input_size = CHUNK_SIZE
+        chunk = decompressor.decompress(value[offset:offset + input_size])
+        offset += input_size
+        if not chunk:
+            continue
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise MaxSizeExceeded('Decompressed value is larger than %i '
+                                  'bytes' % max_size)
+        for start in xrange(0, len(chunk), CHUNK_SIZE):
+            yield chunk[start:start + CHUNK_SIZE]
+
+
+def stream_zlib(value, max_size=None):
+    """Decompress a zlib value incrementally, returning an iterator of the
+    decompressed chunks.
+
+    :param str value: The compressed value
+    :param int max_size: The maximum decompressed size in bytes, or None to
+        not limit it and disable the protection against decompression bombs
+    :rtype: iterator
+    :raises: MaxSizeExceeded
+
+    """
+    decompressor = zlib.decompressobj()
+    size = 0
+    while True:
+        chunk = decompressor.decompress(value, CHUNK_SIZE)
+        value = decompressor.unconsumed_tail
+        if not chunk:
+            if value:
+                continue
+            chunk = decompressor.flush()
+            if not chunk:
+                return
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise MaxSizeExceeded('Decompressed value is larger than %i '
+                                  'bytes' % max_size)
+        yield chunk
+
+
+REGISTRY = Registry()
+
+# Content encodings
+REGISTRY.register('bzip2', Codec('bz2', bz2.compress, bz2.decompress,
+                                 stream_bz2))
+REGISTRY.register('gzip', Codec('zlib', zlib.compress, zlib.decompress,
+                                stream_zlib))
+
+# Content types
+if simplejson:
+    REGISTRY.register('application/json',
+                      Codec('simplejson', simplejson.dumps,
+                            lambda value: simplejson.loads(value,
+                                                           use_decimal=True)))
+REGISTRY.register('application/json', Codec('json', json.dumps, json.loads))
+if ujson:
+    REGISTRY.register('application/json',
+                      Codec('ujson', ujson.dumps, ujson.loads))
+REGISTRY.register(PICKLE_MIME_TYPES, Codec('pickle', pickle.dumps,
+                                           pickle.loads))
+REGISTRY.register(PICKLE_MIME_TYPES, Codec('cpickle', cPickle.dumps,
+                                           cPickle.loads))
+REGISTRY.register('application/x-plist',
+                  Codec('plistlib', plistlib.writePlistToString,
+                        plistlib.readPlistFromString))
+REGISTRY.register('text/csv', Codec('csv', dump_csv, load_csv))
+if bs4:
+    REGISTRY.register(['text/html', 'text/xml'],
+                      Codec('bs4', str, bs4.BeautifulSoup))
+REGISTRY.register(YAML_MIME_TYPES, Codec('yaml', yaml.dump, yaml.load))
+if hasattr(yaml, 'CLoader'):
+    REGISTRY.register(YAML_MIME_TYPES, Codec('yaml_c', dump_yaml, load_yaml))
+if msgpack:
+    REGISTRY.register(MSGPACK_MIME_TYPES,
+                      Codec('msgpack', msgpack.packb, msgpack.unpackb))
+if avro:
+    REGISTRY.register(AVRO_MIME_TYPES,
+                      Codec('avro', dump_avro, load_avro,
+                            schema=avro_schema))
+if protobuf_message:
+    REGISTRY.register(PROTOBUF_MIME_TYPES,
+                      Codec('protobuf', dump_protobuf, load_protobuf,
+                            schema=protobuf_schema))
+
+SCHEMAS = SchemaCache()
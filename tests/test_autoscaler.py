@@ -0,0 +1,89 @@
+"""Tests for rejected.autoscaler"""
+import mock
+import sys
+# Import unittest if 2.7, unittest2 if other version
+if (sys.version_info[0], sys.version_info[1]) == (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+
+from rejected import autoscaler
+
+
+class TestAutoscaler(unittest.TestCase):
+
+    def setUp(self):
+        self._obj = autoscaler.Autoscaler(1, 4, {'scale_down_intervals': 2})
+
+    def decide(self, timestamp, processes, idle_ratio, backlog=None):
+        with mock.patch('time.time', return_value=timestamp):
+            return self._obj.decide(processes, idle_ratio, backlog)
+
+    def test_config(self):
+        obj = autoscaler.Autoscaler(1, 4, {'scale_up_idle_ratio': 0.2})
+        self.assertEqual(obj.scale_up_idle_ratio, 0.2)
+        self.assertEqual(obj.scale_up_intervals,
+                         autoscaler.Autoscaler._SCALE_UP_INTERVALS)
+        self.assertEqual(obj.scale_down_idle_ratio,
+                         autoscaler.Autoscaler._SCALE_DOWN_IDLE_RATIO)
+
+    def test_scale_up_when_saturated(self):
+        self.assertEqual(self.decide(1000, 1, 0.05),
+                         autoscaler.Autoscaler.SCALE_UP)
+
+    def test_no_change_between_ratios(self):
+        self.assertEqual(self.decide(1000, 2, 0.3), 0)
+
+    def test_no_change_without_idle_ratio(self):
+        self.assertEqual(self.decide(1000, 2, None), 0)
+
+    def test_scale_up_stops_at_maximum(self):
+        self.assertEqual(self.decide(1000, 4, 0.0), 0)
+
+    def test_scale_up_cooldown(self):
+        self.decide(1000, 1, 0.0)
+        self.assertEqual(self.decide(1030, 2, 0.0), 0)
+        self.assertEqual(self.decide(1061, 2, 0.0),
+                         autoscaler.Autoscaler.SCALE_UP)
+
+    def test_scale_up_on_growing_backlog(self):
+        self.assertEqual(self.decide(1000, 1, 0.3, 100), 0)
+        self.assertEqual(self.decide(1030, 1, 0.3, 200), 0)
+        self.assertEqual(self.decide(1060, 1, 0.3, 300),
+                         autoscaler.Autoscaler.SCALE_UP)
+
+    def test_no_scale_up_on_growing_backlog_when_idle(self):
+        for offset in range(5):
+            self.assertEqual(self.decide(1000 + offset * 30, 1, 0.9,
+                                         100 * (offset + 1)), 0)
+
+    def test_no_scale_up_on_backlog_growth_interrupted(self):
+        self.decide(1000, 1, 0.3, 100)
+        self.decide(1030, 1, 0.3, 200)
+        self.decide(1060, 1, 0.3, 150)
+        self.assertEqual(self.decide(1090, 1, 0.3, 250), 0)
+
+    def test_scale_down_after_idle_intervals(self):
+        self.assertEqual(self.decide(1000, 3, 0.9), 0)
+        self.assertEqual(self.decide(1030, 3, 0.9),
+                         autoscaler.Autoscaler.SCALE_DOWN)
+
+    def test_scale_down_interrupted_by_busy_interval(self):
+        self.decide(1000, 3, 0.9)
+        self.decide(1030, 3, 0.3)
+        self.assertEqual(self.decide(1060, 3, 0.9), 0)
+
+    def test_scale_down_stops_at_minimum(self):
+        self.decide(1000, 1, 0.9)
+        self.assertEqual(self.decide(1030, 1, 0.9), 0)
+
+    def test_scale_down_not_with_backlog(self):
+        self.decide(1000, 3, 0.9, 10)
+        self.assertEqual(self.decide(1030, 3, 0.9, 5), 0)
+
+    def test_scale_down_cooldown_after_scale_up(self):
+        self.decide(1000, 1, 0.0)
+        self.decide(1030, 2, 0.9)
+        self.assertEqual(self.decide(1060, 2, 0.9), 0)
+        self.assertEqual(self.decide(1301, 2, 0.9),
+                         autoscaler.Autoscaler.SCALE_DOWN)
@@ -0,0 +1,157 @@
+"""Tests for rejected.brokers"""
+import mock
+import socket
+import sys
+# Import unittest if 2.7, unittest2 if other version
+if (sys.version_info[0], sys.version_info[1]) == (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+
+from rejected import brokers
+from rejected import process
+
+
+class TestBroker(unittest.TestCase):
+
+    def setUp(self):
+        self._obj = brokers.Broker('localhost', 5672)
+
+    def test_score_no_failures(self):
+        self.assertEqual(self._obj.score, 0)
+
+    def test_score_after_failure(self):
+        with mock.patch('time.time', return_value=1000):
+            self._obj.failed()
+            self.assertEqual(self._obj.score, 1)
+
+    def test_score_decays(self):
+        with mock.patch('time.time', return_value=1000):
+            self._obj.failed()
+            self._obj.failed()
+        with mock.patch('time.time', return_value=1060):
+            self.assertEqual(self._obj.score, 1)
+
+    def test_succeeded_resets_failures(self):
+        self._obj.failed()
+        self._obj.succeeded()
+        self.assertEqual(self._obj.score, 0)
+
+
+class TestBrokers(unittest.TestCase):
+
+    def test_single_host(self):
+        obj = brokers.Brokers({'host': 'rabbitmq', 'port': 5673})
+        self.assertEqual([(node.host, node.port) for node in obj],
+                         [('rabbitmq', 5673)])
+
+    def test_host_list_with_ports(self):
+        obj = brokers.Brokers({'host': ['rabbit1', 'rabbit2:5673'],
+                               'port': 5672})
+        self.assertEqual([(node.host, node.port) for node in obj],
+                         [('rabbit1', 5672), ('rabbit2', 5673)])
+
+    def test_invalid_strategy(self):
+        self.assertRaises(ValueError, brokers.Brokers,
+                          {'host': 'rabbitmq', 'failover': 'random'})
+
+    def test_least_recently_failed_prefers_first(self):
+        obj = brokers.Brokers({'host': ['rabbit1', 'rabbit2']})
+        self.assertEqual(obj.next().host, 'rabbit1')
+        self.assertEqual(obj.next().host, 'rabbit1')
+
+    def test_least_recently_failed_skips_failed(self):
+        obj = brokers.Brokers({'host': ['rabbit1', 'rabbit2']})
+        obj.nodes[0].failed()
+        self.assertEqual(obj.next().host, 'rabbit2')
+
+    def test_least_recently_failed_all_failed(self):
+        obj = brokers.Brokers({'host': ['rabbit1', 'rabbit2']})
+        with mock.patch('time.time', return_value=1000):
+            obj.nodes[1].failed()
+        with mock.patch('time.time', return_value=1000.001):
+            obj.nodes[0].failed()
+            self.assertEqual(obj.next().host, 'rabbit2')
+
+    def test_round_robin(self):
+        obj = brokers.Brokers({'host': ['rabbit1', 'rabbit2', 'rabbit3'],
+                               'failover': 'round_robin'})
+        self.assertEqual([obj.next().host for offset in range(4)],
+                         ['rabbit1', 'rabbit2', 'rabbit3', 'rabbit1'])
+
+    def test_round_robin_skips_unhealthy(self):
+        obj = brokers.Brokers({'host': ['rabbit1', 'rabbit2', 'rabbit3'],
+                               'failover': 'round_robin'})
+        obj.nodes[1].failed()
+        self.assertEqual([obj.next().host for offset in range(3)],
+                         ['rabbit1', 'rabbit3', 'rabbit1'])
+
+    def test_round_robin_all_unhealthy(self):
+        obj = brokers.Brokers({'host': ['rabbit1', 'rabbit2'],
+                               'failover': 'round_robin'})
+        for node in obj:
+            node.failed()
+        self.assertEqual([obj.next().host for offset in range(3)],
+                         ['rabbit1', 'rabbit2', 'rabbit1'])
+
+
+class TestProcessFailover(unittest.TestCase):
+    """Connect a Process to local stand-in listeners for the broker nodes"""
+
+    def setUp(self):
+        self._listener = self.new_listener()
+        self._dead_port = self.new_listener()
+        dead_port = self._dead_port.getsockname()[1]
+        self._dead_port.close()
+        self._connections = {
+            'rabbitmq': {'host': ['127.0.0.1:%i' % dead_port,
+                                  '127.0.0.1:%i' %
+                                  self._listener.getsockname()[1]],
+                         'user': 'guest',
+                         'pass': 'guest',
+                         'vhost': '/'}}
+        with mock.patch('multiprocessing.Process'):
+            self._obj = process.Process(name='MockProcess')
+        self._obj._connections = self._connections
+        self._obj._connection_name = 'rabbitmq'
+
+    def tearDown(self):
+        if self._obj._connection and self._obj._connection.socket:
+            self._obj._connection.ioloop.remove_handler(
+                self._obj._connection.socket.fileno())
+            self._obj._connection.socket.close()
+        self._listener.close()
+
+    def new_listener(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        return listener
+
+    def test_connect_fails_over_to_live_node(self):
+        self._obj.connect()
+        self.assertEqual(self._obj._broker.port,
+                         self._listener.getsockname()[1])
+
+    def test_connect_marks_dead_node_failed(self):
+        self._obj.connect()
+        self.assertEqual(self._obj.brokers.nodes[0].failures, 1)
+
+    def test_connect_does_not_schedule_reconnect(self):
+        with mock.patch.object(process.Process,
+                               'schedule_reconnect') as schedule:
+            self._obj.connect()
+            self.assertFalse(schedule.called)
+
+    def test_connect_all_nodes_down_schedules_reconnect(self):
+        self._listener.close()
+        with mock.patch.object(process.Process,
+                               'schedule_reconnect') as schedule:
+            self._obj.connect()
+            schedule.assert_called_once_with()
+        self.assertTrue(all([node.failures for node in self._obj.brokers]))
+
+    def test_next_connect_prefers_live_node(self):
+        self._obj.connect()
+        self.assertEqual(self._obj.brokers.next().port,
+                         self._listener.getsockname()[1])
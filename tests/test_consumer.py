@@ -3,10 +3,12 @@
 import sys
 import bs4
 import bz2
+import copy
 import csv
 import datetime
 import mock
 import pickle
+import threading
 try:
     import pgsql_wrapper
 except ImportError:
@@ -24,9 +26,14 @@ if (sys.version_info[0], sys.version_info[1]) == (2, 7):
     import unittest
 else:
     import unittest2 as unittest
+from tornado import concurrent
+from tornado import gen
+from tornado import ioloop
 import zlib
 
 from rejected import consumer
+from rejected import data
+from rejected import serialization
 
 
 class MockAllProperties(object):
@@ -85,6 +92,14 @@ class LocalConsumer(consumer.Consumer):
     _MESSAGE_TYPE = None
 
 
+class LocalAsyncConsumer(consumer.AsyncConsumer):
+
+    @gen.coroutine
+    def _process(self):
+        yield gen.moment
+        raise gen.Return(self.message_id)
+
+
 class TestJSONConsumer(unittest.TestCase):
     _CONFIG = {'pgsql': {'host': 'localhost',
                          'port': 6000,
@@ -265,6 +280,116 @@ Logging:
         result = list(self._obj._load_csv_value(self._CSV))
         self.assertListEqual(result, self._CSV_EXPECTATION)
 
+    def test_load_csv_value_caches_dialect_by_type(self):
+        with mock.patch('rejected.serialization.sniff_csv_dialect',
+                        return_value=csv.excel) as sniff:
+            self._obj._load_csv_value(self._CSV)
+            self._obj._load_csv_value(self._CSV)
+            sniff.assert_called_once_with(self._CSV)
+        self.assertIs(self._obj._csv_dialects['click'], csv.excel)
+
+    def test_load_csv_value_caches_dialect_by_routing_key(self):
+        self._obj._message.properties.type = None
+        self._obj._load_csv_value(self._CSV)
+        self.assertIn('click', self._obj._csv_dialects)
+        self.assertEqual(list(self._obj._csv_dialects), ['click'])
+
+    def test_load_csv_value_drops_least_recently_used_dialect(self):
+        with mock.patch.object(LocalConsumer, '_CSV_DIALECT_CACHE_SIZE', 2):
+            for key in ['first', 'second', 'first', 'third']:
+                self._obj._message.properties.type = key
+                self._obj._load_csv_value(self._CSV)
+        self.assertEqual(list(self._obj._csv_dialects), ['first', 'third'])
+
+    def test_load_csv_value_shares_dialect_lock_with_copies(self):
+        self.assertIs(copy.copy(self._obj)._csv_dialects_lock,
+                      self._obj._csv_dialects_lock)
+
+    def test_load_csv_value_from_threads(self):
+        errors = list()
+
+        def load(offset):
+            instance = copy.copy(self._obj)
+            try:
+                for key in range(200):
+                    instance._message = MockJSONMessage()
+                    instance._message.properties.type = str((key + offset) % 7)
+                    instance._get_csv_dialect(self._CSV)
+            except Exception as error:
+                errors.append(error)
+
+        with mock.patch.object(LocalConsumer, '_CSV_DIALECT_CACHE_SIZE', 3):
+            threads = [threading.Thread(target=load, args=(offset,))
+                       for offset in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self._obj._csv_dialects), 3)
+
+    def test_load_csv_value_without_message(self):
+        self._obj._message = None
+        self.assertListEqual(list(self._obj._load_csv_value(self._CSV)),
+                             self._CSV_EXPECTATION)
+        self.assertEqual(self._obj._csv_dialects, {})
+
+    def test_load_csv_value_configured_dialect(self):
+        self._obj._config = {'csv_dialect': {'delimiter': '|'}}
+        with mock.patch('rejected.serialization.sniff_csv_dialect') as sniff:
+            result = list(self._obj._load_csv_value('a|b\r\n1|2\r\n'))
+            self.assertFalse(sniff.called)
+        self.assertEqual(result, [{'a': '1', 'b': '2'}])
+
+    def test_load_csv_value_class_dialect(self):
+        with mock.patch.object(LocalConsumer, '_CSV_DIALECT', 'excel-tab'):
+            result = list(self._obj._load_csv_value('a\tb\r\n1\t2\r\n'))
+        self.assertEqual(result, [{'a': '1', 'b': '2'}])
+
+    def test_message_body_csv_uses_cached_dialect(self):
+        message = MockJSONMessage()
+        message.body = self._CSV
+        message.properties.content_type = 'text/csv'
+        self._obj._csv_dialects['click'] = csv.excel
+        with mock.patch.object(LocalConsumer, '_process'):
+            self._obj.process(message)
+        with mock.patch('rejected.serialization.sniff_csv_dialect') as sniff:
+            self.assertListEqual(list(self._obj.message_body),
+                                 self._CSV_EXPECTATION)
+            self.assertFalse(sniff.called)
+
+    def new_csv_message(self, body):
+        message = MockJSONMessage()
+        message.body = zlib.compress(body)
+        message.properties.content_encoding = 'gzip'
+        message.properties.content_type = 'text/csv'
+        self._obj._message = message
+        return message
+
+    def test_message_csv_rows(self):
+        self.new_csv_message(self._CSV)
+        fields, rows = self._obj.message_csv_rows({'foo': 'int',
+                                                   'bar': float})
+        self.assertEqual(fields, ['foo', 'bar'])
+        self.assertEqual(list(rows), [[1, 2.0], [3, 4.0], [5, 6.0]])
+
+    def test_message_csv_rows_sniffs_large_body(self):
+        self.new_csv_message('a;b\n' + '1;2\n' * 10000)
+        fields, rows = self._obj.message_csv_rows()
+        self.assertEqual(fields, ['a', 'b'])
+        self.assertEqual(len(list(rows)), 10000)
+        self.assertEqual(self._obj._csv_dialects['click'].delimiter, ';')
+
+    def test_message_csv_rows_invalid_type(self):
+        self.new_csv_message(self._CSV)
+        self.assertRaises(ValueError, self._obj.message_csv_rows,
+                          {'foo': 'datetime'})
+
+    def test_message_csv_columns(self):
+        self.new_csv_message(self._CSV)
+        self.assertEqual(self._obj.message_csv_columns({'foo': int}),
+                         {'foo': [1, 3, 5], 'bar': ['2', '4', '6']})
+
     def test_load_json_value_return_type(self):
         self.assertIsInstance(self._obj._load_json_value(MockJSONMessage.body),
                               dict)
@@ -449,6 +574,254 @@ Logging:
             self.assertRaises(consumer.ConsumerException,
                               self._obj.process, message)
 
+    def test_get_codec_default(self):
+        self.assertIs(self._obj._get_codec('gzip'),
+                      serialization.REGISTRY.get('gzip'))
+        self.assertIsNone(self._obj._get_codec('text/plain'))
+
+    def test_get_codec_configured_backend(self):
+        consumer_ = LocalConsumer({'codecs': {'application/json': 'json'}})
+        self.assertIs(consumer_._get_codec('application/json'),
+                      serialization.REGISTRY.get('application/json', 'json'))
+
+    def test_get_codec_class_backend(self):
+        codec = serialization.Codec('custom', str, str)
+        with mock.patch.object(LocalConsumer, '_CODECS',
+                               {'text/plain': codec}):
+            consumer_ = LocalConsumer({})
+            self.assertIs(consumer_._get_codec('text/plain'), codec)
+
+    def test_codecs_selected_on_init(self):
+        consumer_ = LocalAsyncConsumer({})
+        self.assertIs(copy.copy(consumer_)._codecs, consumer_._codecs)
+        self.assertIn('application/json', consumer_._codecs)
+
+    def test_message_body_custom_codec(self):
+        codec = serialization.Codec('custom', str, lambda value: value[::-1])
+        self._obj._codecs = {'application/json': codec}
+        with mock.patch.object(LocalConsumer, '_process'):
+            self._obj.process(MockJSONMessage())
+        self.assertEqual(self._obj.message_body, MockJSONMessage.body[::-1])
+
+    def test_message_body_uses_load_method(self):
+        with mock.patch.object(LocalConsumer, '_load_json_value',
+                               return_value='loaded') as load:
+            with mock.patch.object(LocalConsumer, '_process'):
+                self._obj.process(MockJSONMessage())
+            self.assertEqual(self._obj.message_body, 'loaded')
+            load.assert_called_once_with(MockJSONMessage.body)
+
+    def test_message_body_uses_decode_method(self):
+        message = MockJSONMessage()
+        message.properties.content_encoding = 'gzip'
+        with mock.patch.object(LocalConsumer, '_decode_gzip',
+                               return_value=MockJSONMessage.body) as decode:
+            with mock.patch.object(LocalConsumer, '_process'):
+                self._obj.process(message)
+            self.assertEqual(self._obj.message_body,
+                             MockJSONMessage.body_expectation)
+            decode.assert_called_once_with(message.body)
+
+    def test_message_body_load_method_uses_content_type_codec(self):
+        codec = serialization.Codec('custom', str, lambda value: value[::-1])
+        self._obj._codecs = dict(self._obj._codecs,
+                                 **{'application/x-pickle': codec})
+        message = MockJSONMessage()
+        message.properties.content_type = 'application/x-pickle'
+        with mock.patch.object(LocalConsumer, '_process'):
+            self._obj.process(message)
+        self.assertEqual(self._obj.message_body, MockJSONMessage.body[::-1])
+
+    def new_schema_message(self, headers=None, type_=None):
+        self._schema = mock.Mock(return_value='schema')
+        codec = serialization.Codec('custom', lambda value, schema: value,
+                                    lambda value, schema: (value, schema),
+                                    schema=self._schema)
+        self._obj._codecs = {'application/x-custom': codec}
+        self._obj._config = {'schemas': {'application/x-custom': 'here'}}
+        message = MockJSONMessage()
+        message.properties.content_type = 'application/x-custom'
+        message.properties.headers = headers
+        message.properties.type = type_
+        self._obj._message = message
+        self._obj._message_body = None
+        return message
+
+    def test_message_body_schema_from_header(self):
+        self.new_schema_message({serialization.SCHEMA_HEADER: 'Event'},
+                                'click')
+        with mock.patch.object(serialization, 'SCHEMAS',
+                               serialization.SchemaCache()):
+            self.assertEqual(self._obj.message_body,
+                             (MockJSONMessage.body, 'schema'))
+        self._schema.assert_called_once_with('Event', 'here')
+
+    def test_message_body_schema_from_type(self):
+        self.new_schema_message(type_='click')
+        with mock.patch.object(serialization, 'SCHEMAS',
+                               serialization.SchemaCache()):
+            self._obj.message_body
+        self._schema.assert_called_once_with('click', 'here')
+
+    def test_message_body_schema_cached(self):
+        self.new_schema_message(type_='click')
+        with mock.patch.object(serialization, 'SCHEMAS',
+                               serialization.SchemaCache()):
+            self._obj.message_body
+            self._obj._message = MockJSONMessage()
+            self._obj._message.properties.content_type = 'application/x-custom'
+            self._obj._message.properties.type = 'click'
+            self._obj._message_body = None
+            self._obj.message_body
+        self.assertEqual(self._schema.call_count, 1)
+
+    def test_message_body_without_schema_name(self):
+        self.new_schema_message()
+        with self.assertRaises(consumer.MessageException):
+            self._obj.message_body
+
+    def test_message_body_schema_error(self):
+        self.new_schema_message(type_='click')
+        self._schema.side_effect = serialization.SchemaError('missing')
+        with mock.patch.object(serialization, 'SCHEMAS',
+                               serialization.SchemaCache()):
+            with self.assertRaises(consumer.ConsumerException):
+                self._obj.message_body
+
+    def test_message_body_schema_name_error(self):
+        self.new_schema_message(type_='click')
+        self._schema.side_effect = serialization.SchemaNameError('missing')
+        with mock.patch.object(serialization, 'SCHEMAS',
+                               serialization.SchemaCache()):
+            with self.assertRaises(consumer.MessageException):
+                self._obj.message_body
+
+    def test_message_body_invalid_schema_name(self):
+        self.new_schema_message(type_='../click')
+        with mock.patch.object(serialization, 'SCHEMAS',
+                               serialization.SchemaCache()):
+            with self.assertRaises(consumer.MessageException):
+                self._obj.message_body
+        self.assertFalse(self._schema.called)
+
+    def test_message_body_without_schema_location(self):
+        self.new_schema_message(type_='click')
+        self._obj._config = dict()
+        with mock.patch.object(serialization, 'SCHEMAS',
+                               serialization.SchemaCache()):
+            with self.assertRaises(consumer.ConsumerException):
+                self._obj.message_body
+
+    def test_message_body_schema_load_error(self):
+        self.new_schema_message(type_='click')
+        self._obj._codecs['application/x-custom'].load = mock.Mock(
+            side_effect=ValueError('truncated'))
+        with mock.patch.object(serialization, 'SCHEMAS',
+                               serialization.SchemaCache()):
+            with self.assertRaises(consumer.MessageException):
+                self._obj.message_body
+
+    def test_auto_serialize_schema_from_properties(self):
+        self.new_schema_message()
+        properties = data.Properties()
+        properties.type = 'click'
+        with mock.patch.object(serialization, 'SCHEMAS',
+                               serialization.SchemaCache()):
+            self.assertEqual(self._obj._auto_serialize('application/x-custom',
+                                                       [1], properties), [1])
+        self._schema.assert_called_once_with('click', 'here')
+
+    def test_auto_serialize_schema_without_properties(self):
+        self.new_schema_message()
+        self.assertRaises(ValueError, self._obj._auto_serialize,
+                          'application/x-custom', [1])
+
+    def test_auto_serialize_unknown_content_type(self):
+        self.assertEqual(self._obj._auto_serialize('text/plain', [1]), [1])
+
+    def test_auto_encode_gzip(self):
+        self.assertEqual(zlib.decompress(self._obj._auto_encode('gzip', 'a')),
+                         'a')
+
+    def new_encoded_message(self, body, encoding='gzip'):
+        message = MockJSONMessage()
+        message.body = body
+        message.properties.content_encoding = encoding
+        message.properties.content_type = 'text/plain'
+        self._obj._message = message
+        self._obj._message_body = None
+        return message
+
+    def test_message_body_max_body_size(self):
+        self.new_encoded_message(zlib.compress('x' * 2048))
+        self._obj._config = {'max_body_size': 1024}
+        with self.assertRaises(consumer.MessageException):
+            self._obj.message_body
+
+    def test_message_body_class_max_body_size(self):
+        self.new_encoded_message(bz2.compress('x' * 2048), 'bzip2')
+        with mock.patch.object(LocalConsumer, '_MAX_BODY_SIZE', 1024):
+            with self.assertRaises(consumer.MessageException):
+                self._obj.message_body
+
+    def test_message_body_within_max_body_size(self):
+        self.new_encoded_message(zlib.compress('x' * 2048))
+        self._obj._config = {'max_body_size': 2048}
+        self.assertEqual(self._obj.message_body, 'x' * 2048)
+
+    def test_message_body_chunks_streams(self):
+        self.new_encoded_message(zlib.compress('x' * 200000))
+        chunks = list(self._obj.message_body_chunks())
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), 'x' * 200000)
+
+    def test_message_body_chunks_not_encoded(self):
+        self.new_encoded_message('{"a": 1}', None)
+        self.assertEqual(list(self._obj.message_body_chunks()), ['{"a": 1}'])
+
+    def test_message_body_lines(self):
+        lines = ['{"offset": %i}\n' % offset for offset in range(20000)]
+        self.new_encoded_message(zlib.compress(''.join(lines) + '{}'))
+        self.assertEqual(list(self._obj.message_body_lines()),
+                         lines + ['{}'])
+
+    def test_message_body_lines_csv(self):
+        self.new_encoded_message(bz2.compress('a,b\r\n1,2\r\n'), 'bzip2')
+        self.assertEqual(list(csv.reader(self._obj.message_body_lines())),
+                         [['a', 'b'], ['1', '2']])
+
+    def test_message_body_lines_max_body_size(self):
+        self.new_encoded_message(zlib.compress('x\n' * 200000))
+        self._obj._config = {'max_body_size': 1024}
+        self.assertRaises(consumer.MessageException, list,
+                          self._obj.message_body_lines())
+
+    def new_timed_message(self):
+        message = data.Message(None, mock.Mock(), MockJSONProperties(),
+                               MockJSONMessage.body)
+        self._obj._message = message
+        self._obj._message_body = None
+        return message
+
+    def test_message_body_records_phase_timings(self):
+        message = self.new_timed_message()
+        self.assertEqual(self._obj.message_body,
+                         MockJSONMessage.body_expectation)
+        self.assertEqual(sorted(message.timings),
+                         [consumer.Consumer.DECODE_DURATION,
+                          consumer.Consumer.DESERIALIZE_DURATION])
+
+    def test_publish_message_records_phase_timing(self):
+        message = self.new_timed_message()
+        self._obj._channel = mock.Mock()
+        with mock.patch.object(self._obj, '_get_pika_properties'):
+            with mock.patch('rejected.consumer.time') as mock_time:
+                mock_time.time.side_effect = [100, 100.25]
+                self._obj._publish_message('ex', 'rk', data.Properties(),
+                                           'body')
+        self.assertEqual(message.timings,
+                         {consumer.Consumer.PUBLISH_DURATION: 0.25})
+
     def test_message_body_compressed_with_bzip2(self):
         with mock.patch.object(LocalConsumer, '_process'):
             message = MockJSONMessage()
@@ -559,3 +932,46 @@ Logging:
             self._obj.process(message)
             _first_call = self._obj.message_body
             self.assertEqual(self._obj.message_body, self._PLIST)
+
+    def test_properties_is_properties_instance(self):
+        self.assertIsInstance(self._obj.properties, data.Properties)
+
+    def test_properties_is_created_once_per_message(self):
+        self.assertIs(self._obj.properties, self._obj.properties)
+
+    def test_properties_is_created_for_new_message(self):
+        properties = self._obj.properties
+        self._obj._message = MockJSONMessage()
+        self.assertIsNot(self._obj.properties, properties)
+
+    def test_properties_changes_do_not_change_message(self):
+        properties = self._obj.properties
+        properties.type = 'changed'
+        self.assertEqual(self._obj.message_type, MockJSONProperties.type)
+
+
+class TestAsyncConsumer(unittest.TestCase):
+
+    def setUp(self):
+        self._obj = LocalAsyncConsumer({})
+
+    def test_process_returns_future(self):
+        self.assertTrue(concurrent.is_future(
+            self._obj.process(MockJSONMessage())))
+
+    def test_process_does_not_assign_message(self):
+        self._obj.process(MockJSONMessage())
+        self.assertIsNone(self._obj._message)
+
+    def test_process_interleaved_messages(self):
+        first, second = MockJSONMessage(), MockJSONMessage()
+        second.properties.message_id = 'second'
+
+        @gen.coroutine
+        def process():
+            results = yield [self._obj.process(first),
+                             self._obj.process(second)]
+            raise gen.Return(results)
+
+        results = ioloop.IOLoop.current().run_sync(process)
+        self.assertEqual(results, [MockJSONProperties.message_id, 'second'])
@@ -0,0 +1,48 @@
+"""Tests for rejected.counters"""
+import multiprocessing
+import sys
+# Import unittest if 2.7, unittest2 if other version
+if (sys.version_info[0], sys.version_info[1]) == (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+
+from rejected import counters
+
+
+class TestCounterBlock(unittest.TestCase):
+
+    def setUp(self):
+        self._obj = counters.CounterBlock(['processed', 'failed'])
+
+    def test_starts_zeroed(self):
+        self.assertEqual(dict(self._obj), {'processed': 0, 'failed': 0})
+
+    def test_layout_order(self):
+        self.assertEqual(list(self._obj), ['processed', 'failed'])
+
+    def test_increment(self):
+        self._obj['processed'] += 2
+        self._obj['processed'] += 0.5
+        self.assertEqual(self._obj['processed'], 2.5)
+
+    def test_unknown_counter(self):
+        def set_unknown():
+            self._obj['unknown'] = 1
+        self.assertRaises(KeyError, set_unknown)
+
+    def test_delete_raises(self):
+        def delete():
+            del self._obj['processed']
+        self.assertRaises(TypeError, delete)
+
+    def test_len(self):
+        self.assertEqual(len(self._obj), 2)
+
+    def test_shared_with_child_process(self):
+        def increment(block):
+            block['processed'] += 5
+        child = multiprocessing.Process(target=increment, args=(self._obj,))
+        child.start()
+        child.join()
+        self.assertEqual(self._obj['processed'], 5)
@@ -1,4 +1,6 @@
 """Tests for rejected.data"""
+import copy
+import json
 import sys
 # Import unittest if 2.7, unittest2 if other version
 if (sys.version_info[0], sys.version_info[1]) == (2, 7):
@@ -120,6 +122,14 @@ class TestMessage(unittest.TestCase):
     def test_consumer_tag(self):
         self.assertEqual(self._obj.consumer_tag, mocks.MockMethod.consumer_tag)
 
+    def test_timings_empty(self):
+        self.assertEqual(self._obj.timings, {})
+
+    def test_add_timing_accumulates(self):
+        self._obj.add_timing('publish_duration', 0.25)
+        self._obj.add_timing('publish_duration', 0.5)
+        self.assertEqual(self._obj.timings, {'publish_duration': 0.75})
+
     def test_content_encoding(self):
         self.assertEqual(self._obj.properties.content_encoding,
                          mocks.MockHeader.ATTRIBUTES['content_encoding'])
@@ -182,3 +192,150 @@ class TestMessage(unittest.TestCase):
     def test_user_id(self):
         self.assertEqual(self._obj.properties.user_id,
                          mocks.MockHeader.ATTRIBUTES['user_id'])
+
+    def test_body_is_not_copied(self):
+        body = 'x' * 1024
+        message = data.Message(self.CHANNEL, self._method,
+                               mocks.MockHeader(), body)
+        self.assertIs(message.body, body)
+
+    def test_release(self):
+        self._obj.release()
+        self.assertIsNone(self._obj.body)
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(self._obj, '__dict__'))
+
+    def test_repr(self):
+        self.assertIn("'delivery_tag=%s'" % mocks.MockMethod.delivery_tag,
+                      repr(self._obj))
+
+
+class TestSlottedDataObject(unittest.TestCase):
+
+    def test_properties_no_instance_dict(self):
+        self.assertFalse(hasattr(data.Properties(mocks.MockHeader()),
+                                 '__dict__'))
+
+    def test_properties_rejects_unknown_attributes(self):
+        properties = data.Properties()
+        self.assertRaises(AttributeError, setattr, properties, 'foo', 'bar')
+
+    def test_repr_unassigned_slots(self):
+        class Slotted(data.SlottedDataObject):
+            __slots__ = ('foo', 'bar')
+        obj = Slotted()
+        obj.foo = 'baz'
+        self.assertEqual(repr(obj), "<Slotted(['foo=baz'])>")
+
+
+class TestLazyProperties(unittest.TestCase):
+
+    def setUp(self):
+        self._header = mocks.MockHeader()
+        self._obj = data.Properties(self._header)
+
+    def test_reads_through_to_header(self):
+        self._header.type = 'changed'
+        self.assertEqual(self._obj.type, 'changed')
+
+    def test_assignment_does_not_change_header(self):
+        self._obj.type = 'changed'
+        self.assertEqual(self._header.type,
+                         mocks.MockHeader.ATTRIBUTES['type'])
+
+    def test_assignment(self):
+        self._obj.type = 'changed'
+        self.assertEqual(self._obj.type, 'changed')
+
+    def test_headers_are_created_once(self):
+        self.assertIsNone(self._obj._values)
+        self.assertIs(self._obj.headers, self._obj.headers)
+
+    def test_headers_share_values_until_changed(self):
+        self._header.headers = {'list': [1, 2]}
+        self.assertIs(dict.__getitem__(self._obj.headers, 'list'),
+                      self._header.headers['list'])
+
+    def test_headers_are_a_dict(self):
+        self.assertIsInstance(self._obj.headers, dict)
+        self.assertEqual(json.loads(json.dumps(self._obj.headers)),
+                         mocks.MockHeader.ATTRIBUTES['headers'])
+
+    def test_headers_are_copied_when_changed(self):
+        self._obj.headers['foo'] = 'baz'
+        self.assertEqual(self._obj.headers['foo'], 'baz')
+        self.assertEqual(self._header.headers['foo'], 'bar')
+
+    def test_headers_are_copied_when_container_read(self):
+        self._header.headers = {'list': [1, 2]}
+        self._obj.headers['list'].append(3)
+        self.assertEqual(self._header.headers['list'], [1, 2])
+
+    def test_headers_none(self):
+        self._header.headers = None
+        self.assertEqual(self._obj.headers, {})
+
+    def test_headers_deepcopy_is_dict(self):
+        value = copy.deepcopy(self._obj.headers)
+        self.assertIsInstance(value, dict)
+        self.assertEqual(value, mocks.MockHeader.ATTRIBUTES['headers'])
+
+    def test_copy_is_lazy_view(self):
+        value = copy.copy(self._obj)
+        self.assertIs(value._header, self._obj)
+
+    def test_copy_assignment_does_not_change_original(self):
+        value = copy.copy(self._obj)
+        value.reply_to = 'changed'
+        value.headers['foo'] = 'baz'
+        self.assertEqual(self._obj.reply_to,
+                         mocks.MockHeader.ATTRIBUTES['reply_to'])
+        self.assertEqual(self._obj.headers['foo'], 'bar')
+
+    def test_default_values(self):
+        value = data.Properties()
+        self.assertEqual((value.content_type, value.delivery_mode,
+                          value.headers, value.app_id),
+                         ('text/text', 1, {}, None))
+
+
+class TestHeaders(unittest.TestCase):
+
+    def setUp(self):
+        self._table = {'foo': 'bar', 'list': [1, 2], 'dict': {'a': 1}}
+        self._obj = data.Headers(self._table)
+
+    def test_is_a_dict(self):
+        self.assertIsInstance(self._obj, dict)
+        self.assertEqual(self._obj, self._table)
+
+    def test_none(self):
+        self.assertEqual(data.Headers(None), {})
+
+    def test_get_copies_container(self):
+        self._obj.get('dict')['a'] = 2
+        self.assertEqual(self._table['dict'], {'a': 1})
+
+    def test_items_copy_containers(self):
+        for key, value in self._obj.items():
+            if key == 'list':
+                value.append(3)
+        self.assertEqual(self._table['list'], [1, 2])
+
+    def test_setitem_does_not_change_table(self):
+        self._obj['foo'] = 'baz'
+        self.assertEqual(self._table['foo'], 'bar')
+
+    def test_update_does_not_change_table(self):
+        self._obj.update({'list': [3]}, foo='baz')
+        self.assertEqual(self._obj['list'], [3])
+        self.assertEqual(self._table, {'foo': 'bar', 'list': [1, 2],
+                                       'dict': {'a': 1}})
+
+    def test_copy_does_not_share_changes(self):
+        value = self._obj.copy()
+        self.assertIsInstance(value, data.Headers)
+        value['list'].append(3)
+        self.assertEqual(self._obj['list'], [1, 2])
+        self.assertEqual(self._table['list'], [1, 2])
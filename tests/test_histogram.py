@@ -0,0 +1,96 @@
+"""Tests for rejected.histogram"""
+import sys
+# Import unittest if 2.7, unittest2 if other version
+if (sys.version_info[0], sys.version_info[1]) == (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+
+from rejected import histogram
+
+
+class TestBuckets(unittest.TestCase):
+
+    def test_linear_buckets(self):
+        for value in range(0, 64):
+            self.assertEqual(histogram.bucket_index(value), value)
+
+    def test_bucket_value_covers_value(self):
+        for value in range(0, 100000, 7):
+            index = histogram.bucket_index(value)
+            self.assertGreaterEqual(histogram.bucket_value(index), value)
+            self.assertLess(histogram.bucket_value(index - 1), value)
+
+    def test_relative_error(self):
+        for value in [100, 12345, 999999, 3600000000]:
+            index = histogram.bucket_index(value)
+            error = (histogram.bucket_value(index) - value) / float(value)
+            self.assertLess(error, 0.032)
+
+
+class TestHistogram(unittest.TestCase):
+
+    def setUp(self):
+        self._obj = histogram.Histogram()
+
+    def test_empty_percentile(self):
+        self.assertEqual(self._obj.percentile(99), 0)
+
+    def test_len(self):
+        self._obj.record(0.1)
+        self._obj.record(0.2)
+        self.assertEqual(len(self._obj), 2)
+
+    def test_percentiles(self):
+        for value in range(1, 1001):
+            self._obj.record(value / 1000.0)
+        self.assertAlmostEqual(self._obj.percentile(50), 0.5, delta=0.016)
+        self.assertAlmostEqual(self._obj.percentile(99), 0.99, delta=0.032)
+        self.assertAlmostEqual(self._obj.percentile(99.9), 0.999, delta=0.032)
+
+    def test_percentile_single_value(self):
+        self._obj.record(0.000010)
+        self.assertEqual(self._obj.percentile(50), 0.000010)
+
+    def test_negative_duration(self):
+        self._obj.record(-1)
+        self.assertEqual(self._obj.counts, {0: 1})
+
+    def test_max_duration(self):
+        self._obj.record(100000)
+        self.assertEqual(list(self._obj.counts),
+                         [histogram.bucket_index(histogram._MAX_VALUE)])
+
+    def test_merge_histogram(self):
+        other = histogram.Histogram()
+        self._obj.record(0.1)
+        other.record(0.1)
+        other.record(0.2)
+        self._obj.merge(other)
+        self.assertEqual(len(self._obj), 3)
+        self.assertEqual(len(other), 2)
+
+    def test_merge_counts(self):
+        self._obj.record(0.1)
+        self._obj.merge(dict(self._obj.counts))
+        self.assertEqual(self._obj.counts.values(), [2])
+
+    def test_total(self):
+        for value in range(1, 1001):
+            self._obj.record(value / 1000.0)
+        self.assertAlmostEqual(self._obj.total(), 500.5, delta=500.5 * 0.016)
+
+    def test_total_linear_buckets(self):
+        self._obj.record(0.000010)
+        self._obj.record(0.000020)
+        self.assertAlmostEqual(self._obj.total(), 0.000030)
+
+    def test_total_empty(self):
+        self.assertEqual(self._obj.total(), 0)
+
+    def test_reset(self):
+        counts = self._obj.counts
+        self._obj.record(0.1)
+        self._obj.reset()
+        self.assertEqual(len(self._obj), 0)
+        self.assertEqual(len(counts), 1)
@@ -0,0 +1,157 @@
+"""Tests for rejected.httpd"""
+import json
+import mock
+import sys
+from tornado import ioloop
+from tornado import testing
+# Import unittest if 2.7, unittest2 if other version
+if (sys.version_info[0], sys.version_info[1]) == (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+
+from rejected import httpd
+
+STATS = {'last_poll': 1000,
+         'counts': {'processed': 100, 'processes': 2},
+         'consumers': {'consumer': {'backlog': None,
+                                    'failed': 1,
+                                    'latency': {
+                                        'processing_duration': {
+                                            'count': 100, 'sum': 2.5,
+                                            'p50': 0.01, 'p99': 0.1,
+                                            'p999': 0.5}},
+                                    'processed': 100,
+                                    'processes': 2,
+                                    'velocity': 12.5}},
+         'process_data': {'consumer': {
+             'consumer_1': {'counts': {'processed': 60,
+                                       'message_velocity': 10.0},
+                            'pid': 1234,
+                            'state': 'Idle'}}}}
+
+
+class TestRendering(unittest.TestCase):
+
+    def test_metric_name(self):
+        self.assertEqual(httpd.metric_name('process', 'failures-until stop'),
+                         'rejected_process_failures_until_stop')
+
+    def test_metric_labels_escaped(self):
+        self.assertEqual(httpd.metric_labels({'b': 'x"y', 'a': 'z\\'}),
+                         '{a="z\\\\",b="x\\"y"}')
+
+    def test_to_json(self):
+        self.assertEqual(json.loads(httpd.to_json(STATS)), STATS)
+
+    def test_to_prometheus_consumer_gauge(self):
+        lines = httpd.to_prometheus(STATS).splitlines()
+        self.assertIn('# TYPE rejected_velocity gauge', lines)
+        self.assertIn('rejected_velocity{consumer="consumer"} 12.5', lines)
+
+    def test_to_prometheus_consumer_counter(self):
+        lines = httpd.to_prometheus(STATS).splitlines()
+        self.assertIn('# TYPE rejected_processed counter', lines)
+        self.assertIn('rejected_processed{consumer="consumer"} 100.0', lines)
+
+    def test_to_prometheus_skips_unknown_values(self):
+        self.assertNotIn('rejected_backlog', httpd.to_prometheus(STATS))
+
+    def test_to_prometheus_latency_summary(self):
+        lines = httpd.to_prometheus(STATS).splitlines()
+        self.assertIn('# TYPE rejected_processing_duration_seconds summary',
+                      lines)
+        self.assertIn('rejected_processing_duration_seconds{consumer='
+                      '"consumer",quantile="0.99"} 0.1', lines)
+        self.assertIn('rejected_processing_duration_seconds_count{consumer='
+                      '"consumer"} 100.0', lines)
+        self.assertIn('rejected_processing_duration_seconds_sum{consumer='
+                      '"consumer"} 2.5', lines)
+
+    def test_to_prometheus_process_counts(self):
+        lines = httpd.to_prometheus(STATS).splitlines()
+        self.assertIn('# TYPE rejected_process_message_velocity gauge', lines)
+        self.assertIn('rejected_process_processed{consumer="consumer",'
+                      'process="consumer_1"} 60.0', lines)
+        self.assertIn('rejected_process_state{consumer="consumer",'
+                      'process="consumer_1",state="Idle"} 1.0', lines)
+
+    def test_to_prometheus_empty(self):
+        self.assertEqual(httpd.to_prometheus({}), '')
+
+
+class TestApplication(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.stats = dict(STATS)
+        self.profile = mock.Mock(return_value=['consumer_1'])
+        return httpd.Application(lambda: self.stats, self.profile)
+
+    def test_stats(self):
+        response = self.fetch('/stats')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.body), STATS)
+
+    def test_root_serves_stats(self):
+        self.assertEqual(json.loads(self.fetch('/').body), STATS)
+
+    def test_metrics(self):
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith(
+            'text/plain'))
+        self.assertIn('rejected_velocity{consumer="consumer"} 12.5',
+                      response.body)
+
+    def test_renders_once_per_poll(self):
+        with mock.patch('rejected.httpd.to_json',
+                        return_value='{}') as renderer:
+            self.fetch('/stats')
+            self.fetch('/stats')
+            self.assertEqual(renderer.call_count, 1)
+            self.stats = dict(STATS, last_poll=1010)
+            self.fetch('/stats')
+            self.assertEqual(renderer.call_count, 2)
+
+    def test_profile(self):
+        response = self.fetch('/profile/consumer?seconds=5', method='POST',
+                              body='')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body),
+                         {'processes': ['consumer_1']})
+        self.profile.assert_called_once_with('consumer', 5.0)
+
+    def test_profile_default_seconds(self):
+        self.fetch('/profile/consumer', method='POST', body='')
+        self.profile.assert_called_once_with('consumer', 0.0)
+
+    def test_profile_invalid_seconds(self):
+        response = self.fetch('/profile/consumer?seconds=a', method='POST',
+                              body='')
+        self.assertEqual(response.code, 400)
+
+    def test_profile_unknown_name(self):
+        self.profile.return_value = []
+        response = self.fetch('/profile/unknown', method='POST', body='')
+        self.assertEqual(response.code, 404)
+
+    def test_profile_not_enabled(self):
+        self._app.profile = None
+        response = self.fetch('/profile/consumer', method='POST', body='')
+        self.assertEqual(response.code, 404)
+
+
+class TestStart(unittest.TestCase):
+
+    def test_listening_fds(self):
+        io_loop = ioloop.IOLoop()
+        server = httpd.start(0, '127.0.0.1', dict, io_loop)
+        try:
+            self.assertEqual(httpd.listening_fds(server),
+                             sorted(sock.fileno()
+                                    for sock in server._sockets.values()))
+            self.assertTrue(httpd.listening_fds(server))
+        finally:
+            server.stop()
+            io_loop.close()
@@ -1,8 +1,14 @@
 """Tests for the MCP"""
 import mock
 import multiprocessing
+import signal
+import socket
 
+from rejected import counters
+from rejected import histogram
 from rejected import mcp
+from rejected import metrics
+from rejected import process
 from . import test_state
 
 class TestMCP(test_state.TestState):
@@ -10,8 +16,7 @@ class TestMCP(test_state.TestState):
     CONFIG = {'poll_interval': 30.0,
               'log_stats': True}
 
-    @mock.patch.object(multiprocessing, 'Queue')
-    def setUp(self, mock_queue_unused):
+    def setUp(self):
         self._obj = mcp.MasterControlProgram(self.CONFIG)
 
     def test_mcp_init_consumers_dict(self):
@@ -23,6 +28,734 @@ class TestMCP(test_state.TestState):
     def test_mcp_init_config(self):
         self.assertEqual(self._obj._config, self.CONFIG)
 
-    def test_mcp_init_queue_initialized(self):
-        self.assertIsInstance(self._obj._stats_queue, mock.MagicMock)
+    def test_mcp_init_stats_address_loopback(self):
+        self.assertEqual(self._obj._stats_address, '127.0.0.1')
 
+    def test_mcp_init_stats_pipes_empty(self):
+        self.assertEqual(self._obj._stats_pipes, {})
+
+
+    def new_snapshot(self, name='consumer_1', counts=None, gauges=None,
+                     histograms=None):
+        return {'name': name,
+                'consumer_name': 'consumer',
+                'pid': 1234,
+                'state': 'Idle',
+                'timestamp': 1000,
+                'counts': counts or {},
+                'gauges': gauges or {},
+                'histograms': histograms or {}}
+
+    def test_collect_results_sums_deltas(self):
+        self._obj._collect_results(self.new_snapshot(counts={'processed': 5}))
+        self._obj._collect_results(self.new_snapshot(counts={'processed': 3}))
+        results = self._obj._last_poll_results['consumer']['consumer_1']
+        self.assertEqual(results['counts']['processed'], 8)
+        self.assertEqual(self._obj._interval_counts['consumer']['processed'],
+                         8)
+
+    def test_collect_results_sets_gauges(self):
+        self._obj._collect_results(self.new_snapshot(gauges={'qos_prefetch':
+                                                             10}))
+        self._obj._collect_results(self.new_snapshot(gauges={'qos_prefetch':
+                                                             20}))
+        results = self._obj._last_poll_results['consumer']['consumer_1']
+        self.assertEqual(results['counts']['qos_prefetch'], 20)
+
+    def test_collect_results_removes_reported_process(self):
+        self._obj._poll_data['processes'] = set(['consumer_1', 'consumer_2'])
+        self._obj._collect_results(self.new_snapshot())
+        self.assertEqual(self._obj._poll_data['processes'],
+                         set(['consumer_2']))
+
+    def test_collect_results_keeps_stats_in_registry(self):
+        self._obj._registry.add('consumer_1', 'consumer', 'conn', mock.Mock())
+        self._obj._collect_results(self.new_snapshot(counts={'processed': 5}))
+        record = self._obj._registry.get('consumer_1')
+        self.assertEqual(record.stats['counts']['processed'], 5)
+
+    def test_calculate_stats_throughput(self):
+        self._obj._consumers['consumer'] = {'connections': {'conn': []}}
+        self._obj._collect_results(self.new_snapshot(counts={'processed': 50}))
+        self._obj._collect_results(self.new_snapshot('consumer_2',
+                                                     {'processed': 50}))
+        self._obj._poll_data['timestamp'] = 1000
+        with mock.patch('time.time', return_value=1010):
+            stats = self._obj._calculate_stats(self._obj._last_poll_results)
+        self.assertEqual(stats['consumers']['consumer']['processed'], 100)
+        self.assertEqual(stats['consumers']['consumer']['throughput'], 10)
+        self.assertEqual(stats['counts']['throughput'], 10)
+        self.assertEqual(self._obj._interval_counts, {})
+
+    def new_stats_pipe(self, name='consumer_1'):
+        reader, writer = multiprocessing.Pipe(False)
+        self._obj._stats_pipes[name] = reader
+        self.addCleanup(reader.close)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_poll_results_check_drains_pipes(self):
+        self._obj._consumers['consumer'] = {'connections': {'conn': []}}
+        writer = self.new_stats_pipe()
+        writer.send(self.new_snapshot(counts={'processed': 1}))
+        writer.send(self.new_snapshot(counts={'processed': 2}))
+        self._obj._log_stats_enabled = False
+        self._obj._poll_results_check()
+        self.assertFalse(self._obj._stats_pipes['consumer_1'].poll())
+        self.assertEqual(self._obj._stats['counts']['processed'], 3)
+
+    def test_drain_stats_pipe_stops_watching_closed_pipe(self):
+        writer = self.new_stats_pipe()
+        writer.close()
+        self._obj._ioloop = mock.Mock()
+        self._obj._drain_stats_pipe('consumer_1')
+        self._obj._ioloop.remove_handler.assert_called_once_with(
+            self._obj._stats_pipes['consumer_1'].fileno())
+
+    def test_poll_does_not_signal_processes(self):
+        self.new_scaling_consumer(2)
+        with mock.patch('os.kill') as kill:
+            with mock.patch.object(mcp.MasterControlProgram,
+                                   '_poll_results_check'):
+                self._obj._poll()
+            self.assertFalse(kill.called)
+        self.assertEqual(self._obj._poll_data['processes'],
+                         set(['consumer_0', 'consumer_1']))
+
+    def test_poll_removes_dead_processes(self):
+        consumer = self.new_scaling_consumer(2)
+        self._obj._process('consumer',
+                           'consumer_1').is_alive.return_value = False
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_poll_results_check'):
+            self._obj._poll()
+        self.assertEqual(self._obj._registry.names('consumer', 'conn'),
+                         ['consumer_0'])
+        self.assertEqual(self._obj._poll_data['processes'],
+                         set(['consumer_0']))
+
+    def new_counter_process(self, name='consumer_1'):
+        child = mock.Mock()
+        child.pid = 1234
+        self._obj._consumers['consumer'] = {'connections': ['conn']}
+        self._obj._registry.add(name, 'consumer', 'conn', child)
+        self._obj._counter_blocks[name] = \
+            counters.CounterBlock(process.Process.COUNTERS)
+        return self._obj._counter_blocks[name]
+
+    def test_new_process_passes_counter_block(self):
+        self._obj._consumers['consumer'] = {'last_proc_num': 0}
+        name, child = self._obj._new_process('consumer', 'conn')
+        self.assertIs(child._counts, self._obj._counter_blocks[name])
+
+    def test_read_counters_collects_deltas(self):
+        block = self.new_counter_process()
+        block[process.Process.PROCESSED] = 10
+        self._obj._read_counters()
+        block[process.Process.PROCESSED] = 25
+        self._obj._read_counters()
+        results = self._obj._last_poll_results['consumer']['consumer_1']
+        self.assertEqual(results['counts'][process.Process.PROCESSED], 25)
+        self.assertEqual(
+            self._obj._interval_counts['consumer'][process.Process.PROCESSED],
+            25)
+        self.assertEqual(results['pid'], 1234)
+
+    def test_read_counters_gauges(self):
+        block = self.new_counter_process()
+        block[process.Process.QOS_PREFETCH] = 10
+        self._obj._read_counters()
+        self._obj._read_counters()
+        results = self._obj._last_poll_results['consumer']['consumer_1']
+        self.assertEqual(results['counts'][process.Process.QOS_PREFETCH], 10)
+
+    def test_read_counters_skips_ack_latency_max(self):
+        block = self.new_counter_process()
+        self._obj._collect_results({'name': 'consumer_1',
+                                    'consumer_name': 'consumer',
+                                    'counts': {},
+                                    'gauges': {
+                                        process.Process.ACK_LATENCY_MAX: 0.5}})
+        block[process.Process.ACK_LATENCY_MAX] = 0
+        self._obj._read_counters()
+        results = self._obj._last_poll_results['consumer']['consumer_1']
+        self.assertEqual(
+            results['counts'][process.Process.ACK_LATENCY_MAX], 0.5)
+
+    def test_remove_process_releases_counter_block(self):
+        self.new_counter_process()
+        self._obj._remove_process('consumer_1')
+        self.assertNotIn('consumer_1', self._obj._counter_blocks)
+
+    def test_remove_process_reads_counters_and_retires_stats(self):
+        block = self.new_counter_process()
+        block[process.Process.PROCESSED] = 10
+        self._obj._read_counters()
+        block[process.Process.PROCESSED] = 15
+        self._obj._remove_process('consumer_1')
+        self.assertEqual(self._obj._last_poll_results['consumer'], {})
+        self.assertEqual(
+            self._obj._interval_counts['consumer'][process.Process.PROCESSED],
+            15)
+        stats = self._obj._calculate_stats(self._obj._last_poll_results)
+        self.assertEqual(stats['consumers']['consumer']['processed'], 15)
+        self.assertEqual(stats['process_data'], {'consumer': {}})
+
+    def test_remove_process_collects_and_closes_stats_pipe(self):
+        self.new_counter_process()
+        writer = self.new_stats_pipe()
+        reader = self._obj._stats_pipes['consumer_1']
+        writer.send(self.new_snapshot(counts={'processed': 1}))
+        self._obj._remove_process('consumer_1')
+        self.assertNotIn('consumer_1', self._obj._stats_pipes)
+        self.assertTrue(reader.closed)
+        self.assertEqual(
+            self._obj._interval_counts['consumer'][process.Process.PROCESSED],
+            1)
+
+    def test_prune_poll_results_retires_removed_processes(self):
+        self.new_counter_process()
+        self._obj._collect_results(self.new_snapshot(counts={'processed': 5}))
+        self._obj._collect_results(self.new_snapshot('consumer_2',
+                                                     counts={'processed': 3}))
+        self._obj._prune_poll_results()
+        self.assertEqual(list(self._obj._last_poll_results['consumer']),
+                         ['consumer_1'])
+        self.assertEqual(self._obj._retired_counts,
+                         {'consumer': {'processed': 3}})
+
+    def test_calculate_stats_latency_percentiles(self):
+        self._obj._consumers['consumer'] = {'connections': {'conn': []}}
+        values = [histogram.Histogram(), histogram.Histogram()]
+        for duration in range(1, 1001):
+            values[duration % 2].record(duration / 1000.0)
+        for offset, name in enumerate(['consumer_1', 'consumer_2']):
+            self._obj._collect_results(
+                self.new_snapshot(name,
+                                  histograms={'queue_wait':
+                                              values[offset].counts}))
+        stats = self._obj._calculate_stats(self._obj._last_poll_results)
+        latency = stats['consumers']['consumer']['latency']['queue_wait']
+        self.assertEqual(latency['count'], 1000)
+        self.assertAlmostEqual(latency['sum'], 500.5, delta=500.5 * 0.016)
+        self.assertAlmostEqual(latency['p50'], 0.5, delta=0.016)
+        self.assertAlmostEqual(latency['p99'], 0.99, delta=0.032)
+        self.assertAlmostEqual(latency['p999'], 0.999, delta=0.032)
+        self.assertEqual(stats['counts']['latency']['queue_wait'], latency)
+        self.assertEqual(self._obj._interval_histograms, {})
+
+    def new_scaling_consumer(self, processes):
+        self._obj._consumers['consumer'] = self._obj._consumer_dict(
+            {'connections': ['conn'], 'queue': 'test', 'min': 1, 'max': 3,
+             'autoscale': True})
+        for offset in range(processes):
+            self._obj._registry.add('consumer_%i' % offset, 'consumer',
+                                    'conn', mock.Mock(pid=1000 + offset))
+        return self._obj._consumers['consumer']
+
+    def test_assign_queue_probe_picks_oldest_process(self):
+        self.new_scaling_consumer(2)
+        self._obj._assign_queue_probe('consumer', 'conn')
+        probe = self._obj._queue_probe('consumer', 'conn')
+        self.assertEqual(probe[process.Process.PROBE_PID], 1000)
+        self.assertEqual(probe[process.Process.PROBE_CONSUMERS], -1)
+
+    def test_remove_process_reassigns_queue_probe(self):
+        self.new_scaling_consumer(2)
+        self._obj._remove_process('consumer_0')
+        probe = self._obj._queue_probe('consumer', 'conn')
+        self.assertEqual(probe[process.Process.PROBE_PID], 1001)
+
+    def test_new_process_shares_queue_probe(self):
+        self._obj._consumers['consumer'] = {'last_proc_num': 0}
+        children = [self._obj._new_process('consumer', 'conn')[1]
+                    for offset in range(2)]
+        self.assertIs(children[0]._queue_probe, children[1]._queue_probe)
+
+    def test_consumer_dict_autoscaler(self):
+        consumer = self.new_scaling_consumer(0)
+        self.assertEqual(consumer['autoscaler'].minimum, 1)
+        self.assertEqual(consumer['autoscaler'].maximum, 3)
+
+    def test_consumer_dict_autoscale_off_by_default(self):
+        consumer = self._obj._consumer_dict({'connections': ['conn'],
+                                             'queue': 'test', 'min': 1,
+                                             'max': 3})
+        self.assertIsNone(consumer['autoscaler'])
+
+    def test_consumer_dict_autoscale_disabled(self):
+        consumer = self._obj._consumer_dict({'connections': ['conn'],
+                                             'queue': 'test',
+                                             'autoscale': False})
+        self.assertIsNone(consumer['autoscaler'])
+
+    def test_calculate_stats_idle_ratio(self):
+        self._obj._consumers['consumer'] = {'connections': {'conn': []}}
+        self._obj._collect_results(
+            self.new_snapshot(counts={'idle_time': 3, 'processing_time': 1}))
+        stats = self._obj._calculate_stats(self._obj._last_poll_results)
+        self.assertEqual(stats['consumers']['consumer']['idle_ratio'], 0.75)
+
+    def test_autoscale_scales_up(self):
+        self.new_scaling_consumer(1)
+        self._obj._stats = {'consumers': {'consumer': {'idle_ratio': 0.0}}}
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_start_process') as start:
+            self._obj._autoscale()
+            start.assert_called_once_with('consumer', 'conn')
+
+    def test_autoscale_scales_down_newest_process(self):
+        consumer = self.new_scaling_consumer(3)
+        consumer['autoscaler'].scale_down_intervals = 1
+        self._obj._stats = {'consumers': {'consumer': {'idle_ratio': 1.0}}}
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_stop_process') as stop:
+            self._obj._autoscale()
+            stop.assert_called_once_with(
+                self._obj._process('consumer', 'consumer_2'))
+
+    def test_scale_up_at_max(self):
+        self.new_scaling_consumer(3)
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_start_process') as start:
+            self._obj._scale_up('consumer')
+            self.assertFalse(start.called)
+
+    def test_scale_down_at_min(self):
+        self.new_scaling_consumer(1)
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_stop_process') as stop:
+            self._obj._scale_down('consumer')
+            self.assertFalse(stop.called)
+
+    def test_calculate_stats_backlog(self):
+        self._obj._consumers['consumer'] = {'connections': ['conn1', 'conn2']}
+        for name, connection in [('consumer_1', 'conn1'),
+                                 ('consumer_2', 'conn1'),
+                                 ('consumer_3', 'conn2')]:
+            self._obj._registry.add(name, 'consumer', connection, mock.Mock())
+        for name, depth in [('consumer_1', 100), ('consumer_2', 90),
+                            ('consumer_3', 50)]:
+            self._obj._collect_results(
+                self.new_snapshot(name, {'processed': 50},
+                                  {process.Process.QUEUE_DEPTH: depth}))
+        self._obj._poll_data['timestamp'] = 1000
+        with mock.patch('time.time', return_value=1010):
+            stats = self._obj._calculate_stats(self._obj._last_poll_results)
+        self.assertEqual(stats['consumers']['consumer']['backlog'], 150)
+        self.assertEqual(stats['consumers']['consumer']['backlog_seconds'], 10)
+
+    def test_calculate_stats_backlog_unknown(self):
+        self._obj._consumers['consumer'] = {
+            'connections': {'conn': ['consumer_1']}}
+        self._obj._collect_results(self.new_snapshot())
+        stats = self._obj._calculate_stats(self._obj._last_poll_results)
+        self.assertIsNone(stats['consumers']['consumer']['backlog'])
+        self.assertIsNone(stats['consumers']['consumer']['backlog_seconds'])
+
+    def test_autoscale_passes_backlog(self):
+        consumer = self.new_scaling_consumer(1)
+        consumer['autoscaler'] = mock.Mock()
+        consumer['autoscaler'].decide.return_value = 0
+        self._obj._stats = {'consumers': {'consumer': {'idle_ratio': 0.5,
+                                                       'backlog': 20}}}
+        self._obj._autoscale()
+        consumer['autoscaler'].decide.assert_called_once_with(1, 0.5, 20)
+
+    def new_exited_consumer(self):
+        consumer = self.new_scaling_consumer(2)
+        self._obj._process('consumer',
+                           'consumer_1').is_alive.return_value = False
+        self._obj._state = self._obj.STATE_ACTIVE
+        self._obj._ioloop = mock.Mock()
+        return consumer
+
+    def test_reap_processes_removes_exited(self):
+        consumer = self.new_exited_consumer()
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_schedule_respawn'):
+            self._obj._reap_processes()
+        self.assertEqual(self._obj._registry.names('consumer', 'conn'),
+                         ['consumer_0'])
+        self.assertEqual(self._obj.total_process_count, 1)
+
+    def test_reap_processes_schedules_respawn(self):
+        self.new_exited_consumer()
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_schedule_respawn') as respawn:
+            self._obj._reap_processes()
+            respawn.assert_called_once_with('consumer')
+
+    def test_reap_processes_no_respawn_when_stopping(self):
+        self.new_exited_consumer()
+        self._obj._state = self._obj.STATE_SHUTTING_DOWN
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_schedule_respawn') as respawn:
+            self._obj._reap_processes()
+            self.assertFalse(respawn.called)
+
+    def test_schedule_respawn_immediately(self):
+        self.new_scaling_consumer(0)
+        self._obj._state = self._obj.STATE_ACTIVE
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_check_consumer_process_counts') as check:
+            self._obj._schedule_respawn('consumer')
+            check.assert_called_once_with()
+
+    def test_schedule_respawn_backs_off(self):
+        consumer = self.new_scaling_consumer(0)
+        self._obj._ioloop = mock.Mock()
+        with mock.patch('time.time', return_value=1000):
+            consumer['last_respawn'] = 995
+            self._obj._schedule_respawn('consumer')
+            self._obj._schedule_respawn('consumer')
+        check = self._obj._check_consumer_process_counts
+        self.assertEqual(self._obj._ioloop.call_later.call_args_list,
+                         [mock.call(1, check), mock.call(2, check)])
+
+    def test_schedule_respawn_delay_capped_at_poll_interval(self):
+        consumer = self.new_scaling_consumer(0)
+        consumer['respawn_delay'] = 20
+        self._obj._ioloop = mock.Mock()
+        with mock.patch('time.time', return_value=1000):
+            consumer['last_respawn'] = 1000
+            self._obj._schedule_respawn('consumer')
+        self.assertEqual(consumer['respawn_delay'], 30)
+
+    def test_schedule_respawn_at_min(self):
+        self.new_scaling_consumer(1)
+        self._obj._ioloop = mock.Mock()
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_check_consumer_process_counts') as check:
+            self._obj._schedule_respawn('consumer')
+            self.assertFalse(check.called)
+        self.assertFalse(self._obj._ioloop.call_later.called)
+
+    def test_set_state_stopped_stops_ioloop(self):
+        self._obj._ioloop = mock.Mock()
+        self._obj._set_state(self._obj.STATE_STOPPED)
+        self._obj._ioloop.add_callback_from_signal.assert_called_once_with(
+            self._obj._ioloop.stop)
+
+    def test_on_stats_pipe_ready_drains_pipe(self):
+        writer = self.new_stats_pipe()
+        writer.send(self.new_snapshot(counts={'processed': 1}))
+        self._obj._on_stats_pipe_ready('consumer_1', 10, 1)
+        self.assertFalse(self._obj._stats_pipes['consumer_1'].poll())
+        results = self._obj._last_poll_results['consumer']['consumer_1']
+        self.assertEqual(results['counts']['processed'], 1)
+
+    def test_stop_timers_stops_poll_timer(self):
+        timer = mock.Mock()
+        self._obj._poll_timer = timer
+        self._obj._stop_timers()
+        timer.stop.assert_called_once_with()
+        self.assertIsNone(self._obj._poll_timer)
+
+    def test_start_process_registers_process(self):
+        self.new_scaling_consumer(0)
+        with mock.patch.object(process.Process, 'start'):
+            with mock.patch.object(process.Process, 'pid', 4321):
+                self._obj._start_process('consumer', 'conn')
+        record = self._obj._registry.by_pid(4321)
+        self.assertEqual(record.name, 'consumer_1')
+        self.assertEqual(self._obj._process_count('consumer', 'conn'), 1)
+
+    def test_start_process_watches_stats_pipe(self):
+        self.new_scaling_consumer(0)
+        self._obj._ioloop = mock.Mock()
+        with mock.patch.object(process.Process, 'start'):
+            with mock.patch.object(process.Process, 'pid', 4321):
+                self._obj._start_process('consumer', 'conn')
+        reader = self._obj._stats_pipes['consumer_1']
+        self.addCleanup(reader.close)
+        self.assertEqual(self._obj._stats_writers, {})
+        self.assertEqual(self._obj._ioloop.add_handler.call_args[0][0],
+                         reader.fileno())
+
+    def test_reap_processes_counts_restarts(self):
+        self.new_exited_consumer()
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_schedule_respawn'):
+            self._obj._reap_processes()
+        record = self._obj._registry.add('consumer_2', 'consumer', 'conn',
+                                         mock.Mock())
+        self.assertEqual(record.restarts, 1)
+
+    def test_reap_processes_retired_is_not_a_restart(self):
+        self.new_exited_consumer()
+        self._obj._registry.get('consumer_1').retiring = True
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_schedule_respawn') as respawn:
+            self._obj._reap_processes()
+            self.assertFalse(respawn.called)
+        record = self._obj._registry.add('consumer_2', 'consumer', 'conn',
+                                         mock.Mock())
+        self.assertEqual(record.restarts, 0)
+
+    def test_scale_down_marks_process_retiring(self):
+        self.new_scaling_consumer(2)
+        with mock.patch.object(mcp.MasterControlProgram, '_stop_process'):
+            self._obj._scale_down('consumer')
+        self.assertTrue(self._obj._registry.get('consumer_1').retiring)
+
+    def test_preload_consumer_imports_module(self):
+        with mock.patch('rejected.process.import_namespaced_class') as load:
+            self._obj._preload_consumer('consumer',
+                                        {'consumer': 'rejected.example.Test',
+                                         'preload': True})
+            load.assert_called_once_with('rejected.example.Test')
+
+    def test_preload_consumer_disabled(self):
+        with mock.patch('rejected.process.import_namespaced_class') as load:
+            self._obj._preload_consumer('consumer',
+                                        {'consumer': 'rejected.example.Test',
+                                         'preload': False})
+            self.assertFalse(load.called)
+
+    def test_preload_consumer_disabled_by_default(self):
+        with mock.patch('rejected.process.import_namespaced_class') as load:
+            self._obj._preload_consumer('consumer',
+                                        {'consumer': 'rejected.example.Test'})
+            self.assertFalse(load.called)
+
+    def test_preload_consumer_import_error(self):
+        self._obj._preload_consumer('consumer',
+                                    {'consumer': 'rejected.missing.Consumer',
+                                     'preload': True})
+
+    def test_calculate_stats_spawn_latency(self):
+        self._obj._consumers['consumer'] = {'connections': ['conn']}
+        for name, latency in [('consumer_1', 0.5), ('consumer_2', 1.5),
+                              ('consumer_3', 0)]:
+            self._obj._collect_results(
+                self.new_snapshot(name, gauges={
+                    process.Process.SPAWN_LATENCY: latency}))
+        stats = self._obj._calculate_stats(self._obj._last_poll_results)
+        self.assertEqual(stats['consumers']['consumer']['spawn_latency'], 1.5)
+
+    def new_spare_consumer(self, processes, spares):
+        consumer = self.new_scaling_consumer(processes)
+        consumer['spares'] = spares
+        for offset in range(spares):
+            child = mock.Mock()
+            child.pid = 2000 + offset
+            self._obj._registry.add('spare_%i' % offset, 'consumer', 'conn',
+                                    child, True)
+            self._obj._ready_flags['spare_%i' % offset] = mock.Mock(value=1)
+        return consumer
+
+    def test_add_process_activates_spare(self):
+        self.new_spare_consumer(1, 1)
+        with mock.patch('os.kill') as kill:
+            with mock.patch.object(mcp.MasterControlProgram,
+                                   '_start_process') as start:
+                self._obj._add_process('consumer', 'conn')
+                self.assertFalse(start.called)
+            kill.assert_called_once_with(2000, signal.SIGUSR1)
+        self.assertEqual(self._obj._registry.names('consumer', 'conn'),
+                         ['consumer_0', 'spare_0'])
+        self.assertEqual(self._obj._registry.spares('consumer', 'conn'), [])
+
+    def test_add_process_skips_dead_spare(self):
+        self.new_spare_consumer(1, 1)
+        self._obj._process('consumer',
+                           'spare_0').is_alive.return_value = False
+        with mock.patch('os.kill') as kill:
+            with mock.patch.object(mcp.MasterControlProgram,
+                                   '_start_process') as start:
+                self._obj._add_process('consumer', 'conn')
+                start.assert_called_once_with('consumer', 'conn')
+            self.assertFalse(kill.called)
+
+    def test_add_process_skips_spare_that_is_not_ready(self):
+        self.new_spare_consumer(1, 1)
+        self._obj._ready_flags['spare_0'].value = 0
+        with mock.patch('os.kill') as kill:
+            with mock.patch.object(mcp.MasterControlProgram,
+                                   '_start_process') as start:
+                self._obj._add_process('consumer', 'conn')
+                start.assert_called_once_with('consumer', 'conn')
+            self.assertFalse(kill.called)
+        self.assertEqual(self._obj._registry.spares('consumer', 'conn'),
+                         ['spare_0'])
+
+    def test_new_process_passes_listening_fds(self):
+        self._obj._consumers['consumer'] = {'last_proc_num': 0}
+        self._obj._http_server = mock.Mock(_sockets={9: mock.Mock()})
+        child = self._obj._new_process('consumer', 'conn')[1]
+        self.assertEqual(child._kwargs['listening_fds'], [9])
+
+    def test_new_process_without_http_server(self):
+        self._obj._consumers['consumer'] = {'last_proc_num': 0}
+        child = self._obj._new_process('consumer', 'conn')[1]
+        self.assertEqual(child._kwargs['listening_fds'], [])
+
+    def test_new_process_shares_ready_flag(self):
+        self._obj._consumers['consumer'] = {'last_proc_num': 0}
+        name, child = self._obj._new_process('consumer', 'conn')
+        self.assertIs(child._ready, self._obj._ready_flags[name])
+        self.assertFalse(self._obj._is_ready(name))
+
+    def test_scale_up_activates_spare(self):
+        self.new_spare_consumer(1, 1)
+        with mock.patch('os.kill') as kill:
+            self._obj._scale_up('consumer')
+            kill.assert_called_once_with(2000, signal.SIGUSR1)
+
+    def test_spare_spawn_qty(self):
+        self.new_spare_consumer(1, 0)
+        self.assertEqual(self._obj._spare_spawn_qty('consumer', 'conn'), 0)
+        self._obj._consumers['consumer']['spares'] = 1
+        self.assertEqual(self._obj._spare_spawn_qty('consumer', 'conn'), 1)
+
+    def test_spare_spawn_qty_limited_by_max(self):
+        self.new_spare_consumer(2, 1)
+        self._obj._consumers['consumer']['spares'] = 2
+        self.assertEqual(self._obj._spare_spawn_qty('consumer', 'conn'), 0)
+
+    def test_check_consumer_process_counts_starts_spares(self):
+        self.new_spare_consumer(1, 0)
+        self._obj._consumers['consumer']['spares'] = 1
+        self._obj._state = self._obj.STATE_ACTIVE
+        with mock.patch.object(mcp.MasterControlProgram,
+                               '_start_process') as start:
+            self._obj._check_consumer_process_counts()
+            start.assert_called_once_with('consumer', 'conn', True)
+
+    def test_check_consumer_process_counts_activates_spare(self):
+        self.new_spare_consumer(0, 1)
+        self._obj._state = self._obj.STATE_ACTIVE
+        with mock.patch('os.kill') as kill:
+            with mock.patch.object(mcp.MasterControlProgram,
+                                   '_start_process') as start:
+                self._obj._check_consumer_process_counts()
+                start.assert_called_once_with('consumer', 'conn', True)
+            kill.assert_called_once_with(2000, signal.SIGUSR1)
+
+    def test_calculate_stats_spares(self):
+        self.new_spare_consumer(1, 2)
+        self._obj._collect_results(self.new_snapshot())
+        stats = self._obj._calculate_stats(self._obj._last_poll_results)
+        self.assertEqual(stats['consumers']['consumer']['processes'], 1)
+        self.assertEqual(stats['consumers']['consumer']['spares'], 2)
+        self.assertEqual(stats['counts']['processes'], 1)
+        self.assertEqual(stats['counts']['spares'], 2)
+
+    def test_calculate_stats_velocity(self):
+        self._obj._consumers['consumer'] = {'connections': ['conn']}
+        self._obj._collect_results(
+            self.new_snapshot(counts={'processed': 10, 'idle_time': 1,
+                                      'processing_time': 4}))
+        stats = self._obj._calculate_stats(self._obj._last_poll_results)
+        self.assertEqual(stats['consumers']['consumer']['velocity'], 2)
+        self.assertEqual(stats['counts']['velocity'], 2)
+
+    def test_stats_property(self):
+        self._obj._stats = {'last_poll': 1000}
+        self.assertIs(self._obj.stats, self._obj._stats)
+
+    def test_start_http_server_disabled(self):
+        with mock.patch('rejected.httpd.start') as start:
+            self._obj._start_http_server()
+            self.assertFalse(start.called)
+
+    def test_start_http_server(self):
+        self._obj._stats_port = 8000
+        self._obj._ioloop = mock.Mock()
+        with mock.patch('rejected.httpd.start') as start:
+            self._obj._start_http_server()
+            args = start.call_args[0]
+            self.assertEqual(args[:2], (8000, '127.0.0.1'))
+            self.assertIs(args[3], self._obj._ioloop)
+            self._obj._stats = {'last_poll': 1000}
+            self.assertIs(args[2](), self._obj._stats)
+        self.assertIs(self._obj._http_server, start.return_value)
+
+    def test_start_http_server_error(self):
+        self._obj._stats_port = 8000
+        with mock.patch('rejected.httpd.start',
+                        side_effect=socket.error('in use')):
+            self._obj._start_http_server()
+        self.assertIsNone(self._obj._http_server)
+
+    def test_stop_timers_stops_http_server(self):
+        server = mock.Mock()
+        self._obj._http_server = server
+        self._obj._stop_timers()
+        server.stop.assert_called_once_with()
+        self.assertIsNone(self._obj._http_server)
+
+    def test_start_metrics_disabled(self):
+        self._obj._start_metrics()
+        self.assertIsNone(self._obj._metrics)
+
+    def test_start_metrics(self):
+        self._obj._config = dict(self.CONFIG, metrics={'host': 'localhost'})
+        self._obj._start_metrics()
+        self.assertIsInstance(self._obj._metrics, metrics.StatsEmitter)
+
+    def test_start_metrics_invalid_protocol(self):
+        self._obj._config = dict(self.CONFIG, metrics={'host': 'localhost',
+                                                       'protocol': 'influxdb'})
+        self._obj._start_metrics()
+        self.assertIsNone(self._obj._metrics)
+
+    def test_poll_results_check_emits_metrics(self):
+        self._obj._log_stats_enabled = False
+        self._obj._metrics = mock.Mock()
+        self._obj._poll_results_check()
+        self._obj._metrics.emit.assert_called_once_with(self._obj._stats)
+
+    def new_profiling_consumer(self, processes, spares=0):
+        self.new_spare_consumer(processes, spares)
+        for offset in range(processes):
+            name = 'consumer_%i' % offset
+            self._obj._process('consumer', name).pid = 1000 + offset
+            self._obj._profile_requests[name] = mock.Mock(value=0)
+            self._obj._ready_flags[name] = mock.Mock(value=1)
+
+    def test_new_process_shares_profile_seconds(self):
+        self._obj._consumers['consumer'] = {'last_proc_num': 0}
+        with mock.patch('rejected.process.Process') as new_process:
+            name, _unused = self._obj._new_process('consumer', 'conn')
+        self.assertIs(new_process.call_args[1]['kwargs']['profile_seconds'],
+                      self._obj._profile_requests[name])
+
+    def test_profile_signals_consumer_processes(self):
+        self.new_profiling_consumer(2, 1)
+        with mock.patch('os.kill') as kill:
+            self.assertEqual(self._obj.profile('consumer', 10),
+                             ['consumer_0', 'consumer_1'])
+            kill.assert_has_calls([mock.call(1000, signal.SIGUSR2),
+                                   mock.call(1001, signal.SIGUSR2)],
+                                  any_order=True)
+            self.assertEqual(kill.call_count, 2)
+        self.assertEqual(self._obj._profile_requests['consumer_0'].value, 10)
+
+    def test_profile_signals_process(self):
+        self.new_profiling_consumer(2)
+        with mock.patch('os.kill') as kill:
+            self.assertEqual(self._obj.profile('consumer_1'), ['consumer_1'])
+            kill.assert_called_once_with(1001, signal.SIGUSR2)
+        self.assertEqual(self._obj._profile_requests['consumer_1'].value, 0)
+
+    def test_profile_skips_processes_that_are_not_ready(self):
+        self.new_profiling_consumer(2)
+        self._obj._ready_flags['consumer_0'].value = 0
+        with mock.patch('os.kill') as kill:
+            self.assertEqual(self._obj.profile('consumer', 10),
+                             ['consumer_1'])
+            kill.assert_called_once_with(1001, signal.SIGUSR2)
+        self.assertEqual(self._obj._profile_requests['consumer_0'].value, 0)
+
+    def test_profile_unknown_name(self):
+        self.new_profiling_consumer(1)
+        with mock.patch('os.kill') as kill:
+            self.assertEqual(self._obj.profile('unknown'), [])
+            self.assertFalse(kill.called)
+
+    def test_profile_process_exited(self):
+        self.new_profiling_consumer(1)
+        with mock.patch('os.kill', side_effect=OSError(3, 'No such process')):
+            self.assertEqual(self._obj.profile('consumer'), [])
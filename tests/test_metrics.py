@@ -0,0 +1,207 @@
+"""Tests for rejected.metrics against a local UDP listener"""
+import mock
+import socket
+import sys
+# Import unittest if 2.7, unittest2 if other version
+if (sys.version_info[0], sys.version_info[1]) == (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+
+from rejected import counters
+from rejected import metrics
+
+
+class UDPListenerTestCase(unittest.TestCase):
+
+    PROTOCOL = metrics.STATSD
+
+    def setUp(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.settimeout(1)
+        self._obj = metrics.Emitter('127.0.0.1',
+                                    self._listener.getsockname()[1],
+                                    'test', self.PROTOCOL, 64)
+
+    def tearDown(self):
+        self._obj.close()
+        self._listener.close()
+
+    def receive(self):
+        return self._listener.recv(65536).split('\n')
+
+
+class TestStatsDEmitter(UDPListenerTestCase):
+
+    def test_counter(self):
+        self._obj.counter('consumer.processed', 5)
+        self._obj.flush()
+        self.assertEqual(self.receive(), ['test.consumer.processed:5|c'])
+
+    def test_gauge(self):
+        self._obj.gauge('consumer.processes', 2)
+        self._obj.flush()
+        self.assertEqual(self.receive(), ['test.consumer.processes:2|g'])
+
+    def test_timing_in_milliseconds(self):
+        self._obj.timing('consumer.duration', 0.25)
+        self._obj.flush()
+        self.assertEqual(self.receive(), ['test.consumer.duration:250.0|ms'])
+
+    def test_metrics_are_batched(self):
+        self._obj.counter('a', 1)
+        self._obj.counter('b', 2)
+        self._obj.flush()
+        self.assertEqual(self.receive(), ['test.a:1|c', 'test.b:2|c'])
+
+    def test_nothing_sent_until_flush(self):
+        self._obj.counter('a', 1)
+        self._listener.settimeout(0.05)
+        self.assertRaises(socket.timeout, self.receive)
+
+    def test_full_packet_is_sent(self):
+        for offset in range(5):
+            self._obj.counter('consumer.processed_%i' % offset, offset)
+        self.assertEqual(self.receive(), ['test.consumer.processed_0:0|c',
+                                          'test.consumer.processed_1:1|c'])
+        self.assertEqual(self.receive(), ['test.consumer.processed_2:2|c',
+                                          'test.consumer.processed_3:3|c'])
+        self._obj.flush()
+        self.assertEqual(self.receive(), ['test.consumer.processed_4:4|c'])
+
+    def test_flush_empty(self):
+        with mock.patch.object(self._obj._socket, 'sendto') as sendto:
+            self._obj.flush()
+            self.assertFalse(sendto.called)
+
+    def test_flush_does_not_resolve_host(self):
+        self._obj.counter('a', 1)
+        with mock.patch('socket.getaddrinfo') as getaddrinfo:
+            self._obj.flush()
+            self.assertFalse(getaddrinfo.called)
+        self.assertEqual(self.receive(), ['test.a:1|c'])
+
+    def test_send_error_resolves_host_again(self):
+        with mock.patch.object(self._obj._socket, 'sendto',
+                               side_effect=socket.error(111, 'refused')):
+            self._obj.counter('a', 1)
+            self._obj.flush()
+        self.assertIsNone(self._obj._address)
+        self._obj.counter('b', 1)
+        self._obj.flush()
+        self.assertEqual(self.receive(), ['test.b:1|c'])
+
+    def test_unresolved_host_drops_metrics(self):
+        with mock.patch('socket.getaddrinfo',
+                        side_effect=socket.gaierror(-2, 'unknown')):
+            emitter = metrics.Emitter('collector.invalid')
+            emitter.counter('a', 1)
+            with mock.patch.object(emitter._socket, 'sendto') as sendto:
+                emitter.flush()
+                self.assertFalse(sendto.called)
+        self.assertIsNone(emitter._address)
+        emitter._socket.close()
+
+    def test_send_error_drops_metrics(self):
+        with mock.patch.object(self._obj._socket, 'sendto',
+                               side_effect=socket.error(111, 'refused')):
+            self._obj.counter('a', 1)
+            self._obj.flush()
+        self.assertEqual(self._obj._buffer, [])
+
+    def test_socket_is_non_blocking(self):
+        self.assertEqual(self._obj._socket.gettimeout(), 0.0)
+
+
+class TestGraphiteEmitter(UDPListenerTestCase):
+
+    PROTOCOL = metrics.GRAPHITE
+
+    def test_gauge(self):
+        with mock.patch('time.time', return_value=1000):
+            self._obj.gauge('consumer.processes', 2)
+        self._obj.flush()
+        self.assertEqual(self.receive(), ['test.consumer.processes 2 1000'])
+
+    def test_timing_in_seconds(self):
+        with mock.patch('time.time', return_value=1000):
+            self._obj.timing('consumer.duration', 0.25)
+        self._obj.flush()
+        self.assertEqual(self.receive(), ['test.consumer.duration 0.25 1000'])
+
+
+class TestStatsEmitter(UDPListenerTestCase):
+
+    def setUp(self):
+        super(TestStatsEmitter, self).setUp()
+        self._obj._max_packet = 65536
+        self._stats = metrics.StatsEmitter(self._obj, ['message_velocity'])
+
+    def test_consumer_gauges_shared_with_httpd(self):
+        self.assertIs(metrics.StatsEmitter.CONSUMER_GAUGES,
+                      counters.CONSUMER_GAUGES)
+
+    def new_stats(self, processed):
+        return {'consumers': {'consumer': {'backlog': None,
+                                           'latency': {'queue_wait': {
+                                               'count': 1, 'p50': 0.5,
+                                               'p99': 0.5, 'p999': 0.5}},
+                                           'processes': 2}},
+                'process_data': {'consumer': {
+                    'consumer_1': {'counts': {'processed': processed,
+                                              'message_velocity': 2.5}},
+                    'consumer_2': {'counts': {'processed': 3}}}}}
+
+    def test_emit(self):
+        self._stats.emit(self.new_stats(10))
+        lines = self.receive()
+        for line in ['test.consumer.consumer_1.processed:10|c',
+                     'test.consumer.consumer_1.message_velocity:2.5|g',
+                     'test.consumer.consumer_2.processed:3|c',
+                     'test.consumer.processed:13|c',
+                     'test.consumer.processes:2|g',
+                     'test.consumer.queue_wait.p99:0.5|g']:
+            self.assertIn(line, lines)
+        self.assertNotIn('backlog', '\n'.join(lines))
+
+    def test_emit_sends_counter_deltas(self):
+        self._stats.emit(self.new_stats(10))
+        self.receive()
+        self._stats.emit(self.new_stats(15))
+        lines = self.receive()
+        self.assertIn('test.consumer.consumer_1.processed:5|c', lines)
+        self.assertIn('test.consumer.processed:5|c', lines)
+        self.assertNotIn('test.consumer.consumer_2.processed:0|c', lines)
+
+    def test_emit_forgets_removed_processes(self):
+        self._stats.emit(self.new_stats(10))
+        self.receive()
+        stats = self.new_stats(15)
+        del stats['process_data']['consumer']['consumer_2']
+        self._stats.emit(stats)
+        self.receive()
+        self.assertEqual(sorted(self._stats._last),
+                         ['consumer.consumer_1.processed'])
+
+
+class TestFromConfig(unittest.TestCase):
+
+    def test_not_configured(self):
+        self.assertIsNone(metrics.from_config(None))
+        self.assertIsNone(metrics.from_config({'direct': True}))
+
+    def test_default_ports(self):
+        emitter = metrics.from_config({'host': '127.0.0.1'})
+        self.assertEqual(emitter._address, ('127.0.0.1', 8125))
+        emitter = metrics.from_config({'host': '127.0.0.1',
+                                       'protocol': 'graphite'})
+        self.assertEqual(emitter._address, ('127.0.0.1', 2003))
+
+    def test_invalid_protocol(self):
+        self.assertRaises(ValueError, metrics.from_config,
+                          {'host': 'localhost', 'protocol': 'influxdb'})
+
+    def test_metric_name(self):
+        self.assertEqual(metrics.metric_name('my.consumer', 'a b:c'),
+                         'my_consumer.a_b_c')
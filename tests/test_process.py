@@ -1,22 +1,32 @@
 """Tests for rejected.process"""
 import copy
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 import mock
+import os
 from pika import channel
 from pika import connection
 from pika import credentials
 from pika import exceptions
 import signal
 import sys
+from tornado import concurrent
 # Import unittest if 2.7, unittest2 if other version
 if (sys.version_info[0], sys.version_info[1]) == (2, 7):
     import unittest
 else:
     import unittest2 as unittest
 
+from rejected import brokers
 from rejected import consumer
+from rejected import counters
+from rejected import data
 from rejected import process
 from rejected import __version__
 
+from . import mocks
 from . import test_state
 
 class TestImportNamspacedClass(unittest.TestCase):
@@ -82,7 +92,7 @@ class TestProcess(test_state.TestState):
     mock_args = {'config': config,
                  'connection_name': 'MockConnection',
                  'consumer_name': 'MockConsumer',
-                 'stats_queue': 'StatsQueue'}
+                 'stats_pipe': 'StatsPipe'}
 
     def setUp(self):
         self._obj = self.new_process()
@@ -420,15 +430,15 @@ class TestProcess(test_state.TestState):
                 'Callback for %i was not %r' % (args[0], args[1])
         self.mock_setup(new_process, side_effect)
 
-    def test_setup_stats_queue(self):
+    def test_setup_stats_pipe(self):
         mock_process = self.mock_setup()
-        self.assertEqual(mock_process._stats_queue,
-                         self.mock_args['stats_queue'])
+        self.assertEqual(mock_process._stats_pipe,
+                         self.mock_args['stats_pipe'])
 
     def test_setup_consumer_name(self):
         mock_process = self.mock_setup()
-        self.assertEqual(mock_process._stats_queue,
-                         self.mock_args['stats_queue'])
+        self.assertEqual(mock_process._stats_pipe,
+                         self.mock_args['stats_pipe'])
 
     def test_setup_config(self):
         mock_process = self.mock_setup()
@@ -513,3 +523,1109 @@ class TestProcess(test_state.TestState):
         self._obj._state = self._obj.STATE_PROCESSING
         self.assertEqual(self._obj.state_description,
                          self._obj._STATES[self._obj.STATE_PROCESSING])
+
+    def test_ack_message_without_batching(self):
+        self._obj._channel = self.new_mock_channel()
+        self._obj.ack_message(10)
+        self._obj._channel.basic_ack.assert_called_once_with(delivery_tag=10)
+
+    def test_ack_message_with_batching_buffers_tag(self):
+        self._obj._ack_batch_size = 3
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        self._obj.ack_message(10)
+        self.assertFalse(self._obj._channel.basic_ack.called)
+        self.assertEqual(len(self._obj._pending_acks), 1)
+
+    def test_ack_message_with_batching_adds_timeout(self):
+        self._obj._ack_batch_size = 3
+        self._obj._ack_batch_timeout = 250
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        self._obj.ack_message(10)
+        self._obj._connection.add_timeout.assert_called_once_with(
+            0.25, self._obj.on_ack_timeout)
+
+    def test_ack_message_with_batching_flushes_when_full(self):
+        self._obj._ack_batch_size = 3
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        for delivery_tag in [1, 2, 3]:
+            self._obj.ack_message(delivery_tag)
+        self._obj._channel.basic_ack.assert_called_once_with(delivery_tag=3,
+                                                             multiple=True)
+        self.assertEqual(self._obj._pending_acks, [])
+
+    def test_flush_acks_counts(self):
+        self._obj._ack_batch_size = 10
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        for delivery_tag in [1, 2, 3, 4]:
+            self._obj.ack_message(delivery_tag)
+        self._obj.flush_acks()
+        self.assertEqual(self._obj._counts[process.Process.ACKED], 4)
+        self.assertEqual(self._obj._counts[process.Process.ACK_FRAMES_SAVED], 3)
+
+    def test_flush_acks_ack_latency_max(self):
+        self._obj._ack_batch_size = 10
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        with mock.patch('time.time', return_value=100):
+            self._obj.ack_message(1)
+        with mock.patch('time.time', return_value=100.5):
+            self._obj.flush_acks()
+        self.assertEqual(self._obj._counts[process.Process.ACK_LATENCY_MAX],
+                         0.5)
+
+    def test_flush_acks_with_closed_channel_discards_tags(self):
+        self._obj._ack_batch_size = 10
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        self._obj.ack_message(1)
+        self._obj._channel.is_open = False
+        self._obj.flush_acks()
+        self.assertFalse(self._obj._channel.basic_ack.called)
+        self.assertEqual(self._obj._pending_acks, [])
+
+    def test_reject_flushes_pending_acks(self):
+        self._obj._ack_batch_size = 10
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        self._obj.ack_message(1)
+        self._obj.reject(2, True)
+        self.assertEqual(self._obj._channel.method_calls[:2],
+                         [mock.call.basic_ack(delivery_tag=1, multiple=True),
+                          mock.call.basic_nack(delivery_tag=2, requeue=True)])
+
+    def test_cancel_consumer_flushes_pending_acks(self):
+        self._obj._ack_batch_size = 10
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        self._obj.ack_message(1)
+        self._obj.cancel_consumer_with_rabbitmq()
+        self._obj._channel.basic_ack.assert_called_once_with(delivery_tag=1,
+                                                             multiple=True)
+
+    def new_message(self, delivery_tag=1):
+        method = mocks.MockMethod()
+        method.delivery_tag = delivery_tag
+        return method
+
+    def test_can_process_when_idle(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self.assertTrue(self._obj.can_process)
+
+    def test_can_process_below_max_concurrency(self):
+        self._obj._state = self._obj.STATE_PROCESSING
+        self._obj._max_concurrency = 2
+        self._obj._deliveries = {1: 0}
+        self.assertTrue(self._obj.can_process)
+
+    def test_can_process_at_max_concurrency(self):
+        self._obj._state = self._obj.STATE_PROCESSING
+        self._obj._max_concurrency = 2
+        self._obj._deliveries = {1: 0, 2: 0}
+        self.assertFalse(self._obj.can_process)
+
+    def test_can_process_when_stop_requested(self):
+        self._obj._state = self._obj.STATE_STOP_REQUESTED
+        self._obj._max_concurrency = 2
+        self.assertFalse(self._obj.can_process)
+
+    def test_process_buffers_when_at_max_concurrency(self):
+        self._obj._state = self._obj.STATE_PROCESSING
+        self._obj._deliveries = {1: 0}
+        self._obj._channel = self.new_mock_channel()
+        self._obj.process(None, self.new_message(2), mocks.MockHeader(), '')
+        self.assertFalse(self._obj._channel.basic_nack.called)
+        self.assertEqual([value[1].delivery_tag
+                          for value in self._obj._buffered], [2])
+        self.assertEqual(list(self._obj._deliveries), [1])
+
+    def test_process_rejects_when_stop_requested(self):
+        self._obj._state = self._obj.STATE_STOP_REQUESTED
+        self._obj._deliveries = {1: 0}
+        self._obj._channel = self.new_mock_channel()
+        self._obj.process(None, self.new_message(2), mocks.MockHeader(), '')
+        self._obj._channel.basic_nack.assert_called_once_with(delivery_tag=2,
+                                                              requeue=True)
+        self.assertFalse(self._obj._buffered)
+
+    def test_process_sync_acks_and_resets_state(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._consumer = mock.Mock(consumer.Consumer)
+        self._obj._consumer.process.return_value = None
+        self._obj._channel = self.new_mock_channel()
+        self._obj.process(None, self.new_message(1), mocks.MockHeader(), '')
+        self._obj._channel.basic_ack.assert_called_once_with(delivery_tag=1)
+        self.assertTrue(self._obj.is_idle)
+        self.assertEqual(self._obj._deliveries, {})
+
+    def process_async(self, delivery_tags):
+        futures = dict()
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._max_concurrency = len(delivery_tags)
+        self._obj._consumer = mock.Mock(consumer.Consumer)
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        self._obj._connection.ioloop = mock.Mock()
+        for delivery_tag in delivery_tags:
+            futures[delivery_tag] = concurrent.Future()
+            self._obj._consumer.process.return_value = futures[delivery_tag]
+            self._obj.process(None, self.new_message(delivery_tag),
+                              mocks.MockHeader(), '')
+        return futures
+
+    def test_process_async_interleaves_messages(self):
+        self.process_async([1, 2, 3])
+        self.assertEqual(sorted(self._obj._deliveries.keys()), [1, 2, 3])
+        self.assertEqual(self._obj._state, self._obj.STATE_PROCESSING)
+        self.assertFalse(self._obj._channel.basic_ack.called)
+
+    def test_on_processed_acks_message(self):
+        futures = self.process_async([1, 2])
+        futures[2].set_result(None)
+        self._obj.on_processed(data.Message(None, self.new_message(2),
+                                            mocks.MockHeader(), ''),
+                               futures[2])
+        self._obj._channel.basic_ack.assert_called_once_with(delivery_tag=2)
+        self.assertEqual(list(self._obj._deliveries.keys()), [1])
+        self.assertEqual(self._obj._state, self._obj.STATE_PROCESSING)
+
+    def test_on_processed_starts_buffered_message(self):
+        futures = self.process_async([1, 2])
+        self._obj._consumer.process.return_value = concurrent.Future()
+        self._obj.process(None, self.new_message(3), mocks.MockHeader(), '')
+        self.assertEqual(sorted(self._obj._deliveries), [1, 2])
+        futures[1].set_result(None)
+        self._obj.on_processed(data.Message(None, self.new_message(1),
+                                            mocks.MockHeader(), ''),
+                               futures[1])
+        self.assertEqual(sorted(self._obj._deliveries), [2, 3])
+        self.assertFalse(self._obj._buffered)
+        self.assertFalse(self._obj._channel.basic_nack.called)
+
+    def test_process_buffered_finishing_right_away(self):
+        self._obj._state = self._obj.STATE_PROCESSING
+        self._obj._consumer = mock.Mock(consumer.Consumer)
+        self._obj._consumer.process.return_value = None
+        self._obj._channel = self.new_mock_channel()
+        for delivery_tag in range(1, 2001):
+            self._obj._buffered.append((None, self.new_message(delivery_tag),
+                                        mocks.MockHeader(), ''))
+        self._obj.process_buffered()
+        self.assertEqual(self._obj._channel.basic_ack.call_count, 2000)
+        self.assertTrue(self._obj.is_idle)
+
+    def test_process_buffered_requeues_when_stop_requested(self):
+        futures = self.process_async([1])
+        self._obj.process(None, self.new_message(2), mocks.MockHeader(), '')
+        self._obj._state = self._obj.STATE_STOP_REQUESTED
+        futures[1].set_result(None)
+        with mock.patch.object(process.Process, 'on_ready_to_stop'):
+            self._obj.on_processed(data.Message(None, self.new_message(1),
+                                                mocks.MockHeader(), ''),
+                                   futures[1])
+        self._obj._channel.basic_nack.assert_called_once_with(delivery_tag=2,
+                                                              requeue=True)
+        self.assertFalse(self._obj._buffered)
+
+    def test_reconnect_drops_buffered_messages(self):
+        self._obj._buffered.append((None, self.new_message(2),
+                                    mocks.MockHeader(), ''))
+        self._obj._brokers = brokers.Brokers({'host': 'localhost'})
+        with mock.patch.object(process.Process, 'schedule_reconnect'):
+            self._obj.reconnect()
+        self.assertFalse(self._obj._buffered)
+
+    def test_on_processed_last_message_resets_state(self):
+        futures = self.process_async([1])
+        futures[1].set_result(None)
+        self._obj.on_processed(data.Message(None, self.new_message(1),
+                                            mocks.MockHeader(), ''),
+                               futures[1])
+        self.assertTrue(self._obj.is_idle)
+
+    def test_on_processed_with_message_exception_rejects(self):
+        futures = self.process_async([1])
+        futures[1].set_exception(consumer.MessageException('Bad'))
+        self._obj.on_processed(data.Message(None, self.new_message(1),
+                                            mocks.MockHeader(), ''),
+                               futures[1])
+        self._obj._channel.basic_nack.assert_called_once_with(delivery_tag=1,
+                                                              requeue=False)
+        self.assertFalse(self._obj._channel.basic_ack.called)
+        self.assertTrue(self._obj.is_idle)
+
+    def reconnect_with_pending_future(self, delivery_tag):
+        futures = self.process_async([delivery_tag])
+        callback = self._obj._connection.ioloop.add_future.call_args[0][1]
+        self._obj._brokers = brokers.Brokers({'host': 'localhost'})
+        self._obj._connection.is_open = False
+        self._obj._connection.is_closing = False
+        self._obj._connection.socket = None
+        with mock.patch('tornado.ioloop.IOLoop.instance'):
+            self._obj.reconnect()
+
+        # The new channel has delivered a message with the same tag
+        self._obj._channel = self.new_mock_channel()
+        self._obj._state = self._obj.STATE_PROCESSING
+        self._obj._deliveries = {delivery_tag: 0}
+        return futures[delivery_tag], callback
+
+    def test_on_processed_after_reconnect_does_not_ack(self):
+        future, callback = self.reconnect_with_pending_future(5)
+        future.set_result(None)
+        callback(future)
+        self.assertFalse(self._obj._channel.basic_ack.called)
+        self.assertEqual(self._obj._deliveries, {5: 0})
+
+    def test_on_processed_after_reconnect_does_not_reject(self):
+        future, callback = self.reconnect_with_pending_future(5)
+        future.set_exception(consumer.MessageException('Bad'))
+        callback(future)
+        self.assertFalse(self._obj._channel.basic_nack.called)
+        self.assertEqual(self._obj._deliveries, {5: 0})
+
+    def test_on_processed_without_channel(self):
+        futures = self.process_async([1])
+        futures[1].set_result(None)
+        self._obj._channel = None
+        self._obj.on_processed(data.Message(None, self.new_message(1),
+                                            mocks.MockHeader(), ''),
+                               futures[1])
+        self.assertEqual(self._obj._deliveries, {})
+
+    def test_flush_acks_does_not_coalesce_past_in_flight(self):
+        self._obj._ack_batch_size = 10
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        self._obj._deliveries = {3: 0}
+        for delivery_tag in [1, 2, 4]:
+            self._obj.ack_message(delivery_tag)
+        self._obj.flush_acks()
+        self.assertEqual(self._obj._channel.basic_ack.call_args_list,
+                         [mock.call(delivery_tag=2, multiple=True),
+                          mock.call(delivery_tag=4)])
+        self.assertEqual(self._obj._counts[process.Process.ACK_FRAMES_SAVED], 1)
+
+    def test_get_executor_without_futures(self):
+        with mock.patch('rejected.process.futures', new=None):
+            self.assertRaises(ImportError, self._obj.get_executor, 2)
+
+    def test_get_executor_max_workers(self):
+        if not futures:
+            self.skipTest('futures not installed')
+        executor = self._obj.get_executor(3)
+        self.assertEqual(executor._max_workers, 3)
+        executor.shutdown()
+
+    def test_process_in_thread_pool(self):
+        if not futures:
+            self.skipTest('futures not installed')
+        self._obj._executor = futures.ThreadPoolExecutor(max_workers=2)
+        self._obj._max_concurrency = 2
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        self._obj._connection.ioloop = mock.Mock()
+        with mock.patch.object(consumer.Consumer, '_process'):
+            self._obj._consumer = consumer.Consumer({})
+            self._obj.process(None, self.new_message(1), mocks.MockHeader(), '')
+            future = self._obj._connection.ioloop.add_future.call_args[0][0]
+            future.result(timeout=5)
+        self._obj._executor.shutdown()
+        self.assertIsInstance(future, futures.Future)
+        self.assertEqual(list(self._obj._deliveries.keys()), [1])
+
+    def test_process_in_thread_pool_uses_consumer_copy(self):
+        if not futures:
+            self.skipTest('futures not installed')
+        self._obj._executor = mock.Mock()
+        self._obj._connection = self.new_mock_connection()
+        self._obj._consumer = consumer.Consumer({})
+        self._obj._process('Hello World')
+        method = self._obj._executor.submit.call_args[0][0]
+        self.assertIsNot(method.__self__, self._obj._consumer)
+
+    def test_thread_safe_channel_publish_on_ioloop(self):
+        mock_channel = self.new_mock_channel()
+        mock_ioloop = mock.Mock()
+        channel = process.ThreadSafeChannel(mock_channel, mock_ioloop)
+        channel.basic_publish(exchange='foo', routing_key='bar', body='baz')
+        self.assertFalse(mock_channel.basic_publish.called)
+        callback = mock_ioloop.add_callback.call_args[0][0]
+        callback()
+        mock_channel.basic_publish.assert_called_once_with(exchange='foo',
+                                                           routing_key='bar',
+                                                           body='baz')
+
+    def test_thread_safe_channel_proxies_attributes(self):
+        mock_channel = self.new_mock_channel()
+        channel = process.ThreadSafeChannel(mock_channel, mock.Mock())
+        self.assertEqual(channel.is_open, mock_channel.is_open)
+
+    def test_reconnect_delay_first_attempt(self):
+        self._obj._reconnect_delay = 2
+        with mock.patch('random.uniform') as uniform:
+            self._obj.reconnect_delay
+            uniform.assert_called_once_with(0, 2)
+
+    def test_reconnect_delay_backoff(self):
+        self._obj._reconnect_delay = 2
+        self._obj._reconnect_attempts = 3
+        with mock.patch('random.uniform') as uniform:
+            self._obj.reconnect_delay
+            uniform.assert_called_once_with(0, 16)
+
+    def test_reconnect_delay_cap(self):
+        self._obj._reconnect_delay = 2
+        self._obj._reconnect_max_delay = 30
+        self._obj._reconnect_attempts = 10
+        with mock.patch('random.uniform') as uniform:
+            self._obj.reconnect_delay
+            uniform.assert_called_once_with(0, 30)
+
+    def test_schedule_reconnect_adds_timeout(self):
+        with mock.patch('tornado.ioloop.IOLoop.instance') as instance:
+            with mock.patch('time.time', return_value=100):
+                with mock.patch('random.uniform', return_value=0.5):
+                    self._obj.schedule_reconnect()
+            instance.return_value.add_timeout.assert_called_once_with(
+                100.5, self._obj.on_reconnect_timeout)
+
+    def test_schedule_reconnect_counts_attempts(self):
+        with mock.patch('tornado.ioloop.IOLoop.instance'):
+            self._obj.schedule_reconnect()
+            self._obj.schedule_reconnect()
+        self.assertEqual(self._obj._reconnect_attempts, 2)
+        self.assertEqual(
+            self._obj._counts[process.Process.RECONNECT_ATTEMPTS], 2)
+
+    def test_connect_failure_schedules_reconnect(self):
+        self._obj._brokers = brokers.Brokers({'host': 'localhost'})
+        with mock.patch.object(process.Process, 'connect_to_rabbitmq',
+                               side_effect=exceptions.AMQPConnectionError(1)):
+            with mock.patch.object(process.Process,
+                                   'schedule_reconnect') as schedule:
+                self._obj.connect()
+                schedule.assert_called_once_with()
+        self.assertIsNone(self._obj._connection)
+
+    def test_reconnect_does_not_sleep(self):
+        self._obj._brokers = brokers.Brokers({'host': 'localhost'})
+        self._obj._connection = self.new_mock_connection()
+        self._obj._connection.is_open = False
+        self._obj._connection.is_closing = False
+        self._obj._connection.socket = None
+        with mock.patch('tornado.ioloop.IOLoop.instance'):
+            with mock.patch('time.sleep') as sleep:
+                self._obj.reconnect()
+                self.assertFalse(sleep.called)
+        self.assertIsNone(self._obj._connection)
+        self.assertIsNotNone(self._obj._reconnect_timeout)
+
+    def reconnect_to_brokers(self, attempts):
+        self._obj._brokers = brokers.Brokers({'host': ['a', 'b', 'c']})
+        self._obj._reconnect_attempts = attempts
+        with mock.patch.object(process.Process,
+                               'schedule_reconnect') as schedule:
+            self._obj.reconnect()
+        return schedule
+
+    def test_reconnect_fails_over_without_delay(self):
+        for attempts in [0, 1]:
+            schedule = self.reconnect_to_brokers(attempts)
+            schedule.assert_called_once_with(0)
+
+    def test_reconnect_backs_off_after_first_pass(self):
+        schedule = self.reconnect_to_brokers(2)
+        schedule.assert_called_once_with()
+
+    def test_reconnect_only_schedules_once(self):
+        self._obj._reconnect_timeout = 'timeout'
+        with mock.patch.object(process.Process,
+                               'schedule_reconnect') as schedule:
+            self._obj.reconnect()
+            self.assertFalse(schedule.called)
+
+    def test_on_connection_open_counts_disconnected_time(self):
+        self._obj._broker = brokers.Broker('localhost', 5672)
+        self._obj._connection = self.new_mock_connection()
+        self._obj._disconnected_at = 100
+        self._obj._reconnect_attempts = 3
+        with mock.patch('time.time', return_value=112.5):
+            self._obj.on_connection_open(self._obj._connection)
+        self.assertEqual(self._obj._counts[process.Process.TIME_DISCONNECTED],
+                         12.5)
+        self.assertEqual(self._obj._reconnect_attempts, 0)
+        self.assertIsNone(self._obj._disconnected_at)
+
+    def test_on_connection_closed_ignores_replaced_connection(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._connection = self.new_mock_connection()
+        with mock.patch.object(process.Process, 'reconnect') as reconnect:
+            self._obj.on_connection_closed(self.new_mock_connection())
+            self.assertFalse(reconnect.called)
+
+    def test_on_connection_closed_reconnects(self):
+        self._obj._broker = brokers.Broker('localhost', 5672)
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._connection = self.new_mock_connection()
+        with mock.patch.object(process.Process, 'reconnect') as reconnect:
+            self._obj.on_connection_closed(self._obj._connection)
+            reconnect.assert_called_once_with()
+
+    def test_ewma_without_average(self):
+        self.assertEqual(self._obj.ewma(None, 10), 10)
+
+    def test_ewma_with_average(self):
+        self.assertAlmostEqual(self._obj.ewma(10, 20), 13.0)
+
+    def test_dynamic_qos_prefetch_without_velocity(self):
+        self.assertEqual(self._obj.dynamic_qos_pretch, 0)
+
+    def test_dynamic_qos_prefetch_from_velocity(self):
+        self._obj._velocity_ewma = 100
+        self._obj._latency_ewma = 0.001
+        self.assertEqual(self._obj.dynamic_qos_pretch, 125)
+
+    def test_dynamic_qos_prefetch_capped_by_latency(self):
+        self._obj._max_concurrency = 2
+        self._obj._velocity_ewma = 100
+        self._obj._latency_ewma = 0.5
+        self.assertEqual(self._obj.dynamic_qos_pretch, 5)
+
+    def new_qos_process(self, qos_prefetch, velocity):
+        self._obj._config = {'qos_prefetch': 5}
+        self._obj._channel = self.new_mock_channel()
+        self._obj._qos_prefetch = qos_prefetch
+        self._obj._velocity_ewma = velocity
+
+    def test_calculate_qos_prefetch_increases(self):
+        self.new_qos_process(5, 80)
+        self.assertTrue(self._obj.calculate_qos_prefetch())
+        self._obj._channel.basic_qos.assert_called_once_with(
+            prefetch_count=100)
+        self.assertEqual(self._obj._counts[process.Process.QOS_PREFETCH], 100)
+        self.assertEqual(self._obj._counts[process.Process.QOS_ADJUSTMENTS], 1)
+
+    def test_calculate_qos_prefetch_floor(self):
+        self.new_qos_process(100, 1)
+        self._obj.calculate_qos_prefetch()
+        self._obj._channel.basic_qos.assert_called_once_with(prefetch_count=5)
+
+    def test_calculate_qos_prefetch_max(self):
+        self.new_qos_process(100, 100000)
+        self._obj.calculate_qos_prefetch()
+        self._obj._channel.basic_qos.assert_called_once_with(
+            prefetch_count=process.Process._QOS_MAX)
+
+    def test_calculate_qos_prefetch_above_max_concurrency_buffers(self):
+        self.new_qos_process(5, 80)
+        self._obj._max_concurrency = 2
+        self._obj._latency_ewma = 0.01
+        self._obj.calculate_qos_prefetch()
+        prefetch = self._obj._channel.basic_qos.call_args[1]['prefetch_count']
+        self.assertGreater(prefetch, self._obj._max_concurrency)
+
+        # Deliver as many messages as the prefetch allows
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._consumer = mock.Mock(consumer.Consumer)
+        self._obj._consumer.process.return_value = concurrent.Future()
+        self._obj._connection = self.new_mock_connection()
+        self._obj._connection.ioloop = mock.Mock()
+        for delivery_tag in range(1, prefetch + 1):
+            self._obj.process(None, self.new_message(delivery_tag),
+                              mocks.MockHeader(), '')
+        self.assertEqual(len(self._obj._deliveries), 2)
+        self.assertEqual(len(self._obj._buffered), prefetch - 2)
+        self.assertFalse(self._obj._channel.basic_nack.called)
+
+    def test_calculate_qos_prefetch_ignores_small_change(self):
+        self.new_qos_process(100, 84)
+        self.assertFalse(self._obj.calculate_qos_prefetch())
+        self.assertFalse(self._obj._channel.basic_qos.called)
+        self.assertEqual(self._obj._counts[process.Process.QOS_ADJUSTMENTS], 0)
+
+    def test_finish_message_records_latency(self):
+        self._obj._deliveries = {1: 100}
+        self._obj._ack = False
+        with mock.patch('time.time', return_value=100.25):
+            self._obj.finish_message(data.Message(None, self.new_message(1),
+                                                  mocks.MockHeader(), ''),
+                                     True)
+        self.assertEqual(self._obj._latency_samples, 1)
+        self.assertEqual(self._obj._latency_total, 0.25)
+
+    def test_update_qos_prefetch_first_interval(self):
+        with mock.patch('time.time', return_value=100):
+            self._obj.update_qos_prefetch()
+        self.assertEqual(self._obj._last_stats_time, 100)
+        self.assertIsNone(self._obj._velocity_ewma)
+
+    def test_update_qos_prefetch_updates_averages(self):
+        self.new_qos_process(5, None)
+        self._obj._last_counts = self._obj.new_counter_dict()
+        self._obj._last_stats_time = 100
+        self._obj._counts[process.Process.PROCESSED] = 200
+        self._obj._latency_samples = 200
+        self._obj._latency_total = 2
+        with mock.patch('time.time', return_value=110):
+            self._obj.update_qos_prefetch()
+        self.assertEqual(self._obj._counts[process.Process.VELOCITY], 20)
+        self.assertEqual(
+            self._obj._counts[process.Process.PROCESSING_LATENCY], 0.01)
+        self.assertEqual(self._obj._latency_samples, 0)
+        self.assertEqual(self._obj._last_counts[process.Process.PROCESSED],
+                         200)
+        self._obj._channel.basic_qos.assert_called_once_with(prefetch_count=25)
+
+    def test_update_qos_prefetch_without_channel(self):
+        self._obj._last_counts = self._obj.new_counter_dict()
+        self._obj._last_stats_time = 100
+        self._obj._qos_prefetch = 5
+        with mock.patch.object(process.Process,
+                               'calculate_qos_prefetch') as calculate:
+            with mock.patch('time.time', return_value=110):
+                self._obj.update_qos_prefetch()
+            self.assertFalse(calculate.called)
+
+    def test_reconnect_resets_qos_prefetch(self):
+        self._obj._brokers = brokers.Brokers({'host': 'localhost'})
+        self._obj._qos_prefetch = 100
+        with mock.patch.object(process.Process, 'schedule_reconnect'):
+            self._obj.reconnect()
+        self.assertIsNone(self._obj._qos_prefetch)
+
+    def new_stats_process(self):
+        self._obj._consumer_name = 'MockConsumer'
+        self._obj._stats_pipe = mock.Mock()
+        return self._obj._stats_pipe
+
+    def test_submit_stats_sends_deltas(self):
+        stats_pipe = self.new_stats_process()
+        self._obj._counts[process.Process.PROCESSED] = 10
+        self._obj.submit_stats()
+        self._obj._counts[process.Process.PROCESSED] = 15
+        self._obj.submit_stats()
+        snapshot = stats_pipe.send.call_args[0][0]
+        self.assertEqual(snapshot['counts'], {process.Process.PROCESSED: 5})
+
+    def test_submit_stats_snapshot(self):
+        stats_pipe = self.new_stats_process()
+        self._obj.submit_stats()
+        snapshot = stats_pipe.send.call_args[0][0]
+        self.assertEqual(snapshot['name'], 'MockProcess')
+        self.assertEqual(snapshot['consumer_name'], 'MockConsumer')
+        self.assertEqual(snapshot['counts'], {})
+
+    def test_submit_stats_sends_gauges(self):
+        stats_pipe = self.new_stats_process()
+        self._obj._counts[process.Process.QOS_PREFETCH] = 25
+        self._obj.submit_stats()
+        self._obj.submit_stats()
+        snapshot = stats_pipe.send.call_args[0][0]
+        self.assertEqual(snapshot['gauges'][process.Process.QOS_PREFETCH], 25)
+        self.assertNotIn(process.Process.QOS_PREFETCH, snapshot['counts'])
+
+    def test_submit_stats_resets_ack_latency_max(self):
+        self.new_stats_process()
+        self._obj._counts[process.Process.ACK_LATENCY_MAX] = 0.5
+        self._obj.submit_stats()
+        self.assertEqual(self._obj._counts[process.Process.ACK_LATENCY_MAX], 0)
+
+    def test_submit_stats_resets_ack_latency_max_in_counter_block(self):
+        stats_pipe = self.new_stats_process()
+        self._obj._counts = counters.CounterBlock(process.Process.COUNTERS)
+        self._obj._counts[process.Process.ACK_LATENCY_MAX] = 0.5
+        self._obj.submit_stats()
+        snapshot = stats_pipe.send.call_args[0][0]
+        self.assertEqual(snapshot['gauges'],
+                         {process.Process.ACK_LATENCY_MAX: 0.5})
+        self.assertEqual(self._obj._counts[process.Process.ACK_LATENCY_MAX], 0)
+
+    def test_submit_stats_sends_ack_latency_max_reset_in_counter_block(self):
+        stats_pipe = self.new_stats_process()
+        self._obj._counts = counters.CounterBlock(process.Process.COUNTERS)
+        self._obj._counts[process.Process.ACK_LATENCY_MAX] = 0.5
+        self._obj.submit_stats()
+        self._obj.submit_stats()
+        snapshot = stats_pipe.send.call_args[0][0]
+        self.assertEqual(snapshot['gauges'],
+                         {process.Process.ACK_LATENCY_MAX: 0})
+        stats_pipe.send.reset_mock()
+        self._obj.submit_stats()
+        self.assertFalse(stats_pipe.send.called)
+
+    def test_submit_stats_pipe_closed(self):
+        stats_pipe = self.new_stats_process()
+        stats_pipe.send.side_effect = IOError
+        self._obj.submit_stats()
+
+    def test_on_ready_to_stop_submits_stats(self):
+        self._obj._consumer = mock.Mock()
+        self._obj._stats_timer = mock.Mock()
+        with mock.patch.object(process.Process, 'submit_stats') as submit:
+            with mock.patch('tornado.ioloop.IOLoop.instance'):
+                self._obj.on_ready_to_stop()
+            submit.assert_called_once_with()
+        self.assertIsNone(self._obj._stats_timer)
+
+    def test_counts_use_shared_counter_block(self):
+        block = counters.CounterBlock(process.Process.COUNTERS)
+        kwargs = self.new_kwargs(self.mock_args)
+        kwargs['counters'] = block
+        new_process = self.new_process(kwargs)
+        new_process.increment_count(process.Process.PROCESSED)
+        self.assertEqual(block[process.Process.PROCESSED], 1)
+
+    def test_new_counter_dict_layout(self):
+        self.assertEqual(sorted(self._obj.new_counter_dict().keys()),
+                         sorted(process.Process.COUNTERS))
+
+    def test_process_records_queue_wait(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._consumer = mock.Mock(consumer.Consumer)
+        self._obj._consumer.process.return_value = None
+        self._obj._channel = self.new_mock_channel()
+        header = mocks.MockHeader()
+        with mock.patch('time.time', return_value=header.timestamp + 2):
+            self._obj.process(None, self.new_message(1), header, '')
+        queue_wait = self._obj._histograms[process.Process.QUEUE_WAIT]
+        self.assertEqual(len(queue_wait), 1)
+        self.assertAlmostEqual(queue_wait.percentile(50), 2, delta=0.07)
+
+    def test_process_ignores_future_timestamp(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._consumer = mock.Mock(consumer.Consumer)
+        self._obj._consumer.process.return_value = None
+        self._obj._channel = self.new_mock_channel()
+        header = mocks.MockHeader()
+        with mock.patch('time.time', return_value=header.timestamp - 2):
+            self._obj.process(None, self.new_message(1), header, '')
+        queue_wait = self._obj._histograms[process.Process.QUEUE_WAIT]
+        self.assertEqual(len(queue_wait), 0)
+
+    def test_process_records_spawn_latency_once(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._consumer = mock.Mock(consumer.Consumer)
+        self._obj._consumer.process.return_value = None
+        self._obj._channel = self.new_mock_channel()
+        self._obj._spawned = 1000
+        with mock.patch('time.time', return_value=1002.5):
+            self._obj.process(None, self.new_message(1), mocks.MockHeader(),
+                              '')
+        with mock.patch('time.time', return_value=1010):
+            self._obj.process(None, self.new_message(2), mocks.MockHeader(),
+                              '')
+        self.assertEqual(self._obj._counts[process.Process.SPAWN_LATENCY],
+                         2.5)
+        self.assertIsNone(self._obj._spawned)
+
+    def test_finish_message_records_histograms(self):
+        self._obj._deliveries = {1: 100}
+        self._obj._channel = self.new_mock_channel()
+        with mock.patch('time.time', return_value=100.25):
+            self._obj.finish_message(data.Message(None, self.new_message(1),
+                                                  mocks.MockHeader(), ''),
+                                     True)
+        for name in [process.Process.ACK_LATENCY,
+                     process.Process.PROCESSING_DURATION]:
+            self.assertAlmostEqual(self._obj._histograms[name].percentile(50),
+                                   0.25, delta=0.008)
+
+    def test_flush_acks_records_ack_latency(self):
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        self._obj._ack_batch_size = 10
+        with mock.patch('time.time', return_value=100):
+            self._obj.ack_message(1, 99)
+            self._obj.ack_message(2)
+        with mock.patch('time.time', return_value=101):
+            self._obj.flush_acks()
+        ack_latency = self._obj._histograms[process.Process.ACK_LATENCY]
+        self.assertEqual(len(ack_latency), 1)
+        self.assertAlmostEqual(ack_latency.percentile(50), 2, delta=0.07)
+
+    def test_submit_stats_sends_histograms(self):
+        stats_pipe = self.new_stats_process()
+        self._obj._histograms[process.Process.QUEUE_WAIT].record(0.5)
+        self._obj.submit_stats()
+        snapshot = stats_pipe.send.call_args[0][0]
+        self.assertEqual(snapshot['histograms'].keys(),
+                         [process.Process.QUEUE_WAIT])
+        self.assertEqual(len(self._obj._histograms[process.Process.QUEUE_WAIT]),
+                         0)
+
+    def test_submit_stats_with_counter_block_skips_counts(self):
+        stats_pipe = self.new_stats_process()
+        self._obj._counts = counters.CounterBlock(process.Process.COUNTERS)
+        self._obj._counts[process.Process.PROCESSED] = 5
+        self._obj._histograms[process.Process.QUEUE_WAIT].record(0.5)
+        self._obj.submit_stats()
+        snapshot = stats_pipe.send.call_args[0][0]
+        self.assertEqual(snapshot['counts'], {})
+        self.assertEqual(snapshot['gauges'], {})
+
+    def test_submit_stats_with_counter_block_nothing_to_send(self):
+        stats_pipe = self.new_stats_process()
+        self._obj._counts = counters.CounterBlock(process.Process.COUNTERS)
+        self._obj.submit_stats()
+        self.assertFalse(stats_pipe.send.called)
+
+    def test_count_state_time_idle(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._state_start = 100
+        with mock.patch('time.time', return_value=110):
+            self._obj.count_state_time()
+        with mock.patch('time.time', return_value=115):
+            self._obj.count_state_time()
+        self.assertEqual(self._obj._counts[process.Process.TIME_WAITED], 15)
+
+    def test_count_state_time_processing(self):
+        self._obj._state = self._obj.STATE_PROCESSING
+        self._obj._state_start = 100
+        with mock.patch('time.time', return_value=110):
+            self._obj.count_state_time()
+        self.assertEqual(self._obj._counts[process.Process.TIME_SPENT], 10)
+
+    def test_count_state_time_spare(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._state_start = 100
+        self._obj._spare = True
+        with mock.patch('time.time', return_value=110):
+            self._obj.count_state_time()
+        self.assertEqual(self._obj._counts[process.Process.TIME_WAITED], 0)
+
+    def test_set_state_counts_time_since_last_counted(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._state_start = 100
+        with mock.patch('time.time', return_value=110):
+            self._obj.count_state_time()
+        with mock.patch('time.time', return_value=112):
+            self._obj.set_state(self._obj.STATE_PROCESSING)
+        self.assertEqual(self._obj._counts[process.Process.TIME_WAITED], 12)
+
+    def test_probe_queue(self):
+        self._obj._channel = self.new_mock_channel()
+        self._obj._queue_name = 'test_queue'
+        self._obj.probe_queue()
+        self._obj._channel.queue_declare.assert_called_once_with(
+            self._obj.on_queue_probe, queue='test_queue', passive=True)
+
+    def test_probe_queue_closed_channel(self):
+        self._obj._channel = self.new_mock_channel()
+        self._obj._channel.is_open = False
+        self._obj.probe_queue()
+        self.assertFalse(self._obj._channel.queue_declare.called)
+
+    def new_queue_probe(self, pid, depth=-1, consumers=-1):
+        self._obj._queue_probe = [pid, depth, consumers]
+        self._obj._channel = self.new_mock_channel()
+        self._obj._queue_name = 'test_queue'
+
+    def test_probe_queue_shared_by_other_process(self):
+        self.new_queue_probe(os.getpid() + 1, 30, 3)
+        self._obj.probe_queue()
+        self.assertFalse(self._obj._channel.queue_declare.called)
+        self.assertEqual((self._obj._queue_depth, self._obj._queue_consumers),
+                         (30, 3))
+
+    def test_probe_queue_shared_not_probed_yet(self):
+        self.new_queue_probe(os.getpid() + 1)
+        self._obj.probe_queue()
+        self.assertIsNone(self._obj._queue_depth)
+
+    def test_probe_queue_shared_by_this_process(self):
+        self.new_queue_probe(os.getpid())
+        self._obj.probe_queue()
+        self.assertTrue(self._obj._channel.queue_declare.called)
+
+    def test_probe_queue_spare(self):
+        self._obj._channel = self.new_mock_channel()
+        self._obj._spare = True
+        self._obj.probe_queue()
+        self.assertFalse(self._obj._channel.queue_declare.called)
+
+    def test_on_queue_probe_shares_result(self):
+        self.new_queue_probe(os.getpid())
+        frame = mock.Mock()
+        frame.method.message_count = 150
+        frame.method.consumer_count = 3
+        self._obj.on_queue_probe(frame)
+        self.assertEqual(self._obj._queue_probe, [os.getpid(), 150, 3])
+
+    def test_on_queue_probe(self):
+        self._obj._queue_name = 'test_queue'
+        frame = mock.Mock()
+        frame.method.message_count = 150
+        frame.method.consumer_count = 3
+        self._obj.on_queue_probe(frame)
+        self.assertEqual(self._obj._counts[process.Process.QUEUE_DEPTH], 150)
+        self.assertEqual(self._obj._counts[process.Process.QUEUE_CONSUMERS], 3)
+
+    def test_calculate_qos_prefetch_limited_by_queue_depth(self):
+        self.new_qos_process(5, 80)
+        self._obj._queue_depth = 30
+        self._obj._queue_consumers = 3
+        self._obj.calculate_qos_prefetch()
+        self._obj._channel.basic_qos.assert_called_once_with(prefetch_count=15)
+
+    def test_calculate_qos_prefetch_empty_queue_does_not_grow(self):
+        self.new_qos_process(5, 80)
+        self._obj._queue_depth = 0
+        self._obj._queue_consumers = 3
+        self.assertFalse(self._obj.calculate_qos_prefetch())
+
+    def test_calculate_qos_prefetch_queue_depth_does_not_limit_lowering(self):
+        self.new_qos_process(100, 8)
+        self._obj._queue_depth = 0
+        self._obj._queue_consumers = 1
+        self._obj.calculate_qos_prefetch()
+        self._obj._channel.basic_qos.assert_called_once_with(prefetch_count=10)
+
+    def new_spare_process(self):
+        self._obj._spare = True
+        self._obj._config = {}
+        self._obj._consumer = mock.Mock(consumer.Consumer)
+        self._obj._channel = self.new_mock_channel()
+        self._obj._channel.is_open = True
+        self._obj._connection = self.new_mock_connection()
+        self._obj._queue_name = 'test'
+        return self._obj._channel
+
+    def test_spare_kwarg(self):
+        new_process = self.new_process({'spare': True})
+        self.assertTrue(new_process._spare)
+
+    def test_setup_channel_spare_does_not_consume(self):
+        mock_channel = self.new_spare_process()
+        self._obj.setup_channel()
+        self.assertTrue(mock_channel.basic_qos.called)
+        self.assertFalse(mock_channel.basic_consume.called)
+
+    def test_setup_channel_consumes(self):
+        mock_channel = self.new_spare_process()
+        self._obj._spare = False
+        self._obj.setup_channel()
+        mock_channel.basic_recover.assert_called_once_with(requeue=True)
+        mock_channel.basic_consume.assert_called_once_with(
+            consumer_callback=self._obj.process, queue='test', no_ack=False,
+            consumer_tag=self._obj.name)
+
+    def test_activate_starts_consuming(self):
+        mock_channel = self.new_spare_process()
+        with mock.patch('time.time', return_value=1000):
+            self._obj.activate()
+        self.assertFalse(self._obj._spare)
+        self.assertEqual(self._obj._spawned, 1000)
+        self.assertTrue(mock_channel.basic_consume.called)
+
+    def test_activate_channel_not_open(self):
+        mock_channel = self.new_spare_process()
+        mock_channel.is_open = False
+        self._obj.activate()
+        self.assertFalse(self._obj._spare)
+        self.assertFalse(mock_channel.basic_consume.called)
+
+    def test_activate_not_spare(self):
+        mock_channel = self.new_spare_process()
+        self._obj._spare = False
+        self._obj.activate()
+        self.assertFalse(mock_channel.basic_consume.called)
+
+    def test_cancel_consumer_spare(self):
+        mock_channel = self.new_spare_process()
+        self._obj.cancel_consumer_with_rabbitmq()
+        self.assertFalse(mock_channel.basic_cancel.called)
+
+    def test_on_sigusr1_schedules_activate(self):
+        with mock.patch('tornado.ioloop.IOLoop.instance') as instance:
+            self._obj.on_sigusr1(signal.SIGUSR1, None)
+            instance.return_value.add_callback_from_signal.\
+                assert_called_once_with(self._obj.activate)
+
+    def test_run_handles_signals_before_reporting_ready(self):
+        self._obj._ready = mock.Mock(value=0)
+        def setup(*args):
+            self.assertEqual(self._obj._ready.value, 1)
+            raise ImportError('Mock')
+        with mock.patch.object(process.Process, 'setup_signal_handlers') as \
+                setup_signal_handlers:
+            setup_signal_handlers.side_effect = \
+                lambda: self.assertEqual(self._obj._ready.value, 0)
+            with mock.patch.object(process.Process, 'setup',
+                                   side_effect=setup):
+                with mock.patch('signal.signal'):
+                    self._obj.run()
+            setup_signal_handlers.assert_called_once_with()
+
+    def test_run_closes_listening_fds(self):
+        self._obj._kwargs['listening_fds'] = [7, 8]
+        with mock.patch('os.close') as close:
+            with mock.patch.object(process.Process, 'setup',
+                                   side_effect=ImportError('Mock')):
+                with mock.patch.object(process.Process,
+                                       'setup_signal_handlers'):
+                    with mock.patch('signal.signal'):
+                        self._obj.run()
+        self.assertEqual(close.call_args_list, [mock.call(7), mock.call(8)])
+
+    def test_run_clears_forked_ioloop(self):
+        with mock.patch('tornado.ioloop.IOLoop.clear_current') as current:
+            with mock.patch('tornado.ioloop.IOLoop.clear_instance') as \
+                    instance:
+                with mock.patch.object(process.Process, 'setup',
+                                       side_effect=ImportError('Mock')):
+                    with mock.patch.object(process.Process,
+                                           'setup_signal_handlers'):
+                        with mock.patch('signal.signal'):
+                            self._obj.run()
+        current.assert_called_once_with()
+        instance.assert_called_once_with()
+
+    def test_close_listening_fds_already_closed(self):
+        self._obj._kwargs['listening_fds'] = [7]
+        with mock.patch('os.close', side_effect=OSError) as close:
+            self._obj.close_listening_fds()
+        close.assert_called_once_with(7)
+
+    def test_setup_metrics_disabled(self):
+        self._obj.setup_metrics({'host': 'localhost'})
+        self.assertIsNone(self._obj._metrics)
+
+    def test_setup_metrics_direct(self):
+        self._obj._consumer_name = 'consumer'
+        with mock.patch('tornado.ioloop.PeriodicCallback') as timer:
+            self._obj.setup_metrics({'host': 'localhost', 'direct': True,
+                                     'flush_interval': 0.5})
+            timer.assert_called_once_with(self._obj._metrics.flush, 500)
+        self.assertEqual(self._obj._metrics_prefix,
+                         'consumer.%s' % self._obj.name)
+
+    def test_setup_metrics_direct_graphite(self):
+        self._obj.setup_metrics({'host': 'localhost', 'direct': True,
+                                 'protocol': 'graphite'})
+        self.assertIsNone(self._obj._metrics)
+
+    def test_record_timing(self):
+        self._obj._metrics = mock.Mock()
+        self._obj._metrics_prefix = 'consumer.process'
+        self._obj.record_timing(process.Process.QUEUE_WAIT, 0.5)
+        queue_wait = self._obj._histograms[process.Process.QUEUE_WAIT]
+        self.assertEqual(len(queue_wait), 1)
+        self._obj._metrics.timing.assert_called_once_with(
+            'consumer.process.queue_wait', 0.5)
+
+    def new_profiling_process(self, active=False):
+        self._obj._profiler = mock.Mock()
+        self._obj._profiler.active = active
+        self._obj._profile_duration = 30
+        self._obj._profile_seconds = mock.Mock(value=0)
+        return self._obj._profiler
+
+    def test_on_sigprof_samples_when_profiling(self):
+        profiler = self.new_profiling_process(True)
+        frame = mock.Mock()
+        self._obj.on_sigprof(signal.SIGPROF, frame)
+        profiler.sample.assert_called_once_with(frame)
+
+    def test_on_sigprof_logs_when_not_profiling(self):
+        profiler = self.new_profiling_process()
+        self._obj.on_sigprof(signal.SIGPROF, None)
+        self.assertFalse(profiler.sample.called)
+
+    def test_on_sigusr2_schedules_start_profiling(self):
+        with mock.patch('tornado.ioloop.IOLoop.instance') as instance:
+            self._obj.on_sigusr2(signal.SIGUSR2, None)
+            instance.return_value.add_callback_from_signal.\
+                assert_called_once_with(self._obj.start_profiling)
+
+    def test_start_profiling_configured_duration(self):
+        profiler = self.new_profiling_process()
+        with mock.patch('tornado.ioloop.IOLoop.instance') as instance:
+            self._obj.start_profiling()
+            instance.return_value.call_later.assert_called_once_with(
+                30, self._obj.stop_profiling)
+        profiler.start.assert_called_once_with()
+
+    def test_start_profiling_requested_duration(self):
+        self.new_profiling_process()
+        self._obj._profile_seconds.value = 5.0
+        with mock.patch('tornado.ioloop.IOLoop.instance') as instance:
+            self._obj.start_profiling()
+            instance.return_value.call_later.assert_called_once_with(
+                5.0, self._obj.stop_profiling)
+
+    def test_start_profiling_already_active(self):
+        profiler = self.new_profiling_process(True)
+        self._obj.start_profiling()
+        self.assertFalse(profiler.start.called)
+
+    def test_stop_profiling(self):
+        profiler = self.new_profiling_process(True)
+        self._obj._profile_timeout = timeout = mock.Mock()
+        with mock.patch('tornado.ioloop.IOLoop.instance') as instance:
+            self._obj.stop_profiling()
+            instance.return_value.remove_timeout.assert_called_once_with(
+                timeout)
+        profiler.stop.assert_called_once_with()
+        self.assertIsNone(self._obj._profile_timeout)
+
+    def test_stop_profiling_not_active(self):
+        profiler = self.new_profiling_process()
+        self._obj.stop_profiling()
+        self.assertFalse(profiler.stop.called)
+
+    def test_histograms_include_phases(self):
+        for name in ['ack_duration', 'construct_duration', 'consumer_duration',
+                     'decode_duration', 'deserialize_duration',
+                     'publish_duration']:
+            self.assertIn(name, self._obj._histograms)
+
+    def test_finish_message_records_phase_timings(self):
+        self._obj._deliveries = {1: 100}
+        self._obj._ack = False
+        message = data.Message(None, self.new_message(1), mocks.MockHeader(),
+                               '')
+        message.add_timing(process.Process.DECODE_DURATION, 0.125)
+        message.add_timing(process.Process.PUBLISH_DURATION, 0.25)
+        with mock.patch('time.time', return_value=101):
+            self._obj.finish_message(message, True)
+        for name, duration in [(process.Process.DECODE_DURATION, 0.125),
+                               (process.Process.PUBLISH_DURATION, 0.25),
+                               (process.Process.CONSUMER_DURATION, 0.625)]:
+            self.assertAlmostEqual(self._obj._histograms[name].percentile(50),
+                                   duration, delta=duration * 0.04)
+
+    def test_process_records_construct_duration(self):
+        self._obj._state = self._obj.STATE_IDLE
+        self._obj._consumer = mock.Mock()
+        self._obj._consumer.process.return_value = True
+        self._obj._channel = self.new_mock_channel()
+        self._obj.process(None, self.new_message(1), mocks.MockHeader(), '')
+        construct = self._obj._histograms[process.Process.CONSTRUCT_DURATION]
+        self.assertEqual(len(construct), 1)
+
+    def test_ack_message_records_ack_duration(self):
+        self._obj._channel = self.new_mock_channel()
+        self._obj.ack_message(10)
+        self.assertEqual(
+            len(self._obj._histograms[process.Process.ACK_DURATION]), 1)
+
+    def test_flush_acks_records_ack_duration(self):
+        self._obj._ack_batch_size = 10
+        self._obj._channel = self.new_mock_channel()
+        self._obj._connection = self.new_mock_connection()
+        for delivery_tag in [1, 2, 3]:
+            self._obj.ack_message(delivery_tag)
+        self._obj.flush_acks()
+        self.assertEqual(
+            len(self._obj._histograms[process.Process.ACK_DURATION]), 1)
+
+    def test_reject_records_ack_duration(self):
+        self._obj._channel = self.new_mock_channel()
+        self._obj.reject(10, False)
+        self.assertEqual(
+            len(self._obj._histograms[process.Process.ACK_DURATION]), 1)
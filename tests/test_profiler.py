@@ -0,0 +1,84 @@
+"""Tests for rejected.profiler"""
+import mock
+import os
+import shutil
+import signal
+import sys
+import tempfile
+# Import unittest if 2.7, unittest2 if other version
+if (sys.version_info[0], sys.version_info[1]) == (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+
+from rejected import profiler
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._obj = profiler.Profiler(self._directory, 'consumer_1')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def read_profile(self, path):
+        with open(path) as handle:
+            return handle.read().splitlines()
+
+    def test_default_interval(self):
+        self.assertEqual(self._obj.interval, profiler.Profiler._INTERVAL)
+
+    def test_start_sets_timer(self):
+        with mock.patch('signal.setitimer') as setitimer:
+            self._obj.start()
+            setitimer.assert_called_once_with(signal.ITIMER_PROF, 0.01, 0.01)
+        self.assertTrue(self._obj.active)
+
+    def test_stop_clears_timer(self):
+        with mock.patch('signal.setitimer') as setitimer:
+            self._obj.start()
+            self._obj.stop()
+            setitimer.assert_called_with(signal.ITIMER_PROF, 0, 0)
+        self.assertFalse(self._obj.active)
+
+    def test_label(self):
+        code = self.test_label.__func__.__code__
+        self.assertEqual(self._obj.label(code),
+                         'test_label (%s:%i)' % (code.co_filename,
+                                                 code.co_firstlineno))
+
+    def test_sample_counts_stacks(self):
+        frame = sys._getframe()
+        with mock.patch('signal.setitimer'):
+            self._obj.start()
+            self._obj.sample(frame)
+            self._obj.sample(frame)
+        self.assertEqual(self._obj.samples, 2)
+        stack = [stack for stack in self._obj._stacks
+                 if stack.endswith(self._obj.label(frame.f_code))]
+        self.assertEqual(len(stack), 1)
+        self.assertEqual(self._obj._stacks[stack[0]], 2)
+
+    def test_stop_writes_collapsed_stacks(self):
+        frame = sys._getframe()
+        with mock.patch('signal.setitimer'):
+            with mock.patch('time.time', return_value=1000):
+                self._obj.start()
+            self._obj.sample(frame)
+            path = self._obj.stop()
+        self.assertEqual(path, os.path.join(self._directory,
+                                            'consumer_1-%i-1000.collapsed' %
+                                            os.getpid()))
+        lines = self.read_profile(path)
+        label = self._obj.label(frame.f_code)
+        self.assertTrue(any(line.endswith('%s 1' % label) for line in lines))
+        self.assertEqual(self._obj._stacks, {})
+
+    def test_stop_write_error(self):
+        self._obj.directory = os.path.join(self._directory, 'missing')
+        with mock.patch('signal.setitimer'):
+            self._obj.start()
+            self.assertIsNone(self._obj.stop())
+        self.assertFalse(self._obj.active)
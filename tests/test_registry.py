@@ -0,0 +1,135 @@
+"""Tests for rejected.registry"""
+import mock
+import sys
+# Import unittest if 2.7, unittest2 if other version
+if (sys.version_info[0], sys.version_info[1]) == (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+
+from rejected import registry
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self._obj = registry.Registry()
+
+    def new_process(self, pid):
+        process = mock.Mock()
+        process.pid = pid
+        return process
+
+    def test_add_returns_record(self):
+        process = self.new_process(1234)
+        with mock.patch('time.time', return_value=1000):
+            record = self._obj.add('consumer_1', 'consumer', 'conn', process)
+        self.assertEqual(record.name, 'consumer_1')
+        self.assertEqual(record.consumer, 'consumer')
+        self.assertEqual(record.connection, 'conn')
+        self.assertIs(record.process, process)
+        self.assertEqual(record.started, 1000)
+        self.assertEqual(record.restarts, 0)
+        self.assertIsNone(record.stats)
+
+    def test_get(self):
+        record = self._obj.add('consumer_1', 'consumer', 'conn',
+                               self.new_process(1234))
+        self.assertIs(self._obj.get('consumer_1'), record)
+        self.assertIsNone(self._obj.get('consumer_2'))
+
+    def test_by_pid(self):
+        record = self._obj.add('consumer_1', 'consumer', 'conn',
+                               self.new_process(1234))
+        self.assertIs(self._obj.by_pid(1234), record)
+        self.assertIsNone(self._obj.by_pid(4321))
+
+    def test_started_indexes_pid(self):
+        process = self.new_process(None)
+        record = self._obj.add('consumer_1', 'consumer', 'conn', process)
+        self.assertIsNone(self._obj.by_pid(1234))
+        process.pid = 1234
+        self._obj.started('consumer_1')
+        self.assertIs(self._obj.by_pid(1234), record)
+
+    def test_contains_and_len(self):
+        self._obj.add('consumer_1', 'consumer', 'conn', self.new_process(1))
+        self._obj.add('other_1', 'other', 'conn', self.new_process(2))
+        self.assertIn('consumer_1', self._obj)
+        self.assertNotIn('consumer_2', self._obj)
+        self.assertEqual(len(self._obj), 2)
+
+    def test_count(self):
+        self._obj.add('consumer_1', 'consumer', 'conn1', self.new_process(1))
+        self._obj.add('consumer_2', 'consumer', 'conn1', self.new_process(2))
+        self._obj.add('consumer_3', 'consumer', 'conn2', self.new_process(3))
+        self.assertEqual(self._obj.count('consumer'), 3)
+        self.assertEqual(self._obj.count('consumer', 'conn1'), 2)
+        self.assertEqual(self._obj.count('consumer', 'conn3'), 0)
+        self.assertEqual(self._obj.count('other'), 0)
+
+    def test_names_in_start_order(self):
+        for offset in [3, 1, 2]:
+            self._obj.add('consumer_%i' % offset, 'consumer', 'conn',
+                          self.new_process(offset))
+        self.assertEqual(self._obj.names('consumer', 'conn'),
+                         ['consumer_3', 'consumer_1', 'consumer_2'])
+        self.assertEqual(self._obj.names('consumer', 'other'), [])
+
+    def test_remove(self):
+        record = self._obj.add('consumer_1', 'consumer', 'conn',
+                               self.new_process(1234))
+        self.assertIs(self._obj.remove('consumer_1'), record)
+        self.assertNotIn('consumer_1', self._obj)
+        self.assertIsNone(self._obj.by_pid(1234))
+        self.assertEqual(self._obj.count('consumer'), 0)
+        self.assertEqual(self._obj.names('consumer', 'conn'), [])
+
+    def test_remove_unknown(self):
+        self.assertIsNone(self._obj.remove('consumer_1'))
+
+    def test_remove_exited_counts_restart(self):
+        self._obj.add('consumer_1', 'consumer', 'conn', self.new_process(1))
+        self._obj.remove('consumer_1', True)
+        record = self._obj.add('consumer_2', 'consumer', 'conn',
+                               self.new_process(2))
+        self.assertEqual(record.restarts, 1)
+
+    def test_remove_stopped_does_not_count_restart(self):
+        self._obj.add('consumer_1', 'consumer', 'conn', self.new_process(1))
+        self._obj.remove('consumer_1')
+        record = self._obj.add('consumer_2', 'consumer', 'conn',
+                               self.new_process(2))
+        self.assertEqual(record.restarts, 0)
+
+    def test_iter_records(self):
+        record = self._obj.add('consumer_1', 'consumer', 'conn',
+                               self.new_process(1))
+        self.assertEqual(list(self._obj), [record])
+
+    def test_add_spare(self):
+        record = self._obj.add('consumer_1', 'consumer', 'conn',
+                               self.new_process(1), True)
+        self.assertTrue(record.spare)
+        self.assertIn('consumer_1', self._obj)
+        self.assertEqual(self._obj.count('consumer', 'conn'), 0)
+        self.assertEqual(self._obj.names('consumer', 'conn'), [])
+        self.assertEqual(self._obj.spares('consumer', 'conn'), ['consumer_1'])
+
+    def test_activate(self):
+        self._obj.add('consumer_1', 'consumer', 'conn', self.new_process(1))
+        self._obj.add('consumer_2', 'consumer', 'conn', self.new_process(2),
+                      True)
+        record = self._obj.activate('consumer_2')
+        self.assertFalse(record.spare)
+        self.assertEqual(self._obj.count('consumer'), 2)
+        self.assertEqual(self._obj.names('consumer', 'conn'),
+                         ['consumer_1', 'consumer_2'])
+        self.assertEqual(self._obj.spares('consumer', 'conn'), [])
+
+    def test_remove_spare(self):
+        self._obj.add('consumer_1', 'consumer', 'conn', self.new_process(1),
+                      True)
+        self._obj.remove('consumer_1', True)
+        self.assertEqual(self._obj.spares('consumer', 'conn'), [])
+        self.assertEqual(len(self._obj), 0)
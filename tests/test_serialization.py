@@ -0,0 +1,394 @@
+"""Tests for rejected.serialization"""
+import bz2
+import csv
+import decimal
+import mock
+import os
+import shutil
+import sys
+import tempfile
+# Import unittest if 2.7, unittest2 if other version
+if (sys.version_info[0], sys.version_info[1]) == (2, 7):
+    import unittest
+else:
+    import unittest2 as unittest
+import yaml
+import zlib
+
+from rejected import serialization
+
+CUSTOM = serialization.Codec('custom', str, str)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self._obj = serialization.Registry()
+        self._first = serialization.Codec('first', str, str)
+        self._second = serialization.Codec('second', repr, repr)
+        self._obj.register(['text/a', 'text/b'], self._first)
+        self._obj.register('text/a', self._second)
+
+    def test_contains(self):
+        self.assertIn('text/a', self._obj)
+        self.assertNotIn('text/c', self._obj)
+
+    def test_backends(self):
+        self.assertEqual(self._obj.backends('text/a'), ['first', 'second'])
+        self.assertEqual(self._obj.backends('text/c'), [])
+
+    def test_first_registered_is_default(self):
+        self.assertIs(self._obj.get('text/a'), self._first)
+
+    def test_register_default(self):
+        self._obj.register('text/a', self._second, True)
+        self.assertIs(self._obj.get('text/a'), self._second)
+
+    def test_get_backend(self):
+        self.assertIs(self._obj.get('text/a', 'second'), self._second)
+
+    def test_get_unknown(self):
+        self.assertIsNone(self._obj.get('text/c'))
+        self.assertIsNone(self._obj.get('text/b', 'second'))
+        self.assertIsNone(self._obj.get(None))
+
+    def test_select_defaults(self):
+        self.assertEqual(self._obj.select(), {'text/a': self._first,
+                                              'text/b': self._first})
+
+    def test_select_backend(self):
+        codecs = self._obj.select({'text/a': 'second'})
+        self.assertIs(codecs['text/a'], self._second)
+        self.assertIs(codecs['text/b'], self._first)
+
+    def test_select_codec(self):
+        codecs = self._obj.select({'text/c': self._second})
+        self.assertIs(codecs['text/c'], self._second)
+
+    def test_select_import_path(self):
+        codecs = self._obj.select({'text/c':
+                                   'tests.test_serialization.CUSTOM'})
+        self.assertIs(codecs['text/c'], CUSTOM)
+
+    def test_select_unknown_backend(self):
+        self.assertRaises(ValueError, self._obj.select, {'text/b': 'second'})
+
+    def test_select_import_error(self):
+        self.assertRaises(ValueError, self._obj.select,
+                          {'text/c': 'tests.test_serialization.MISSING'})
+
+    def test_select_import_not_a_codec(self):
+        self.assertRaises(ValueError, self._obj.select,
+                          {'text/c': 'tests.test_serialization.unittest'})
+
+
+class TestCodecs(unittest.TestCase):
+
+    VALUE = {'foo': 'bar', 'baz': [1, 2, 3]}
+
+    def round_trip(self, key, backend=None, value=None):
+        codec = serialization.REGISTRY.get(key, backend)
+        return codec.load(codec.dump(value or self.VALUE))
+
+    def test_content_types_round_trip(self):
+        for key in ['application/json', 'application/x-plist',
+                    'application/x-pickle', 'text/yaml']:
+            for backend in serialization.REGISTRY.backends(key):
+                self.assertEqual(self.round_trip(key, backend), self.VALUE)
+
+    def test_content_encodings_round_trip(self):
+        for key in ['bzip2', 'gzip']:
+            self.assertEqual(self.round_trip(key, value='x' * 100), 'x' * 100)
+
+    def test_simplejson_default_loads_decimals(self):
+        if not serialization.simplejson:
+            self.skipTest('simplejson is not installed')
+        codec = serialization.REGISTRY.get('application/json')
+        self.assertEqual(codec.name, 'simplejson')
+        self.assertIsInstance(codec.load('{"a": 1.5}')['a'], decimal.Decimal)
+
+    def test_json_backend(self):
+        codec = serialization.REGISTRY.get('application/json', 'json')
+        self.assertEqual(codec.load('{"a": 1.5}'), {'a': 1.5})
+
+    def test_yaml_c_backend(self):
+        if not hasattr(yaml, 'CLoader'):
+            self.skipTest('libyaml is not available')
+        self.assertEqual(serialization.REGISTRY.backends('text/x-yaml'),
+                         ['yaml', 'yaml_c'])
+        self.assertEqual(self.round_trip('text/yaml', 'yaml_c'), self.VALUE)
+
+    def test_csv(self):
+        codec = serialization.REGISTRY.get('text/csv')
+        value = codec.dump([['a', 'b'], ['1', '2']])
+        self.assertEqual(value, '"a","b"\r\n"1","2"\r\n')
+        reader = codec.load(value)
+        self.assertIsInstance(reader, csv.DictReader)
+        self.assertEqual(list(reader), [{'a': '1', 'b': '2'}])
+
+    def test_bs4(self):
+        if not serialization.bs4:
+            self.skipTest('BeautifulSoup4 is not installed')
+        codec = serialization.REGISTRY.get('text/html')
+        self.assertEqual(codec.load('<title>hi</title>').title.string, 'hi')
+
+
+class TestStreaming(unittest.TestCase):
+
+    VALUE = ''.join([chr(offset % 251) for offset in range(200000)])
+
+    def test_stream_zlib(self):
+        chunks = list(serialization.stream_zlib(zlib.compress(self.VALUE)))
+        self.assertEqual(''.join(chunks), self.VALUE)
+        self.assertTrue(all(len(chunk) <= serialization.CHUNK_SIZE
+                            for chunk in chunks))
+
+    def test_stream_bz2(self):
+        chunks = list(serialization.stream_bz2(bz2.compress(self.VALUE)))
+        self.assertEqual(''.join(chunks), self.VALUE)
+        self.assertTrue(all(len(chunk) <= serialization.CHUNK_SIZE
+                            for chunk in chunks))
+
+    def test_stream_empty(self):
+        self.assertEqual(list(serialization.stream_zlib(zlib.compress(''))),
+                         [])
+        self.assertEqual(list(serialization.stream_bz2(bz2.compress(''))),
+                         [])
+
+    def test_stream_zlib_max_size(self):
+        chunks = serialization.stream_zlib(zlib.compress('\0' * 10000000),
+                                           100000)
+        self.assertRaises(serialization.MaxSizeExceeded, list, chunks)
+
+    def test_stream_bz2_max_size(self):
+        chunks = serialization.stream_bz2(bz2.compress('\0' * 10000000),
+                                          100000)
+        self.assertRaises(serialization.MaxSizeExceeded, list, chunks)
+
+    def test_stream_bz2_max_size_per_block(self):
+        value = bz2.compress('\0' * 10000000)
+        with mock.patch('bz2.BZ2Decompressor') as decompressor:
+            decompressor.return_value.decompress.return_value = '\0' * 200000
+            chunks = serialization.stream_bz2(value, 100000)
+            self.assertRaises(serialization.MaxSizeExceeded, list, chunks)
+            decompressor.return_value.decompress.assert_called_once_with(
+                value[:serialization._BZ2_INPUT_SIZE])
+
+    def test_stream_bz2_within_max_size(self):
+        value = bz2.compress(self.VALUE)
+        self.assertEqual(''.join(serialization.stream_bz2(value,
+                                                          len(self.VALUE))),
+                         self.VALUE)
+
+    def test_stream_bz2_unlimited_input_size(self):
+        value = bz2.compress(self.VALUE)
+        with mock.patch('bz2.BZ2Decompressor') as decompressor:
+            decompressor.return_value.decompress.return_value = ''
+            list(serialization.stream_bz2(value))
+            decompressor.return_value.decompress.assert_called_once_with(
+                value[:serialization.CHUNK_SIZE])
+
+    def test_stream_within_max_size(self):
+        value = zlib.compress(self.VALUE)
+        self.assertEqual(''.join(serialization.stream_zlib(value,
+                                                           len(self.VALUE))),
+                         self.VALUE)
+
+    def test_encodings_stream(self):
+        for key in ['bzip2', 'gzip']:
+            self.assertIsNotNone(serialization.REGISTRY.get(key).stream)
+
+
+class TestCSV(unittest.TestCase):
+
+    LINES = ['a,b\r\n', '1,2\r\n', '3,4\r\n']
+
+    def test_csv_dialect_name(self):
+        self.assertIs(serialization.csv_dialect('excel-tab'),
+                      csv.get_dialect('excel-tab'))
+
+    def test_csv_dialect_parameters(self):
+        dialect = serialization.csv_dialect({u'delimiter': u'|'})
+        self.assertEqual(dialect.delimiter, '|')
+        self.assertEqual(dialect.quotechar, csv.excel.quotechar)
+        self.assertEqual(csv.excel.delimiter, ',')
+
+    def test_csv_dialect_unknown_name(self):
+        self.assertRaises(csv.Error, serialization.csv_dialect, 'unknown')
+
+    def test_csv_dialect_instance(self):
+        self.assertIs(serialization.csv_dialect(csv.excel), csv.excel)
+
+    def test_sniff_csv_dialect_uses_sample(self):
+        sample = 'a|b\n' * 1000
+        with mock.patch('csv.Sniffer.sniff') as sniff:
+            serialization.sniff_csv_dialect(sample)
+            sniff.assert_called_once_with(
+                sample[:serialization.CSV_SAMPLE_SIZE])
+
+    def test_load_csv_with_dialect(self):
+        reader = serialization.load_csv('a|b\n1|2\n',
+                                        serialization.csv_dialect(
+                                            {'delimiter': '|'}))
+        self.assertEqual(list(reader), [{'a': '1', 'b': '2'}])
+
+    def test_load_csv_rows(self):
+        fields, rows = serialization.load_csv_rows(iter(self.LINES),
+                                                   csv.excel)
+        self.assertEqual(fields, ['a', 'b'])
+        self.assertEqual(list(rows), [['1', '2'], ['3', '4']])
+
+    def test_load_csv_rows_typed(self):
+        fields, rows = serialization.load_csv_rows(iter(self.LINES),
+                                                   csv.excel,
+                                                   {'a': 'decimal', 'b': int})
+        self.assertEqual(list(rows), [[decimal.Decimal('1'), 2],
+                                      [decimal.Decimal('3'), 4]])
+
+    def test_load_csv_rows_empty(self):
+        fields, rows = serialization.load_csv_rows(iter([]), csv.excel)
+        self.assertEqual(fields, [])
+        self.assertEqual(list(rows), [])
+
+    def test_load_csv_columns(self):
+        self.assertEqual(serialization.load_csv_columns(iter(self.LINES),
+                                                        csv.excel,
+                                                        {'b': 'float'}),
+                         {'a': ['1', '3'], 'b': [2.0, 4.0]})
+
+    def test_load_csv_columns_ragged_rows(self):
+        lines = ['a,b\r\n', '1\r\n', '3,4,5\r\n']
+        self.assertEqual(serialization.load_csv_columns(iter(lines),
+                                                        csv.excel),
+                         {'a': ['1', '3'], 'b': [None, '4']})
+
+    def test_load_csv_columns_header_only(self):
+        self.assertEqual(serialization.load_csv_columns(iter(self.LINES[:1]),
+                                                        csv.excel),
+                         {'a': [], 'b': []})
+
+
+class TestSchemaCache(unittest.TestCase):
+
+    def setUp(self):
+        self._schema = mock.Mock(side_effect=lambda name, location:
+                                 (name, location))
+        self._codec = serialization.Codec('custom', str, str,
+                                          schema=self._schema)
+        self._obj = serialization.SchemaCache()
+
+    def test_get_resolves_once(self):
+        for _ in range(2):
+            self.assertEqual(self._obj.get(self._codec, 'Event', 'here'),
+                             ('Event', 'here'))
+        self._schema.assert_called_once_with('Event', 'here')
+        self.assertEqual(len(self._obj), 1)
+
+    def test_get_caches_by_location(self):
+        self._obj.get(self._codec, 'Event', 'here')
+        self._obj.get(self._codec, 'Event', 'there')
+        self.assertEqual(len(self._obj), 2)
+
+    def test_get_invalid_names(self):
+        for name in [None, '', '../etc/passwd', '.Event', 'a/b', 'Event.']:
+            self.assertRaises(serialization.SchemaNameError, self._obj.get,
+                              self._codec, name, 'here')
+        self.assertFalse(self._schema.called)
+
+    def test_get_without_location(self):
+        self.assertRaises(serialization.SchemaLocationError, self._obj.get,
+                          self._codec, 'Event')
+
+    def test_get_does_not_cache_errors(self):
+        self._schema.side_effect = serialization.SchemaError('missing')
+        for _ in range(2):
+            self.assertRaises(serialization.SchemaError, self._obj.get,
+                              self._codec, 'Event', 'here')
+        self.assertEqual(self._schema.call_count, 2)
+        self.assertEqual(len(self._obj), 0)
+
+    def test_clear(self):
+        self._obj.get(self._codec, 'Event', 'here')
+        self._obj.clear()
+        self.assertEqual(len(self._obj), 0)
+
+
+class TestBinaryCodecs(unittest.TestCase):
+
+    AVSC = """{"type": "record", "name": "Event",
+               "fields": [{"name": "id", "type": "string"},
+                          {"name": "count", "type": "int"}]}"""
+    PROTOBUF_MODULE = 'google.protobuf.descriptor_pb2'
+    VALUE = {'id': u'abc', 'count': 10}
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        with open(os.path.join(self._directory, 'Event.avsc'), 'w') as handle:
+            handle.write(self.AVSC)
+        self._cache = serialization.SchemaCache()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_msgpack(self):
+        if not serialization.msgpack:
+            self.skipTest('msgpack is not installed')
+        codec = serialization.REGISTRY.get('application/msgpack')
+        self.assertEqual(codec.load(codec.dump(self.VALUE)), self.VALUE)
+
+    def test_avro(self):
+        if not serialization.avro:
+            self.skipTest('avro is not installed')
+        codec = serialization.REGISTRY.get('application/x-avro')
+        schema = self._cache.get(codec, 'Event', self._directory)
+        self.assertEqual(codec.load(codec.dump(self.VALUE, schema), schema),
+                         self.VALUE)
+
+    def test_avro_missing_schema(self):
+        if not serialization.avro:
+            self.skipTest('avro is not installed')
+        self.assertRaises(serialization.SchemaNameError,
+                          serialization.avro_schema, 'Other', self._directory)
+
+    def test_avro_missing_directory(self):
+        if not serialization.avro:
+            self.skipTest('avro is not installed')
+        self.assertRaises(serialization.SchemaLocationError,
+                          serialization.avro_schema, 'Event',
+                          os.path.join(self._directory, 'missing'))
+
+    def test_avro_invalid_schema(self):
+        if not serialization.avro:
+            self.skipTest('avro is not installed')
+        with open(os.path.join(self._directory, 'Bad.avsc'), 'w') as handle:
+            handle.write('{"type": "unknown"}')
+        self.assertRaises(serialization.SchemaError,
+                          serialization.avro_schema, 'Bad', self._directory)
+
+    def test_protobuf(self):
+        if not serialization.protobuf_message:
+            self.skipTest('protobuf is not installed')
+        codec = serialization.REGISTRY.get('application/x-protobuf')
+        schema = self._cache.get(codec, 'DescriptorProto.ExtensionRange',
+                                 self.PROTOBUF_MODULE)
+        message = codec.load(codec.dump({'start': 1, 'end': 5}, schema),
+                             schema)
+        self.assertIsInstance(message, schema)
+        self.assertEqual((message.start, message.end), (1, 5))
+        self.assertEqual(codec.dump(message, schema),
+                         message.SerializeToString())
+
+    def test_protobuf_missing_message(self):
+        if not serialization.protobuf_message:
+            self.skipTest('protobuf is not installed')
+        for name in ['Missing', 'DESCRIPTOR']:
+            self.assertRaises(serialization.SchemaNameError,
+                              serialization.protobuf_schema, name,
+                              self.PROTOBUF_MODULE)
+
+    def test_protobuf_missing_module(self):
+        if not serialization.protobuf_message:
+            self.skipTest('protobuf is not installed')
+        self.assertRaises(serialization.SchemaLocationError,
+                          serialization.protobuf_schema, 'DescriptorProto',
+                          'missing_pb2')
@@ -0,0 +1,69 @@
+"""Micro-benchmark the registered codec backends of rejected.serialization
+on representative message payloads, timing a dump and a load of each.
+
+    python utils/codec_benchmark.py [iterations]
+
+"""
+import sys
+import timeit
+import uuid
+
+from rejected import serialization
+
+PAYLOADS = {
+    'small': {'id': str(uuid.uuid4()), 'type': 'click', 'count': 10,
+              'tags': ['a', 'b', 'c']},
+    'large': {'events': [{'id': str(uuid.uuid4()), 'offset': offset,
+                          'score': offset * 0.5, 'active': bool(offset % 2),
+                          'attributes': {'name': 'event-%i' % offset,
+                                         'values': range(10)}}
+                         for offset in range(500)]}}
+
+CONTENT_TYPES = ['application/json', 'application/msgpack',
+                 'application/x-pickle', 'application/x-plist', 'text/yaml']
+ENCODINGS = ['bzip2', 'gzip']
+
+
+def benchmark(codec, value, iterations):
+    """Return the dump and load times in microseconds and the dumped size
+    for the value.
+
+    :param rejected.serialization.Codec codec: The codec to benchmark
+    :param any value: The value to dump and load
+    :param int iterations: How many times to dump and load the value
+    :rtype: tuple(float, float, int)
+
+    """
+    dumped = codec.dump(value)
+    dump = timeit.timeit(lambda: codec.dump(value), number=iterations)
+    load = timeit.timeit(lambda: codec.load(dumped), number=iterations)
+    return (dump / iterations * 1000000, load / iterations * 1000000,
+            len(dumped))
+
+
+def report(key, value, iterations):
+    """Print the results for each of the backends for the content-type or
+    content-encoding.
+
+    :param str key: The content-type or content-encoding
+    :param any value: The value to dump and load
+    :param int iterations: How many times to dump and load the value
+
+    """
+    for backend in serialization.REGISTRY.backends(key):
+        codec = serialization.REGISTRY.get(key, backend)
+        dump, load, size = benchmark(codec, value, iterations)
+        print('  %-22s %-10s %10.2f usec dump %10.2f usec load %8i bytes' %
+              (key, backend, dump, load, size))
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1] if len(sys.argv) > 1 else 100)
+    for name in sorted(PAYLOADS, reverse=True):
+        print('%s payload, %i iterations' % (name, iterations))
+        for content_type in CONTENT_TYPES:
+            report(content_type, PAYLOADS[name], iterations)
+        body = serialization.REGISTRY.get('application/json').dump(
+            PAYLOADS[name])
+        for encoding in ENCODINGS:
+            report(encoding, body, iterations)
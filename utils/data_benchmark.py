@@ -0,0 +1,118 @@
+"""Micro-benchmark the construction cost and memory use of rejected.data.Message
+against the dict backed Message and Properties classes from rejected 3.2.5.
+
+    python utils/data_benchmark.py [body_size]
+
+"""
+import copy
+import sys
+import time
+import timeit
+import uuid
+
+from rejected import data
+
+ITERATIONS = 100000
+
+
+class LegacyDataObject(object):
+    pass
+
+
+class LegacyMessage(LegacyDataObject):
+
+    def __init__(self, channel, method, header, body):
+        self.channel = channel
+        self.method = method
+        self.properties = LegacyProperties(header)
+        self.body = copy.copy(body)
+        self.consumer_tag = method.consumer_tag
+        self.delivery_tag = method.delivery_tag
+        self.exchange = method.exchange
+        self.redelivered = method.redelivered
+        self.routing_key = method.routing_key
+
+
+class LegacyProperties(LegacyDataObject):
+
+    def __init__(self, header=None):
+        self.app_id = header.app_id
+        self.cluster_id = header.cluster_id
+        self.content_type = header.content_type
+        self.content_encoding = header.content_encoding
+        self.correlation_id = header.correlation_id
+        self.delivery_mode = header.delivery_mode
+        self.expiration = header.expiration
+        self.headers = copy.deepcopy(header.headers) or dict()
+        self.priority = header.priority
+        self.reply_to = header.reply_to
+        self.message_id = header.message_id
+        self.timestamp = header.timestamp
+        self.type = header.type
+        self.user_id = header.user_id
+
+
+class Header(object):
+    app_id = 'benchmark'
+    cluster_id = None
+    content_type = 'application/json'
+    content_encoding = None
+    correlation_id = str(uuid.uuid4())
+    delivery_mode = 1
+    expiration = None
+    headers = {'foo': 'bar', 'baz': [1, 2, 3]}
+    priority = None
+    reply_to = None
+    message_id = str(uuid.uuid4())
+    timestamp = int(time.time())
+    type = 'benchmark'
+    user_id = None
+
+
+class Method(object):
+    consumer_tag = 'ctag0'
+    delivery_tag = 1
+    exchange = 'benchmark'
+    redelivered = False
+    routing_key = 'benchmark'
+
+
+def instance_size(obj):
+    """Return the shallow size of the object and its attribute dict if it
+    has one, excluding the values that are shared with the pika frames.
+
+    :param object obj: The object to size
+    :rtype: int
+
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def benchmark(cls, body):
+    """Return the construction time in microseconds and the bytes used per
+    message for the message class.
+
+    :param type cls: The message class to benchmark
+    :param str body: The message body
+    :rtype: tuple(float, int)
+
+    """
+    header, method = Header(), Method()
+    duration = timeit.timeit(lambda: cls(None, method, header, body),
+                             number=ITERATIONS)
+    message = cls(None, method, header, body)
+    memory = (instance_size(message) + instance_size(message.properties) +
+              sys.getsizeof(message.properties.headers))
+    return duration / ITERATIONS * 1000000, memory
+
+
+if __name__ == '__main__':
+    body = 'x' * int(sys.argv[1] if len(sys.argv) > 1 else 65536)
+    print('%i messages with a %i byte body' % (ITERATIONS, len(body)))
+    for name, cls in [('legacy', LegacyMessage), ('slots', data.Message)]:
+        duration, memory = benchmark(cls, body)
+        print('%-8s %8.2f usec per message %6i bytes per message' %
+              (name, duration, memory))
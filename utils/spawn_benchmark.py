@@ -0,0 +1,62 @@
+"""Measure how long a forked consumer process takes to be ready to consume,
+importing the consumer modules after the fork like rejected 3.2.5 did and
+when the MCP has preloaded them before forking.
+
+    python utils/spawn_benchmark.py [module ...]
+
+"""
+import importlib
+import multiprocessing
+import sys
+import time
+
+ITERATIONS = 20
+MODULES = ['pika', 'tornado.ioloop', 'rejected.consumer', 'rejected.example']
+
+
+def child(modules, writer):
+    """Import the modules and send the time the process was ready at.
+
+    :param list modules: The modules to import
+    :param multiprocessing.Connection writer: The pipe to the parent
+
+    """
+    for name in modules:
+        importlib.import_module(name)
+    writer.send(time.time())
+    writer.close()
+
+
+def benchmark(modules):
+    """Return the average and the slowest time in milliseconds from creating
+    a process to the process having imported the modules.
+
+    :param list modules: The modules to import
+    :rtype: tuple(float, float)
+
+    """
+    durations = list()
+    for offset in range(ITERATIONS):
+        reader, writer = multiprocessing.Pipe(False)
+        start_time = time.time()
+        process = multiprocessing.Process(target=child,
+                                          args=(modules, writer))
+        process.start()
+        durations.append((reader.recv() - start_time) * 1000)
+        process.join()
+    return sum(durations) / len(durations), max(durations)
+
+
+if __name__ == '__main__':
+    modules = sys.argv[1:] or MODULES
+    print('%i spawns importing %s' % (ITERATIONS, ', '.join(modules)))
+
+    # The modules must not be imported before the cold spawns are measured
+    average, slowest = benchmark(modules)
+    print('%-10s %8.2f msec average %8.2f msec slowest' %
+          ('cold', average, slowest))
+    for name in modules:
+        importlib.import_module(name)
+    average, slowest = benchmark(modules)
+    print('%-10s %8.2f msec average %8.2f msec slowest' %
+          ('preloaded', average, slowest))